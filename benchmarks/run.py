@@ -0,0 +1,260 @@
+'''
+Benchmarks of the hot paths of gobattlesim.
+
+Run from the repository root:
+
+    python -m benchmarks.run [-o results.json] [--baseline benchmarks/baseline.json] [--threshold 0.25] [--strict]
+
+Everything runs offline on the bundled game master. The matrix benchmark uses GBS, which is the
+deterministic NumPy engine when the native library is not available.
+'''
+
+import argparse
+import csv
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from gobattlesim.Engine import GBS
+from gobattlesim.GameMaster import GameMaster
+from gobattlesim.Matrix import do_run_matrix, load_and_set_pokemon
+from gobattlesim.PokeQuery import PokeQuery, batch_pokemon, compile_query
+from gobattlesim.Ranking import rank_matrix
+from gobattlesim.RaidEngine import RaidSettings, raid_boss, raid_counters, set_raid_attacker
+from gobattlesim.Pokemon import Pokemon
+from gobattlesim.Tables import Tables, get_tables
+from gobattlesim.TeamBuilder import search_teams
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GAME_MASTER_PATH = os.path.join(ROOT, "game_master", "GAME_MASTER.json")
+DEFAULT_BASELINE = os.path.join(ROOT, "benchmarks", "baseline.json")
+
+COMPLEX_QUERIES = [
+    "(dragon,steel)&!(shadow,purified)&!legendary",
+    "dex1-251&(fire,water,grass)&!mythic",
+    "!(normal|flying):(psychic&fairy);dex386-493",
+]
+
+
+class Benchmarks:
+    '''
+    Benchmark cases sharing one parsed game master and temporary files.
+    '''
+
+    def __init__(self, workdir):
+        self.workdir = workdir
+        self.gm = GameMaster().parse(GAME_MASTER_PATH)
+        self.gm.apply()
+        GBS.config(self.gm.to_json())
+
+        self.config_path = os.path.join(workdir, "GBS.json")
+        with open(self.config_path, "w") as fd:
+            json.dump(self.gm.to_json(), fd)
+
+        # A fixed Pokemon list: one moveset of each species in the first generations
+        pkm_list = batch_pokemon({"name": "dex1-251", "fmove": "*", "cmove": "*", "cmove2": "*"}, self.gm)
+        seen = set()
+        self.pkm_list = []
+        for pkm in pkm_list:
+            if pkm["name"] not in seen:
+                seen.add(pkm["name"])
+                self.pkm_list.append({k: pkm[k] for k in ["name", "fmove", "cmove", "cmove2"]})
+        self.pkm_path = os.path.join(workdir, "pokemon.csv")
+        with open(self.pkm_path, "w", newline="") as fd:
+            writer = csv.DictWriter(fd, ["name", "fmove", "cmove", "cmove2"])
+            writer.writeheader()
+            writer.writerows(self.pkm_list)
+        self.matrix_pkm = load_and_set_pokemon(self.pkm_path, "great", self.gm)[:150]
+        self.matrix_values = np.asarray(do_run_matrix(self.matrix_pkm, [], 0), dtype=np.float32)
+
+        self.base_stats = get_tables(self.gm).species.base_stats
+
+        self.raid_attackers = [set_raid_attacker({"name": pkm["name"], "fmove": pkm["fmove"], "cmove": pkm["cmove"]},
+                                                 self.gm) for pkm in self.pkm_list[:50]]
+        self.raid_attackers = [pkm for pkm in self.raid_attackers if pkm]
+        self.raid_settings = RaidSettings(self.gm, "5")
+        self.raid_boss = raid_boss("tyranitar", "bite", "crunch", "5", self.gm)
+
+    def gamemaster_parse(self):
+        GameMaster().parse(GAME_MASTER_PATH)
+
+    def gamemaster_load_config(self):
+        GameMaster().load_config(self.config_path)
+
+    def pokequery_compile(self):
+        compile_query.cache_clear()
+        for query in COMPLEX_QUERIES:
+            compile_query(query)
+
+    def pokequery_eval(self):
+        for query in COMPLEX_QUERIES:
+            # A plain list gets a fresh bitset index, so index building is measured too
+            PokeQuery(query).select(self.gm.Pokemon)
+
+    def batch_pokemon(self):
+        batch_pokemon({"name": "dex1-151", "fmove": "*", "cmove": "*", "cmove2": "*"}, self.gm)
+
+    def infer_ivs(self):
+        for bAtk, bDef, bStm in self.base_stats[:100]:
+            Pokemon.infer_cpm_and_IVs(bAtk, bDef, bStm, 1500)
+
+    def infer_ivs_batch(self):
+        Pokemon.infer_cpm_and_IVs_batch(self.base_stats[:, 0], self.base_stats[:, 1], self.base_stats[:, 2], 1500)
+
+    def tables(self):
+        Tables(self.gm)
+
+    def load_and_set_pokemon(self):
+        load_and_set_pokemon(self.pkm_path, "great", self.gm)
+
+    def matrix(self):
+        do_run_matrix(self.matrix_pkm, [], 0)
+
+    def ranking(self):
+        rank_matrix(self.matrix_values, "rm")
+
+    def teams(self):
+        for objective in ["meta", "worst", "wins"]:
+            search_teams(self.matrix_values, 3, 10, objective)
+
+    def raid(self):
+        raid_counters(self.raid_attackers, self.raid_boss, self.raid_settings,
+                      ("NONE", "CLEAR"), trials=20, seed=0)
+
+    CASES = ["gamemaster_parse", "gamemaster_load_config", "pokequery_compile", "pokequery_eval",
+             "batch_pokemon", "infer_ivs", "infer_ivs_batch", "tables", "load_and_set_pokemon", "matrix", "ranking", "teams",
+             "raid"]
+
+
+def measure(func, repeat, min_time=0.2):
+    '''
+    Time @param func @param repeat times, after one warm-up call.
+    Calls are repeated within a sample until it lasts @param min_time seconds, to time fast cases reliably.
+    @return dict of per-call seconds: "min", "median", and "samples"
+    '''
+    func()
+    start = time.perf_counter()
+    func()
+    once = max(time.perf_counter() - start, 1e-9)
+    loops = max(1, int(min_time / once))
+    samples = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        for j in range(loops):
+            func()
+        samples.append((time.perf_counter() - start) / loops)
+    return {"min": min(samples), "median": statistics.median(samples), "samples": len(samples), "loops": loops}
+
+
+def compare(results, baseline, threshold):
+    '''
+    Compare the medians of @param results against @param baseline.
+
+    @param threshold allowed relative slowdown, e.g. 0.25 for 25%.
+        The baseline may set its own per-case thresholds in field "thresholds"
+    @return list of (case, baseline seconds, current seconds, relative change, regressed)
+    '''
+    thresholds = baseline.get("thresholds", {})
+    rows = []
+    for case, result in results["results"].items():
+        base = baseline.get("results", {}).get(case)
+        if base is None:
+            continue
+        change = result["median"] / base["median"] - 1
+        rows.append((case, base["median"], result["median"], change, change > thresholds.get(case, threshold)))
+    return rows
+
+
+def meta_mismatch(results, baseline):
+    '''
+    Return the fields of the run environment ("meta") of @param results that differ from @param baseline,
+    as list of (field, baseline value, current value). Timings are only comparable when it is empty.
+    '''
+    base_meta = baseline.get("meta", {})
+    return [(field, base_meta.get(field), value) for field, value in results["meta"].items()
+            if base_meta.get(field) != value]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("cases", nargs="*",
+                        help="benchmark cases to run. If omitted, run all: " + ", ".join(Benchmarks.CASES))
+    parser.add_argument("-r", "--repeat", type=int, default=5,
+                        help="number of timed samples per case")
+    parser.add_argument("-o", "--out",
+                        help="file to store results (json)")
+    parser.add_argument("--baseline", nargs="?", const=DEFAULT_BASELINE,
+                        help="compare against stored baseline results. Default to " + DEFAULT_BASELINE)
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="allowed relative slowdown of the median vs the baseline")
+    parser.add_argument("--save-baseline", nargs="?", const=DEFAULT_BASELINE,
+                        help="store the results as the new baseline")
+    parser.add_argument("--strict", action="store_true",
+                        help="fail on regressions even if the baseline was recorded in another environment")
+    args = parser.parse_args()
+
+    cases = args.cases or Benchmarks.CASES
+    for case in cases:
+        if case not in Benchmarks.CASES:
+            parser.error("unknown case {}".format(case))
+
+    with tempfile.TemporaryDirectory() as workdir:
+        # Keep snapshots of the temporary files out of the user's cache
+        os.environ["GBS_CACHE_DIR"] = workdir
+        bench = Benchmarks(workdir)
+        results = {
+            "meta": {
+                "python": sys.version.split()[0],
+                "numpy": np.__version__,
+                "platform": platform.platform(),
+                "engine": GBS.version()
+            },
+            "results": {}
+        }
+        for case in cases:
+            result = measure(getattr(bench, case), args.repeat)
+            results["results"][case] = result
+            print("{:<24}{:>12.6f}s median{:>12.6f}s min".format(case, result["median"], result["min"]),
+                  file=sys.stderr)
+
+    if args.out:
+        with open(args.out, "w") as fd:
+            json.dump(results, fd, indent=4)
+    if args.save_baseline:
+        baseline = {}
+        if os.path.isfile(args.save_baseline):
+            with open(args.save_baseline) as fd:
+                baseline = json.load(fd)
+        # Keep configured thresholds, and the results of cases not run this time
+        baseline["meta"] = results["meta"]
+        baseline.setdefault("results", {}).update(results["results"])
+        with open(args.save_baseline, "w") as fd:
+            json.dump(baseline, fd, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as fd:
+            baseline = json.load(fd)
+        mismatch = meta_mismatch(results, baseline)
+        for field, base, current in mismatch:
+            print("Warning: baseline {} is {}, current is {}".format(field, base, current), file=sys.stderr)
+        if mismatch and not args.strict:
+            print("Warning: the baseline was recorded in another environment, regressions are reported only. "
+                  "Record a local baseline with --save-baseline", file=sys.stderr)
+        regressed = False
+        for case, base, current, change, bad in compare(results, baseline, args.threshold):
+            print("{:<24}{:>12.6f}s ->{:>12.6f}s {:>+8.1%}{}".format(
+                case, base, current, change, "  REGRESSION" if bad else ""))
+            regressed = regressed or bad
+        return 1 if regressed and (args.strict or not mismatch) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,105 @@
+'''
+This module provides an asyncio interface to the GoBattleSim engine.
+
+The engine keeps one global state per process, so each simulation runs in a pool of worker processes,
+each with its own engine instance.
+'''
+
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import sys
+
+from .Engine import GBS, default_session
+
+
+def _init_worker(config):
+    if config is not None:
+        default_session().configure(config)
+
+
+def _simulate(sim_input):
+    try:
+        return default_session().run(sim_input)
+    except Exception as e:
+        gbs_error = GBS.error()
+        if gbs_error:
+            raise RuntimeError("GBS Engine error: {}".format(gbs_error)) from None
+        raise
+
+
+class AsyncEngine:
+    '''
+    Run simulations from asyncio code on a pool of isolated engine processes.
+
+    Usage:
+
+        async with AsyncEngine(workers=4, config=game_master.to_json()) as engine:
+            output = await engine.simulate(sim_input)
+    '''
+
+    def __init__(self, workers=2, config=None, max_pending=None):
+        '''
+        @param workers number of engine processes
+        @param config GBS configuration each engine applies on start
+        @param max_pending maximum number of simulations submitted at once. Default to 2 per worker.
+            Further calls to simulate() wait for a free slot, which keeps callers from queueing without bound
+        '''
+        self.workers = workers
+        self.config = config
+        self.max_pending = max_pending or 2 * workers
+        self._pool = None
+        self._slots = None
+
+    def start(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                             initargs=(self.config,))
+        return self
+
+    def close(self, wait=True):
+        '''
+        Shut down the engine processes. Simulations not started yet are cancelled (Python 3.9+);
+        on earlier versions they still run first.
+        '''
+        if self._pool is not None:
+            if sys.version_info >= (3, 9):
+                self._pool.shutdown(wait=wait, cancel_futures=True)
+            else:
+                self._pool.shutdown(wait=wait)
+            self._pool = None
+
+    async def __aenter__(self):
+        return self.start()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.close)
+
+    async def simulate(self, sim_input):
+        '''
+        Run simulation input @param sim_input (dict, or json bytes from EngineSession.encode)
+        and return the simulation output.
+
+        Cancelling the awaiting task withdraws a simulation that has not started yet;
+        one already running finishes in its process and its result is discarded.
+        '''
+        self.start()
+        if self._slots is None:
+            # Created on first use, so that it belongs to the running event loop
+            self._slots = asyncio.Semaphore(self.max_pending)
+        async with self._slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._pool, _simulate, sim_input)
+
+    async def battle_matrix(self, row_pkm, col_pkm=[], shield=0):
+        '''
+        Run the Battle Matrix of battle-ready Pokemon, as Matrix.do_run_matrix does.
+
+        @return matrix as 2D list
+        '''
+        return await self.simulate({
+            "battleMode": "battlematrix",
+            "rowPokemon": row_pkm,
+            "colPokemon": col_pkm,
+            "avergeByShield": shield != 0
+        })
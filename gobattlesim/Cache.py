@@ -0,0 +1,170 @@
+'''
+This module provides persistent caches for simulation results.
+'''
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+# Fields of a battle-ready Pokemon that determine its matchups
+MatchupFields = ["pokeType1", "pokeType2", "attack",
+                 "defense", "maxHP", "fmove", "cmoves", "num_shields"]
+
+# GoBattleSim configuration fields not used in battles once combatants have their stats and moves set
+NonBattleConfigFields = ["Pokemon", "PvEMoves", "PvPMoves"]
+
+# GoBattleSim configuration fields only used in PvE battles
+PvEConfigFields = ["PvEBattleSettings", "WeatherSettings", "FriendAttackBonusMultipliers", "RaidTierSettings"]
+
+
+def cache_dir():
+    '''
+    Return the directory for on-disk caches, which is $GBS_CACHE_DIR or ~/.cache/gobattlesim.
+    The directory is created if needed.
+    '''
+    path = os.environ.get("GBS_CACHE_DIR") or os.path.join(
+        os.path.expanduser("~"), ".cache", "gobattlesim")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def digest(obj):
+    '''
+    Return the hex SHA-1 of the canonical json encoding of @param obj.
+    '''
+    s = json.dumps(obj, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(s.encode()).hexdigest()
+
+
+def _canonical_move(move):
+    if not isinstance(move, dict):
+        return move
+    return {k: v for k, v in move.items() if k != "movetype"}
+
+
+def pokemon_key(pkm):
+    '''
+    Return the content hash of battle-ready Pokemon @param pkm,
+    covering its types, stats and moves (charged moves in canonical order).
+    '''
+    core = {}
+    for field in MatchupFields:
+        if field not in pkm:
+            continue
+        value = pkm[field]
+        if field == "fmove":
+            value = _canonical_move(value)
+        elif field == "cmoves":
+            value = sorted([_canonical_move(move) for move in value],
+                           key=lambda move: json.dumps(move, sort_keys=True))
+        core[field] = value
+    return digest(core)
+
+
+def config_hash(game_master_json):
+    '''
+    Return the hash of the battle-relevant part of a GoBattleSim configuration.
+    Pokemon and move data are left out, since combatants carry their own stats and moves.
+    '''
+    return digest({k: v for k, v in game_master_json.items() if k not in NonBattleConfigFields})
+
+
+def matchup_config_hash(game_master_json):
+    '''
+    Return the hash of the part of a GoBattleSim configuration that PvP matchups depend on.
+    PvE settings are left out too, so that changes to them keep cached matchups valid.
+    '''
+    return digest({k: v for k, v in game_master_json.items()
+                   if k not in NonBattleConfigFields and k not in PvEConfigFields})
+
+
+def matchup_key(row_key, col_key, shield, config_key, engine=""):
+    '''
+    Return the cache key of the matchup of row Pokemon @param row_key vs col Pokemon @param col_key,
+    simulated by engine of version @param engine.
+    '''
+    s = "{}:{}:{}:{}:{}".format(row_key, col_key, int(shield != 0), config_key, engine)
+    return hashlib.sha1(s.encode()).hexdigest()
+
+
+class MatchupCache:
+    '''
+    On-disk store of pairwise battle results with size-based LRU eviction.
+    '''
+
+    def __init__(self, path=None, max_size=1 << 30):
+        '''
+        @param path path to the cache database. Default to "matchups.sqlite" in cache_dir()
+        @param max_size maximum size of the cache in bytes
+        '''
+        if path is None:
+            path = os.path.join(cache_dir(), "matchups.sqlite")
+        self.path = path
+        self.max_size = max_size
+        # Callers that share a cache across threads (e.g. the Server) serialize access themselves
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS matchup (key TEXT PRIMARY KEY, score REAL, last_used REAL)")
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS matchup_last_used ON matchup (last_used)")
+        self.db.commit()
+
+    def get_many(self, keys, batch_size=500):
+        '''
+        Look up @param keys and mark the hits as recently used.
+        @return dict of key to score, for the keys found
+        '''
+        keys = list(keys)
+        found = {}
+        for i in range(0, len(keys), batch_size):
+            batch = keys[i:i + batch_size]
+            rows = self.db.execute("SELECT key, score FROM matchup WHERE key IN ({})".format(
+                ",".join("?" * len(batch))), batch)
+            found.update(rows)
+        if found:
+            now = time.time()
+            self.db.executemany("UPDATE matchup SET last_used = ? WHERE key = ?",
+                                [(now, key) for key in found])
+            self.db.commit()
+        return found
+
+    def put_many(self, items):
+        '''
+        Store (key, score) pairs @param items, then evict least recently used entries if over the size limit.
+        '''
+        now = time.time()
+        self.db.executemany("INSERT OR REPLACE INTO matchup VALUES (?, ?, ?)",
+                            [(key, score, now) for key, score in items])
+        self.db.commit()
+        self.evict()
+
+    def size(self):
+        page_size = self.db.execute("PRAGMA page_size").fetchone()[0]
+        page_count = self.db.execute("PRAGMA page_count").fetchone()[0]
+        free_count = self.db.execute("PRAGMA freelist_count").fetchone()[0]
+        return (page_count - free_count) * page_size
+
+    def evict(self):
+        '''
+        Delete least recently used entries until the cache is within 90% of its size limit.
+        '''
+        size = self.size()
+        if size <= self.max_size:
+            return
+        count = self.db.execute("SELECT COUNT(*) FROM matchup").fetchone()[0]
+        if count == 0:
+            return
+        target = int(count * (1 - 0.9 * self.max_size / size)) + 1
+        self.db.execute(
+            "DELETE FROM matchup WHERE key IN (SELECT key FROM matchup ORDER BY last_used LIMIT ?)", (target,))
+        self.db.commit()
+
+    def clear(self):
+        self.db.execute("DELETE FROM matchup")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,160 @@
+'''
+This module provides damage multiplier tables: STAB, type effectiveness and weather boost of moves
+against every attacker and defender type pair, built once and looked up by the simulators.
+
+Multipliers only depend on the type of a move, so the table is a tensor indexed by
+move type x attacker type pair x defender type pair (and optionally weather);
+the tensor of a list of moves is a view of it by the type of each move.
+'''
+
+import numpy as np
+
+from .GameMaster import GameMaster, PoketypeList, InversedPoketypeList
+from .Tables import get_tables
+
+
+# Index used for "none" and unknown types
+NO_TYPE = len(PoketypeList)
+
+N_TYPES = NO_TYPE + 1
+
+# Index of the (unordered) pair of type indexes (t1, t2), pokeType2 being NO_TYPE for single-type Pokemon
+PAIR_INDEX = np.zeros((N_TYPES, N_TYPES), dtype=np.int64)
+TYPE_PAIRS = []
+for _t1 in range(N_TYPES):
+    for _t2 in range(_t1, N_TYPES):
+        PAIR_INDEX[_t1, _t2] = PAIR_INDEX[_t2, _t1] = len(TYPE_PAIRS)
+        TYPE_PAIRS.append((_t1, _t2))
+TYPE_PAIRS = np.array(TYPE_PAIRS, dtype=np.int64)
+N_PAIRS = len(TYPE_PAIRS)
+
+
+def type_index(poketype):
+    '''
+    Return the index of @param poketype in PoketypeList, or NO_TYPE for "none" and unknown types.
+    '''
+    return InversedPoketypeList.get(str(poketype).lower(), NO_TYPE)
+
+
+def pair_index(type1, type2):
+    '''
+    Return the index of the type pair of type indexes (arrays) @param type1 and @param type2.
+    '''
+    return PAIR_INDEX[type1, type2]
+
+
+def effectiveness_table(game_master_json):
+    '''
+    Build the attack-type by defend-type effectiveness table from the "TypeEffectiveness" field.
+
+    @param game_master_json dict-like GoBattleSim configuration
+    @return array of shape (len(PoketypeList), len(PoketypeList) + 1); the last column is the "none" type
+    '''
+    table = np.ones((len(PoketypeList), NO_TYPE + 1))
+    for atk_type, row in game_master_json.get("TypeEffectiveness", {}).items():
+        i = type_index(atk_type)
+        if i == NO_TYPE:
+            continue
+        for def_type, multiplier in row.items():
+            j = type_index(def_type)
+            if j != NO_TYPE:
+                table[i, j] = multiplier
+    return table
+
+
+class DamageTable:
+    '''
+    Damage multipliers of a GoBattleSim configuration by move type, attacker type pair and defender type pair:
+
+        stab[move type, attacker pair] * effectiveness[move type, defender pair] * weather[weather, move type]
+
+    Typeless moves (NO_TYPE) have a multiplier of 1.
+    '''
+
+    def __init__(self, game_master_json, stab=None):
+        '''
+        @param game_master_json dict-like GoBattleSim configuration
+        @param stab same type attack bonus. Default to the PvP one of the configuration
+        '''
+        if stab is None:
+            stab = game_master_json.get("PvPBattleSettings", {}).get("sameTypeAttackBonusMultiplier", 1.2)
+        eff = effectiveness_table(game_master_json)
+        move_types = np.arange(NO_TYPE)[:, None]
+        t1, t2 = TYPE_PAIRS[:, 0], TYPE_PAIRS[:, 1]
+
+        self.stab = np.ones((N_TYPES, N_PAIRS))
+        self.stab[:NO_TYPE] = np.where((move_types == t1) | (move_types == t2), stab, 1.0)
+        self.effectiveness = np.ones((N_TYPES, N_PAIRS))
+        self.effectiveness[:NO_TYPE] = eff[move_types, t1] * eff[move_types, t2]
+
+        pve = game_master_json.get("PvEBattleSettings", {})
+        weather_settings = game_master_json.get("WeatherSettings", {})
+        # In the order of GameMaster.search_weather()
+        self.weathers = sorted(weather_settings.keys())
+        self.weather = np.ones((len(self.weathers), N_TYPES))
+        for w, name in enumerate(self.weathers):
+            for poketype in weather_settings[name]:
+                if type_index(poketype) != NO_TYPE:
+                    self.weather[w, type_index(poketype)] = pve.get("weatherAttackBonusMultiplier", 1.2)
+        self._tensor = None
+
+    def tensor(self, weather=None):
+        '''
+        Return the multipliers of all move types against all type pairs, as array of shape
+        (move types, attacker pairs, defender pairs), in weather index @param weather if set.
+        '''
+        if self._tensor is None:
+            self._tensor = self.stab[:, :, None] * self.effectiveness[:, None, :]
+        if weather is None:
+            return self._tensor
+        return self._tensor * self.weather[weather][:, None, None]
+
+    def move_tensor(self, move_types, weather=None):
+        '''
+        Return the multipliers of moves of type indexes @param move_types (array of shape (n,)),
+        as array of shape (n, attacker pairs, defender pairs).
+        '''
+        return self.tensor(weather)[np.asarray(move_types)]
+
+    def lookup(self, move_type, atk_pair, def_pair, weather=None):
+        '''
+        Return the multipliers of moves of type index @param move_type from attackers of type pair @param atk_pair
+        against defenders of type pair @param def_pair (broadcast arrays), in weather index @param weather if set.
+        '''
+        mult = self.stab[move_type, atk_pair] * self.effectiveness[move_type, def_pair]
+        if weather is not None:
+            mult = mult * self.weather[weather, move_type]
+        return mult
+
+
+def damage(power, attack, defense, multiplier):
+    '''
+    Return the damage of a hit: floor(0.5 * power * attack / defense * multiplier) + 1.
+    '''
+    return np.floor(0.5 * power * attack / defense * multiplier) + 1
+
+
+def get_damage_table(game_master=None, pve=False):
+    '''
+    Return the DamageTable of @param game_master (default to the current one), with the PvE (@param pve = True)
+    or PvP same type attack bonus. It is built once, and built again whenever the GameMaster rebuilds its indexes.
+    '''
+    if game_master is None:
+        game_master = GameMaster.CurrentInstance
+    if pve:
+        return game_master.derived("damage_pve", lambda gm: DamageTable(
+            gm.to_json(), gm.PvEBattleSettings.get("sameTypeAttackBonusMultiplier", 1.2)))
+    return game_master.derived("damage_pvp", lambda gm: DamageTable(gm.to_json()))
+
+
+def move_damage_tensor(game_master=None, pvp=True, weather=None):
+    '''
+    Return the multipliers of every PvP (@param pvp = True) or PvE move of @param game_master,
+    as array of shape (moves, attacker pairs, defender pairs). Moves are indexed by their row in
+    Tables.get_tables(game_master), which is their position in GameMaster.PvPMoves (or PvEMoves).
+    '''
+    if game_master is None:
+        game_master = GameMaster.CurrentInstance
+    table = get_damage_table(game_master, pve=not pvp)
+    moves = get_tables(game_master).pvp_moves if pvp else get_tables(game_master).pve_moves
+    return table.move_tensor(np.where(moves.type < 0, NO_TYPE, moves.type), weather)
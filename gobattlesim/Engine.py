@@ -10,55 +10,207 @@ import os
 import platform
 import sys
 
-if platform.system() == "Windows":
-    lib = CDLL(os.path.join(os.path.dirname(__file__), "libGoBattleSim.dll"))
+import numpy as np
+
+from .Cache import NonBattleConfigFields, digest
+from . import Profile
+from .GameMaster import GameMaster
+from .VectorEngine import SHIELD_SCENARIOS, VectorGBS
+
+try:
+    if platform.system() == "Windows":
+        lib = CDLL(os.path.join(os.path.dirname(__file__), "libGoBattleSim.dll"))
+    else:
+        lib = CDLL(os.path.join(os.path.dirname(__file__), "libGoBattleSim.so"))
+except OSError:
+    # No native library for this platform; fall back to the NumPy engine
+    lib = None
+
+
+if lib is not None:
+
+    class NativeGBS:
+
+        # Simulation input crosses into the library as json bytes, so pre-encoded input saves work
+        encoded_input = True
+
+        lib.GBS_version.argtypes = []
+        lib.GBS_version.restype = c_char_p
+        @staticmethod
+        def version():
+            return lib.GBS_version().decode()
+
+        lib.GBS_error.argtypes = []
+        lib.GBS_error.restype = c_char_p
+        @staticmethod
+        def error():
+            return lib.GBS_error().decode()
+
+        lib.GBS_config.argtypes = [c_char_p]
+        lib.GBS_config.restype = c_char_p
+        @staticmethod
+        def config(game_master=None):
+            if game_master is not None:
+                g_str = json.dumps(game_master)
+                lib.GBS_config(g_str.encode())
+            g_str = lib.GBS_config(None).decode()
+            return json.loads(g_str)
+
+        lib.GBS_prepare.argtypes = [c_char_p]
+        lib.GBS_prepare.restype = c_void_p
+        @staticmethod
+        def prepare(sim_input):
+            lib.GBS_prepare(json.dumps(sim_input).encode())
+
+        @staticmethod
+        def prepare_encoded(in_bytes):
+            lib.GBS_prepare(in_bytes)
+
+        lib.GBS_run.argtypes = []
+        lib.GBS_run.restype = c_void_p
+        @staticmethod
+        def run():
+            lib.GBS_run()
+
+        lib.GBS_collect.argtypes = []
+        lib.GBS_collect.restype = c_char_p
+        @staticmethod
+        def collect():
+            # json accepts the UTF-8 bytes as is, saving a decoded copy of the output
+            return json.loads(lib.GBS_collect())
+
+
+    GBS = NativeGBS
 else:
-    lib = CDLL(os.path.join(os.path.dirname(__file__), "libGoBattleSim.so"))
+    GBS = VectorGBS
 
 
-class GBS:
+def engine_config(game_master_json):
+    '''
+    Return the part of a GoBattleSim configuration the engine needs:
+    types, battle settings, cp multipliers and so on, but not the Pokemon and move tables.
+    '''
+    return {k: v for k, v in game_master_json.items() if k not in NonBattleConfigFields}
 
-    lib.GBS_version.argtypes = []
-    lib.GBS_version.restype = c_char_p
-    @staticmethod
-    def version():
-        return lib.GBS_version().decode()
 
-    lib.GBS_error.argtypes = []
-    lib.GBS_error.restype = c_char_p
-    @staticmethod
-    def error():
-        return lib.GBS_error().decode()
+class EngineSession:
+    '''
+    Access to an engine that skips redundant work across runs:
+    configuration is pushed only when it changes, and encoded Pokemon lists are reused.
+    '''
 
-    lib.GBS_config.argtypes = [c_char_p]
-    lib.GBS_config.restype = c_char_p
-    @staticmethod
-    def config(game_master=None):
-        if game_master is not None:
-            g_str = json.dumps(game_master)
-            lib.GBS_config(g_str.encode())
-        g_str = lib.GBS_config(None).decode()
-        return json.loads(g_str)
-
-    lib.GBS_prepare.argtypes = [c_char_p]
-    lib.GBS_prepare.restype = c_void_p
-    @staticmethod
-    def prepare(sim_input):
-        in_str = json.dumps(sim_input)
-        lib.GBS_prepare(in_str.encode())
+    def __init__(self, engine=None):
+        self.engine = GBS if engine is None else engine
+        self.config_key = None
+        # (Pokemon list, its length, encoded bytes) of recently encoded lists
+        self._encoded_lists = []
 
-    lib.GBS_run.argtypes = []
-    lib.GBS_run.restype = c_void_p
-    @staticmethod
-    def run():
-        lib.GBS_run()
+    def configure(self, config):
+        '''
+        Push the engine part of @param config (a GameMaster or its json) to the engine, unless it is already there.
+        @return True if the configuration was pushed
+        '''
+        if isinstance(config, GameMaster):
+            config = config.to_json()
+        config = engine_config(config)
+        key = digest(config)
+        if key == self.config_key:
+            return False
+        with Profile.stage("engine.config"):
+            self.engine.config(config)
+        self.config_key = key
+        return True
+
+    def run(self, sim_input):
+        '''
+        Run simulation input @param sim_input (dict, or json bytes from encode) and return the simulation output.
+        '''
+        Profile.count("engine.runs")
+        with Profile.stage("engine.prepare"):
+            if isinstance(sim_input, (bytes, bytearray)):
+                self.engine.prepare_encoded(sim_input)
+            else:
+                self.engine.prepare(sim_input)
+        with Profile.stage("engine.run"):
+            self.engine.run()
+        with Profile.stage("engine.collect"):
+            return self.engine.collect()
 
-    lib.GBS_collect.argtypes = []
-    lib.GBS_collect.restype = c_char_p
     @staticmethod
-    def collect():
-        out_str = lib.GBS_collect().decode()
-        return json.loads(out_str)
+    @Profile.profiled("engine.encode")
+    def encode(sim_input):
+        return json.dumps(sim_input).encode()
+
+    def _encode_list(self, pkm_list):
+        for encoded_list, size, encoded in self._encoded_lists:
+            if encoded_list is pkm_list and size == len(pkm_list):
+                return encoded
+        encoded = self.encode(pkm_list)
+        self._encoded_lists = [(pkm_list, len(pkm_list), encoded)] + self._encoded_lists[:1]
+        return encoded
+
+    def run_matrix(self, row_pkm, col_pkm=[], shield=0):
+        '''
+        Run the Battle Matrix of battle-ready Pokemon.
+        For engines that take encoded input, a Pokemon list passed again (such as the col Pokemon of
+        successive row blocks) is not encoded again; lists must not be modified in between.
+
+        @return matrix as 2D list
+        '''
+        if not getattr(self.engine, "encoded_input", False):
+            return self.run({
+                "battleMode": "battlematrix",
+                "rowPokemon": row_pkm,
+                "colPokemon": col_pkm,
+                "avergeByShield": shield != 0
+            })
+        return self.run(b"".join([
+            b'{"battleMode": "battlematrix", "rowPokemon": ', self._encode_list(row_pkm),
+            b', "colPokemon": ', self._encode_list(col_pkm),
+            b', "avergeByShield": ', b"true" if shield != 0 else b"false", b"}"
+        ]))
+
+    def run_shield_tensor(self, row_pkm, col_pkm=[]):
+        '''
+        Run the Battle Matrix of battle-ready Pokemon in every shield scenario.
+        Engines that support it simulate all scenarios in one run; otherwise each scenario is one run,
+        with the shields of all Pokemon set to it.
+
+        @return array of shape (rows, cols, row shields, col shields), over SHIELD_SCENARIOS
+        '''
+        col_pkm = col_pkm or row_pkm
+        if getattr(self.engine, "shield_tensor_output", False):
+            tensor = self.run({
+                "battleMode": "battlematrix",
+                "rowPokemon": row_pkm,
+                "colPokemon": col_pkm,
+                "shieldTensor": True
+            })
+            return np.asarray(tensor, dtype=np.float64).reshape(
+                len(row_pkm), len(col_pkm), len(SHIELD_SCENARIOS), len(SHIELD_SCENARIOS))
+
+        n = len(SHIELD_SCENARIOS)
+        tensor = np.empty((len(row_pkm), len(col_pkm), n, n))
+        col_lists = [[dict(pkm, num_shields=shields) for pkm in col_pkm] for shields in SHIELD_SCENARIOS]
+        for a, row_shields in enumerate(SHIELD_SCENARIOS):
+            rows = [dict(pkm, num_shields=row_shields) for pkm in row_pkm]
+            for b, cols in enumerate(col_lists):
+                tensor[:, :, a, b] = np.asarray(self.run_matrix(rows, cols, 0), dtype=np.float64).reshape(
+                    len(row_pkm), len(col_pkm))
+        return tensor
+
+
+_default_session = None
+
+
+def default_session():
+    '''
+    Return the session shared by the tools of this package over GBS.
+    '''
+    global _default_session
+    if _default_session is None:
+        _default_session = EngineSession()
+    return _default_session
 
 
 def print_version():
@@ -76,7 +228,9 @@ def main():
                         help="print configuration, or (with argument) set configuration by path")
     parser.add_argument("-o", "--out", type=argparse.FileType('w'), default=sys.stdout,
                         help="file to save simulation output")
+    Profile.add_argument(parser)
     args = parser.parse_args()
+    Profile.start(args.profile)
 
     if args.version:
         print_version()
@@ -92,16 +246,14 @@ def main():
 
     config_path = args.config or "./GBS.json"
     if os.path.isfile(config_path):
-        with open(config_path) as fd:
+        with open(config_path) as fd, Profile.stage("engine.config"):
             j = json.load(fd)
             GBS.config(j)
 
-    with open(args.sim_input) as fd:
+    with open(args.sim_input) as fd, Profile.stage("engine.load_input"):
         j = json.load(fd)
     try:
-        GBS.prepare(j)
-        GBS.run()
-        sim_output = GBS.collect()
+        sim_output = default_session().run(j)
     except Exception as e:
         gbs_error = GBS.error()
         if gbs_error:
@@ -110,7 +262,8 @@ def main():
             print(str(e))
         return -1
 
-    json.dump(sim_output, args.out, indent=4)
+    with Profile.stage("engine.save_output"):
+        json.dump(sim_output, args.out, indent=4)
 
 
 if __name__ == "__main__":
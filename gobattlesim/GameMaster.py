@@ -5,10 +5,18 @@ This module provides game master file parsing (into GoBattleSim compatible forma
 
 import argparse
 import copy
+import hashlib
 import json
+import marshal
+import os
 import re
 import sys
 
+import numpy as np
+
+from .Cache import cache_dir
+from . import Profile
+
 
 PoketypeList = ["normal", "fighting", "flying", "poison", "ground", "rock", "bug", "ghost",
                 "steel", "fire", "water", "grass", "electric", "psychic", "ice", "dragon", "dark", "fairy"]
@@ -16,6 +24,9 @@ PoketypeList = ["normal", "fighting", "flying", "poison", "ground", "rock", "bug
 InversedPoketypeList = dict([(name, i)
                              for i, name in enumerate(PoketypeList)])
 
+# Bump when the parsed data layout changes, to invalidate existing snapshots
+SNAPSHOT_VERSION = 1
+
 
 def rm_underscores(Str, Category):
     if Category == 'p':
@@ -28,6 +39,172 @@ def rm_underscores(Str, Category):
         return Str.split('_')[-1].lower()
 
 
+# Item templates used, by exact templateId
+_TEMPLATE_IDS = {
+    "PLAYER_LEVEL_SETTINGS": "cpm",
+    "BATTLE_SETTINGS": "pve_settings",
+    "COMBAT_SETTINGS": "pvp_settings",
+    "COMBAT_STAT_STAGE_SETTINGS": "pvp_stage_settings",
+    "WEATHER_BONUS_SETTINGS": "weather_bonus"
+}
+
+# Item templates used, by templateId prefix (the part before the first "_", with "V<digits>" as "V")
+_TEMPLATE_PATTERNS = {
+    "V": [(re.compile(r'V\d+_POKEMON_.+'), "pokemon"), (re.compile(r'V\d+_MOVE_.+'), "pve_move")],
+    "COMBAT": [(re.compile(r'COMBAT_V\d+_MOVE_.+'), "pvp_move")],
+    "POKEMON": [(re.compile(r'POKEMON_TYPE_.+'), "type")],
+    "WEATHER": [(re.compile(r'WEATHER_AFFINITY_.+'), "weather")],
+    "FRIENDSHIP": [(re.compile(r'FRIENDSHIP_LEVEL_\d+'), "friendship")]
+}
+
+
+def template_kind(tid):
+    '''
+    Return the kind of game master item template @param tid (its templateId), or None if it is not used.
+    '''
+    kind = _TEMPLATE_IDS.get(tid)
+    if kind is not None:
+        return kind
+    prefix = tid.split('_', 1)[0]
+    if prefix[:1] == 'V' and prefix[1:].isdigit():
+        prefix = 'V'
+    for pattern, kind in _TEMPLATE_PATTERNS.get(prefix, ()):
+        if pattern.fullmatch(tid):
+            return kind
+    return None
+
+
+_JSON_DECODER = json.JSONDecoder()
+_ITEM_TEMPLATES_START = re.compile(r'"itemTemplates"\s*:\s*\[')
+# Separators, then the end of the list or the start of the next item template (with its templateId if first key)
+_NEXT_TEMPLATE = re.compile(r'[\s,]*(?:(\])|(\{)\s*(?:"templateId"\s*:\s*"([^"\\]*)")?)')
+# End of an item template followed by the start of another one (or the end of the list)
+_TEMPLATE_END = re.compile(r'\}(?=\s*(?:,\s*\{\s*"templateId"\s*:|\]))')
+
+
+class _IncompleteTemplate(Exception):
+    pass
+
+
+def _skip_template(buf, pos):
+    '''
+    Return the end of the item template at @param pos of @param buf, without decoding it.
+    '''
+    match = _TEMPLATE_END.search(buf, pos)
+    if match is not None:
+        end = match.end()
+        # The candidate end must close the template: nested objects or strings may look alike
+        if buf.count('{', pos, end) == buf.count('}', pos, end) and \
+                buf.count('[', pos, end) == buf.count(']', pos, end):
+            return end
+    try:
+        return _JSON_DECODER.raw_decode(buf, pos)[1]
+    except json.JSONDecodeError:
+        raise _IncompleteTemplate()
+
+
+def iter_item_templates(fd, select, chunk_size=1 << 20):
+    '''
+    Read the item templates of a game master json file one at a time.
+
+    Both layouts are supported: {"itemTemplates": [{"templateId": ..., ...}, ...]}
+    and [{"templateId": ..., "data": {"templateId": ..., ...}}, ...].
+    Templates that @param select does not want are skipped without being decoded, when possible.
+
+    @param fd text file object of the game master
+    @param select function of templateId, returning a truthy tag for templates to decode
+    @return generator of (tag, templateId, template)
+    '''
+    buf = ""
+    eof = False
+    pos = 0
+
+    def read_more(buf, pos):
+        nonlocal eof
+        chunk = fd.read(chunk_size)
+        eof = not chunk
+        return buf[pos:] + chunk
+
+    # Find the list of item templates
+    while True:
+        head = buf.lstrip()
+        if head[:1] == '[':
+            pos, wrapped = len(buf) - len(head) + 1, True
+            break
+        match = _ITEM_TEMPLATES_START.search(buf)
+        if match is not None:
+            pos, wrapped = match.end(), False
+            break
+        if eof:
+            raise ValueError("no item templates in game master")
+        buf = read_more(buf, 0)
+
+    while True:
+        match = _NEXT_TEMPLATE.match(buf, pos)
+        # Make sure the match did not stop at the end of the buffer
+        if (match is None or match.end() >= len(buf) - 256) and not eof:
+            buf, pos = read_more(buf, pos), 0
+            continue
+        if match is None:
+            raise ValueError("bad item template at {}".format(buf[pos:pos + 80]))
+        if match.group(1) is not None:
+            return
+        start, tid = match.start(2), match.group(3)
+        try:
+            tag = None
+            if tid is not None:
+                tag = select(tid)
+                if not tag:
+                    pos = _skip_template(buf, start)
+                    continue
+            try:
+                template, pos = _JSON_DECODER.raw_decode(buf, start)
+            except json.JSONDecodeError:
+                raise _IncompleteTemplate()
+        except _IncompleteTemplate:
+            if eof:
+                raise ValueError("truncated game master")
+            buf, pos = read_more(buf, start), 0
+            continue
+        if tag is None:
+            tid = template["templateId"]
+            tag = select(tid)
+        if tag:
+            yield tag, tid, template.get("data", template) if wrapped else template
+
+
+class _EntityIndex:
+    '''
+    Hash indexes of a list of Pokemon or moves, by normalized name and by dex.
+    '''
+
+    def __init__(self, entities):
+        self.entities = entities
+        self.by_name = {}
+        self.by_dex = {}
+        # Other indexes built on demand over the same entities, such as PokeQuery bitsets
+        self.cache = {}
+        for entity in entities:
+            name = entity['name'].strip().lower()
+            self.by_name.setdefault(name, []).append(entity)
+            if 'dex' in entity:
+                self.by_dex.setdefault(entity['dex'], []).append(entity)
+
+    def search(self, criteria, _all):
+        if isinstance(criteria, str):
+            matches = self.by_name.get(criteria.strip().lower(), [])
+        elif isinstance(criteria, int):
+            matches = self.by_dex.get(criteria, [])
+        elif hasattr(criteria, "select"):
+            # Criteria that evaluate over all entities at once, such as a compiled PokeQuery
+            matches = criteria.select(self)
+        else:
+            return GameMaster._search(self.entities, criteria, _all)
+        if _all:
+            return list(matches)
+        return matches[0] if matches else None
+
+
 class GameMaster:
     '''
     The class parses the official Game Master json and organize the data.
@@ -62,6 +239,10 @@ class GameMaster:
                 "maxHP": 18750, "timelimit": 3000000}
         ]
 
+        self._indexes = None
+        self._indexes_key = None
+        self._derived = {}
+
         if file is not None:
             self.parse(file)
 
@@ -72,135 +253,201 @@ class GameMaster:
         self.__init__()
         return self
 
-    def parse(self, file):
+    @Profile.profiled("gamemaster.parse")
+    def parse(self, file, snapshot=False):
         '''
         Load and process a game master json file @param file.
         @param path to game master json.
+        @param snapshot if True, load from the binary snapshot of @param file if it is up to date
+            (same size and mtime), otherwise parse and save a new snapshot.
+            If "hash", the content hash of @param file must match too
         '''
+        if snapshot:
+            return self._load_with_snapshot(file, "game_master", self.parse, snapshot == "hash")
+
+        handlers = {
+            "pokemon": self._parse_pokemon,
+            "pve_move": self._parse_pve_move,
+            "pvp_move": self._parse_pvp_move,
+            "cpm": self._parse_cpm,
+            "type": self._parse_type,
+            "pve_settings": self._parse_pve_settings,
+            "pvp_settings": self._parse_pvp_settings,
+            "pvp_stage_settings": self._parse_pvp_stage_settings,
+            "weather": self._parse_weather,
+            "weather_bonus": self._parse_weather_bonus,
+            "friendship": self._parse_friendship
+        }
         with open(file) as fd:
-            gmdata = json.load(fd)
-
-        for template in gmdata["itemTemplates"]:
-            tid = template['templateId']
-
-            # Match Pokemon
-            if re.fullmatch(r'V\d+_POKEMON_.+', tid):
-                pokemon = {}
-                pkmInfo = template["pokemonSettings"]
-                pokemon['dex'] = int(tid.split('_')[0][1:])
-                pokemon['name'] = rm_underscores(tid, 'p')
-                pokemon['pokeType1'] = rm_underscores(
-                    pkmInfo['type'], 't')
-                pokemon['pokeType2'] = rm_underscores(
-                    pkmInfo.get('type2', 'none'), 't')
-                pokemon['baseAtk'] = pkmInfo["stats"]["baseAttack"]
-                pokemon['baseDef'] = pkmInfo["stats"]["baseDefense"]
-                pokemon['baseStm'] = pkmInfo["stats"]["baseStamina"]
-                pokemon['fastMoves'] = [rm_underscores(
-                    s, "fast") for s in pkmInfo.get('quickMoves', [])]
-                pokemon['chargedMoves'] = [rm_underscores(
-                    s, "charged") for s in pkmInfo.get('cinematicMoves', '')]
-                evolution = [s.lower()
-                             for s in pkmInfo.get('evolutionIds', [])]
-                if any(evolution):
-                    pokemon['evolution'] = evolution
-                if 'rarity' in pkmInfo:
-                    pokemon['rarity'] = pkmInfo['rarity']
-
-                self.Pokemon.append(pokemon)
-
-            # Match move, either Fast or Charged
-            elif re.fullmatch(r'V\d+_MOVE_.+', tid):
-                moveInfo = template['moveSettings']
-                move = {}
-                move['movetype'] = "fast" if tid.endswith(
-                    '_FAST') else "charged"
-                move['name'] = rm_underscores(
-                    moveInfo["movementId"], move['movetype'])
-                move['pokeType'] = rm_underscores(moveInfo["pokemonType"], 't')
-                move['power'] = int(moveInfo.get("power", 0))
-                move['duration'] = int(moveInfo["durationMs"])
-                move['dws'] = int(moveInfo["damageWindowStartMs"])
-                move['energy'] = int(moveInfo.get("energyDelta", 0))
-
-                self.PvEMoves.append(move)
-
-            # Match PvP Moves
-            elif re.fullmatch(r'COMBAT_V\d+_MOVE_.+', tid):
-                moveInfo = template['combatMove']
-                move = {}
-                move['movetype'] = "fast" if tid.endswith(
-                    '_FAST') else "charged"
-                move['name'] = rm_underscores(
-                    moveInfo["uniqueId"], move['movetype'])
-                move['pokeType'] = rm_underscores(moveInfo["type"], 't')
-                move['power'] = int(moveInfo.get("power", 0))
-                move['duration'] = int(moveInfo.get('durationTurns', 0)) + 1
-                move['energy'] = int(moveInfo.get("energyDelta", 0))
-                if "buffs" in moveInfo:
-                    move['effect'] = {
-                        "activation_chance": moveInfo["buffs"]["buffActivationChance"],
-                        "self_attack_stage_delta": moveInfo["buffs"].get("attackerAttackStatStageChange", 0),
-                        "self_defense_stage_delta": moveInfo["buffs"].get("attackerDefenseStatStageChange", 0),
-                        "target_attack_stage_delta": moveInfo["buffs"].get("targetAttackStatStageChange", 0),
-                        "target_defense_stage_delta": moveInfo["buffs"].get("targetDefenseStatStageChange", 0)
-                    }
-
-                self.PvPMoves.append(move)
-
-            # Match CPM's
-            elif tid == 'PLAYER_LEVEL_SETTINGS':
-                for cpm in template["playerLevel"]["cpMultiplier"]:
-                    if self.CPMultipliers:
-                        # Half level
-                        self.CPMultipliers.append(
-                            ((cpm**2 + self.CPMultipliers[-1]**2)/2)**0.5)
-                    self.CPMultipliers.append(cpm)
-
-            # Match Pokemon Types
-            elif re.fullmatch(r'POKEMON_TYPE_.+', tid):
-                pokemonType = rm_underscores(tid, 't')
-                self.TypeEffectiveness[pokemonType] = {}
-                for idx, mtp in enumerate(template["typeEffective"]["attackScalar"]):
-                    self.TypeEffectiveness[pokemonType][PoketypeList[idx]] = mtp
-
-            # Match PvE Battle settings
-            elif tid == 'BATTLE_SETTINGS':
-                self.PvEBattleSettings = template["battleSettings"]
-
-            # Match PvP Battle settings
-            elif tid == 'COMBAT_SETTINGS':
-                for name, value in template["combatSettings"].items():
-                    self.PvPBattleSettings[name] = value
-
-            # Match PvP Battle settings for buff stats
-            elif tid == 'COMBAT_STAT_STAGE_SETTINGS':
-                for name, value in template["combatStatStageSettings"].items():
-                    self.PvPBattleSettings[name] = value
-
-            # Match weather settings
-            elif re.fullmatch(r'WEATHER_AFFINITY_.+', tid):
-                wname = template["weatherAffinities"]["weatherCondition"]
-                if wname == 'OVERCAST':
-                    wname = 'CLOUDY'
-                self.WeatherSettings[wname] = [rm_underscores(
-                    s, 't') for s in template["weatherAffinities"]["pokemonType"]]
-            elif tid == 'WEATHER_BONUS_SETTINGS':
-                self.PvEBattleSettings['weatherAttackBonusMultiplier'] = template["weatherBonusSettings"]["attackBonusMultiplier"]
-
-            # Match friend settings
-            elif re.fullmatch(r'FRIENDSHIP_LEVEL_\d+', tid):
-                multiplier = template["friendshipMilestoneSettings"]["attackBonusPercentage"]
-                self.FriendAttackBonusMultipliers.append(
-                    {"name": tid, "multiplier": multiplier})
+            for kind, tid, template in iter_item_templates(fd, template_kind):
+                handlers[kind](tid, template)
 
         self.FriendAttackBonusMultipliers.sort(key=lambda x: x["multiplier"])
+        self.reindex()
+        return self
+
+    def _parse_pokemon(self, tid, template):
+        pokemon = {}
+        pkmInfo = template["pokemonSettings"]
+        pokemon['dex'] = int(tid.split('_')[0][1:])
+        pokemon['name'] = rm_underscores(tid, 'p')
+        pokemon['pokeType1'] = rm_underscores(
+            pkmInfo['type'], 't')
+        pokemon['pokeType2'] = rm_underscores(
+            pkmInfo.get('type2', 'none'), 't')
+        pokemon['baseAtk'] = pkmInfo["stats"]["baseAttack"]
+        pokemon['baseDef'] = pkmInfo["stats"]["baseDefense"]
+        pokemon['baseStm'] = pkmInfo["stats"]["baseStamina"]
+        pokemon['fastMoves'] = [rm_underscores(
+            s, "fast") for s in pkmInfo.get('quickMoves', [])]
+        pokemon['chargedMoves'] = [rm_underscores(
+            s, "charged") for s in pkmInfo.get('cinematicMoves', '')]
+        evolution = [s.lower()
+                     for s in pkmInfo.get('evolutionIds', [])]
+        if any(evolution):
+            pokemon['evolution'] = evolution
+        if 'rarity' in pkmInfo:
+            pokemon['rarity'] = pkmInfo['rarity']
+
+        self.Pokemon.append(pokemon)
+
+    def _parse_pve_move(self, tid, template):
+        moveInfo = template['moveSettings']
+        move = {}
+        move['movetype'] = "fast" if tid.endswith(
+            '_FAST') else "charged"
+        move['name'] = rm_underscores(
+            moveInfo["movementId"], move['movetype'])
+        move['pokeType'] = rm_underscores(moveInfo["pokemonType"], 't')
+        move['power'] = int(moveInfo.get("power", 0))
+        move['duration'] = int(moveInfo["durationMs"])
+        move['dws'] = int(moveInfo["damageWindowStartMs"])
+        move['energy'] = int(moveInfo.get("energyDelta", 0))
+
+        self.PvEMoves.append(move)
+
+    def _parse_pvp_move(self, tid, template):
+        moveInfo = template['combatMove']
+        move = {}
+        move['movetype'] = "fast" if tid.endswith(
+            '_FAST') else "charged"
+        move['name'] = rm_underscores(
+            moveInfo["uniqueId"], move['movetype'])
+        move['pokeType'] = rm_underscores(moveInfo["type"], 't')
+        move['power'] = int(moveInfo.get("power", 0))
+        move['duration'] = int(moveInfo.get('durationTurns', 0)) + 1
+        move['energy'] = int(moveInfo.get("energyDelta", 0))
+        if "buffs" in moveInfo:
+            move['effect'] = {
+                "activation_chance": moveInfo["buffs"]["buffActivationChance"],
+                "self_attack_stage_delta": moveInfo["buffs"].get("attackerAttackStatStageChange", 0),
+                "self_defense_stage_delta": moveInfo["buffs"].get("attackerDefenseStatStageChange", 0),
+                "target_attack_stage_delta": moveInfo["buffs"].get("targetAttackStatStageChange", 0),
+                "target_defense_stage_delta": moveInfo["buffs"].get("targetDefenseStatStageChange", 0)
+            }
+
+        self.PvPMoves.append(move)
+
+    def _parse_cpm(self, tid, template):
+        for cpm in template["playerLevel"]["cpMultiplier"]:
+            if self.CPMultipliers:
+                # Half level
+                self.CPMultipliers.append(
+                    ((cpm**2 + self.CPMultipliers[-1]**2)/2)**0.5)
+            self.CPMultipliers.append(cpm)
+
+    def _parse_type(self, tid, template):
+        pokemonType = rm_underscores(tid, 't')
+        self.TypeEffectiveness[pokemonType] = {}
+        for idx, mtp in enumerate(template["typeEffective"]["attackScalar"]):
+            self.TypeEffectiveness[pokemonType][PoketypeList[idx]] = mtp
+
+    def _parse_pve_settings(self, tid, template):
+        self.PvEBattleSettings = template["battleSettings"]
+
+    def _parse_pvp_settings(self, tid, template):
+        for name, value in template["combatSettings"].items():
+            self.PvPBattleSettings[name] = value
+
+    def _parse_pvp_stage_settings(self, tid, template):
+        for name, value in template["combatStatStageSettings"].items():
+            self.PvPBattleSettings[name] = value
+
+    def _parse_weather(self, tid, template):
+        wname = template["weatherAffinities"]["weatherCondition"]
+        if wname == 'OVERCAST':
+            wname = 'CLOUDY'
+        self.WeatherSettings[wname] = [rm_underscores(
+            s, 't') for s in template["weatherAffinities"]["pokemonType"]]
+
+    def _parse_weather_bonus(self, tid, template):
+        self.PvEBattleSettings['weatherAttackBonusMultiplier'] = template["weatherBonusSettings"]["attackBonusMultiplier"]
+
+    def _parse_friendship(self, tid, template):
+        multiplier = template["friendshipMilestoneSettings"]["attackBonusPercentage"]
+        self.FriendAttackBonusMultipliers.append(
+            {"name": tid, "multiplier": multiplier})
+
+    @Profile.profiled("gamemaster.load_config")
+    def load_config(self, file, snapshot=True):
+        '''
+        Load a GoBattleSim configuration json (as produced by to_json()) from @param file.
+        @param snapshot if True, load from the binary snapshot of @param file if it is up to date
+            (same size and mtime), otherwise read the json and save a new snapshot.
+            If "hash", the content hash of @param file must match too
+        '''
+        if snapshot:
+            return self._load_with_snapshot(file, "config", self.load_config, snapshot == "hash")
+        with open(file, encoding="utf8") as fd:
+            self.from_json(json.load(fd))
+        return self
+
+    @staticmethod
+    def snapshot_path(file, kind):
+        '''
+        Return the path of the binary snapshot of source @param file, loaded as @param kind.
+        '''
+        key = "{}:{}".format(kind, os.path.abspath(file))
+        return os.path.join(cache_dir(), "snapshots", hashlib.sha1(key.encode()).hexdigest() + ".bin")
+
+    def _load_with_snapshot(self, file, kind, load, check_hash=False):
+        stat = os.stat(file)
+        header = [SNAPSHOT_VERSION, sys.version, kind,
+                  os.path.abspath(file), stat.st_size, stat.st_mtime_ns]
+        if check_hash:
+            with open(file, "rb") as fd:
+                header.append(hashlib.sha1(fd.read()).hexdigest())
+        try:
+            path = GameMaster.snapshot_path(file, kind)
+            with open(path, "rb") as fd:
+                snapshot_header, data = marshal.loads(fd.read())
+            if snapshot_header == header:
+                self.from_json(data)
+                return self
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+
+        load(file, snapshot=False)
+        # Write to a temporary file first so that concurrent readers never see a partial snapshot
+        tmp_path = None
+        try:
+            path = GameMaster.snapshot_path(file, kind)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = "{}.{}.tmp".format(path, os.getpid())
+            with open(tmp_path, "wb") as fd:
+                fd.write(marshal.dumps((header, self.to_json())))
+            os.replace(tmp_path, path)
+        except OSError:
+            # Snapshots only save parsing time; without a usable cache directory, keep the parsed data
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return self
 
     def to_json(self):
         '''
         Export this instance in json.
         '''
-        return self.__dict__
+        return {name: value for name, value in self.__dict__.items() if not name.startswith('_')}
 
     def from_json(self, source):
         '''
@@ -208,8 +455,49 @@ class GameMaster:
         @param source a dict-like object
         '''
         for name, value in source.items():
-            if name in self.__dict__:
+            if name in self.__dict__ and not name.startswith('_'):
                 self.__dict__[name] = value
+        self.reindex()
+
+    def reindex(self):
+        '''
+        Rebuild the lookup indexes of Pokemon and moves.
+        Indexes are rebuilt automatically when the lists are replaced or resized;
+        call this after modifying entries in place.
+        '''
+        def by_movetype(moves, movetype):
+            return [move for move in moves if move.get('movetype') == movetype]
+
+        self._indexes = {
+            "pokemon": _EntityIndex(self.Pokemon),
+            "pve_fast": _EntityIndex(by_movetype(self.PvEMoves, "fast")),
+            "pve_charged": _EntityIndex(by_movetype(self.PvEMoves, "charged")),
+            "pvp_fast": _EntityIndex(by_movetype(self.PvPMoves, "fast")),
+            "pvp_charged": _EntityIndex(by_movetype(self.PvPMoves, "charged")),
+            "pve": _EntityIndex(self.PvEMoves),
+            "pvp": _EntityIndex(self.PvPMoves),
+        }
+        self._indexes_key = self._data_key()
+        self._derived = {}
+
+    def _data_key(self):
+        return tuple((id(data), len(data)) for data in (self.Pokemon, self.PvEMoves, self.PvPMoves))
+
+    def _index(self, kind):
+        if self._indexes is None or self._indexes_key != self._data_key():
+            self.reindex()
+        return self._indexes[kind]
+
+    def derived(self, name, build):
+        '''
+        Return data @param name derived from this instance by @param build(self), such as columnar tables.
+        It is built on first use, and built again whenever the indexes are rebuilt.
+        '''
+        if self._indexes is None or self._indexes_key != self._data_key():
+            self.reindex()
+        if name not in self._derived:
+            self._derived[name] = build(self)
+        return self._derived[name]
 
     def apply(self):
         '''
@@ -241,19 +529,25 @@ class GameMaster:
             return None
 
     def search_pokemon(self, criteria, _all=False):
-        return GameMaster._search(self.Pokemon, criteria, _all)
+        return self._index("pokemon").search(criteria, _all)
+
+    def search_pve_move(self, criteria, _all=False):
+        return self._index("pve").search(criteria, _all)
 
     def search_pve_fmove(self, criteria, _all=False):
-        return GameMaster._search(filter(lambda x: x.get('movetype') == "fast", self.PvEMoves), criteria, _all)
+        return self._index("pve_fast").search(criteria, _all)
 
     def search_pve_cmove(self, criteria, _all=False):
-        return GameMaster._search(filter(lambda x: x.get('movetype') == "charged", self.PvEMoves), criteria, _all)
+        return self._index("pve_charged").search(criteria, _all)
+
+    def search_pvp_move(self, criteria, _all=False):
+        return self._index("pvp").search(criteria, _all)
 
     def search_pvp_fmove(self, criteria, _all=False):
-        return GameMaster._search(filter(lambda x: x.get('movetype') == "fast", self.PvPMoves), criteria, _all)
+        return self._index("pvp_fast").search(criteria, _all)
 
     def search_pvp_cmove(self, criteria, _all=False):
-        return GameMaster._search(filter(lambda x: x.get('movetype') == "charged", self.PvPMoves), criteria, _all)
+        return self._index("pvp_charged").search(criteria, _all)
 
     def search_cpm(self, level):
         idx = round(2 * float(level) - 2)
@@ -291,6 +585,200 @@ class GameMaster:
                 return rt
         return None
 
+    @staticmethod
+    def diff(old, new):
+        '''
+        Return the GameMasterDiff of the changes from GameMaster @param old to GameMaster @param new.
+        '''
+        return GameMasterDiff(old, new)
+
+
+# Fields of a species that the matchups of its Pokemon depend on
+MatchupSpeciesFields = ["pokeType1", "pokeType2", "baseAtk", "baseDef", "baseStm"]
+
+# Settings whose change affects every PvP matchup
+PvPSettingsFields = ["CPMultipliers", "PvPBattleSettings"]
+
+SettingsFields = ["CPMultipliers", "WeatherSettings", "FriendAttackBonusMultipliers",
+                  "PvEBattleSettings", "PvPBattleSettings", "RaidTierSettings"]
+
+
+def _diff_fields(old, new):
+    '''
+    Return {field: [old value, new value]} of the fields that differ between dicts (or lists) @param old and @param new.
+    Missing fields are None.
+    '''
+    if isinstance(old, list) and isinstance(new, list):
+        old, new = dict(enumerate(old)), dict(enumerate(new))
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return {} if old == new else {None: [old, new]}
+    changes = {}
+    for field in list(old) + [field for field in new if field not in old]:
+        if old.get(field) != new.get(field):
+            changes[field] = [old.get(field), new.get(field)]
+    return changes
+
+
+def _diff_entities(old, new, key):
+    '''
+    Diff two lists of Pokemon or moves, matching entities by @param key.
+    @return (added keys, removed keys, {key: {field: [old value, new value]}})
+    '''
+    old = {key(entity): entity for entity in old}
+    new = {key(entity): entity for entity in new}
+    added = [k for k in new if k not in old]
+    removed = [k for k in old if k not in new]
+    changed = {}
+    for k, entity in new.items():
+        if k in old and old[k] != entity:
+            changed[k] = _diff_fields(old[k], entity)
+    return added, removed, changed
+
+
+class GameMasterDiff:
+    '''
+    Differences between two GameMaster instances, and the PvP matchups they affect.
+
+    Pokemon are keyed by (name, dex) and moves by (name, movetype).
+    Each of "pokemon", "pve_moves" and "pvp_moves" is a dict with fields
+    "added" and "removed" (lists of keys), and "changed" ({key: {field: [old value, new value]}}).
+    "type_effectiveness" is {(attack type, defense type): [old multiplier, new multiplier]}, and
+    "settings" is {settings name: {field or index: [old value, new value]}}.
+    '''
+
+    def __init__(self, old, new):
+        def pokemon_key(pkm):
+            return (pkm["name"], pkm.get("dex"))
+
+        def move_key(move):
+            return (move["name"], move.get("movetype"))
+
+        self.pokemon = dict(zip(["added", "removed", "changed"],
+                                _diff_entities(old.Pokemon, new.Pokemon, pokemon_key)))
+        self.pve_moves = dict(zip(["added", "removed", "changed"],
+                                  _diff_entities(old.PvEMoves, new.PvEMoves, move_key)))
+        self.pvp_moves = dict(zip(["added", "removed", "changed"],
+                                  _diff_entities(old.PvPMoves, new.PvPMoves, move_key)))
+
+        self.type_effectiveness = {}
+        for atk_type in set(old.TypeEffectiveness) | set(new.TypeEffectiveness):
+            old_row = old.TypeEffectiveness.get(atk_type, {})
+            new_row = new.TypeEffectiveness.get(atk_type, {})
+            for def_type in set(old_row) | set(new_row):
+                if old_row.get(def_type) != new_row.get(def_type):
+                    self.type_effectiveness[(atk_type, def_type)] = [old_row.get(def_type), new_row.get(def_type)]
+
+        self.settings = {}
+        for name in SettingsFields:
+            changes = _diff_fields(getattr(old, name), getattr(new, name))
+            if changes:
+                self.settings[name] = changes
+
+    def __bool__(self):
+        return bool(self.type_effectiveness or self.settings or any(
+            any(section.values()) for section in (self.pokemon, self.pve_moves, self.pvp_moves)))
+
+    def to_json(self):
+        '''
+        Export the differences in json, with lists of entries in place of tuple keys.
+        '''
+        def entities(section, key_fields):
+            return {
+                "added": [dict(zip(key_fields, k)) for k in section["added"]],
+                "removed": [dict(zip(key_fields, k)) for k in section["removed"]],
+                "changed": [dict(zip(key_fields, k), fields=fields) for k, fields in section["changed"].items()]
+            }
+
+        return {
+            "pokemon": entities(self.pokemon, ["name", "dex"]),
+            "pve_moves": entities(self.pve_moves, ["name", "movetype"]),
+            "pvp_moves": entities(self.pvp_moves, ["name", "movetype"]),
+            "type_effectiveness": [{"attack": atk_type, "defense": def_type, "old": old, "new": new}
+                                   for (atk_type, def_type), (old, new) in sorted(self.type_effectiveness.items())],
+            "settings": {name: {str(field): values for field, values in changes.items()}
+                         for name, changes in self.settings.items()}
+        }
+
+    def changed_species(self):
+        '''
+        Return the set of names of species whose types or base stats changed, or that were added or removed.
+        '''
+        names = set(k[0] for k in self.pokemon["added"] + self.pokemon["removed"])
+        for k, fields in self.pokemon["changed"].items():
+            if any(field in fields for field in MatchupSpeciesFields):
+                names.add(k[0])
+        return names
+
+    def changed_pvp_moves(self):
+        '''
+        Return the set of (name, movetype) of PvP moves that changed, or that were added or removed.
+        '''
+        return set(self.pvp_moves["added"] + self.pvp_moves["removed"]) | set(self.pvp_moves["changed"])
+
+    def pvp_settings_changed(self):
+        '''
+        Return whether settings that affect every PvP matchup changed.
+        '''
+        return any(name in self.settings for name in PvPSettingsFields)
+
+    def affected_cells(self, row_pkm, col_pkm=[]):
+        '''
+        Return the boolean mask of the matchups of battle-ready Pokemon affected by the differences:
+        those of a Pokemon whose species or moves changed, and those where a changed type effectiveness
+        applies to the move types of one side against the types of the other.
+
+        @param row_pkm list of Pokemon objects
+        @param col_pkm list of Pokemon objects. If empty, will be the same as row Pokemon
+        @return boolean array of shape (len(row_pkm), len(col_pkm))
+        '''
+        col_pkm = col_pkm or row_pkm
+        shape = (len(row_pkm), len(col_pkm))
+        if self.pvp_settings_changed():
+            return np.ones(shape, dtype=bool)
+
+        species = self.changed_species()
+        moves = self.changed_pvp_moves()
+
+        def move_name(move):
+            return move.get("name") if isinstance(move, dict) else move
+
+        def changed(pkm):
+            if pkm.get("name") in species:
+                return True
+            if (move_name(pkm.get("fmove")), "fast") in moves:
+                return True
+            return any((move_name(move), "charged") in moves for move in pkm.get("cmoves", []))
+
+        def type_masks(pkm_list):
+            # Bit i of attack (defense) mask is set if a move (the Pokemon) has type PoketypeList[i]
+            attack = np.zeros(len(pkm_list), dtype=np.int64)
+            defense = np.zeros(len(pkm_list), dtype=np.int64)
+            for i, pkm in enumerate(pkm_list):
+                for move in [pkm.get("fmove")] + list(pkm.get("cmoves", [])):
+                    if isinstance(move, dict) and move.get("pokeType") in InversedPoketypeList:
+                        attack[i] |= 1 << InversedPoketypeList[move["pokeType"]]
+                for field in ["pokeType1", "pokeType2"]:
+                    if pkm.get(field) in InversedPoketypeList:
+                        defense[i] |= 1 << InversedPoketypeList[pkm[field]]
+            return attack, defense
+
+        mask = np.zeros(shape, dtype=bool)
+        mask[[changed(pkm) for pkm in row_pkm], :] = True
+        mask[:, [changed(pkm) for pkm in col_pkm]] = True
+
+        if self.type_effectiveness:
+            row_attack, row_defense = type_masks(row_pkm)
+            col_attack, col_defense = type_masks(col_pkm)
+            for atk_type, def_type in self.type_effectiveness:
+                if atk_type not in InversedPoketypeList or def_type not in InversedPoketypeList:
+                    # Not a Pokemon type: be safe
+                    return np.ones(shape, dtype=bool)
+                atk_bit = 1 << InversedPoketypeList[atk_type]
+                def_bit = 1 << InversedPoketypeList[def_type]
+                mask |= np.outer(row_attack & atk_bit != 0, col_defense & def_bit != 0)
+                mask |= np.outer(row_defense & def_bit != 0, col_attack & atk_bit != 0)
+        return mask
+
 
 def main():
     parser = argparse.ArgumentParser()
@@ -298,17 +786,31 @@ def main():
                         help="path to official game master json")
     parser.add_argument("-z", "--minimize", action="store_true",
                         help="leaving out Pokemon and Move data")
-    parser.add_argument("-o", "--out", type=argparse.FileType('w'), default=open("./GBS.json", "w"),
-                        help="output filepath")
+    parser.add_argument("-o", "--out", type=argparse.FileType('w'), default=None,
+                        help="output filepath. Default to ./GBS.json, or stdout with --diff")
+    parser.add_argument("--no-snapshot", action="store_true",
+                        help="always parse the game master instead of using its cached binary snapshot")
+    parser.add_argument("--diff", metavar="OLD",
+                        help="instead, output the changes (json) from older game master json OLD to infile")
+    Profile.add_argument(parser)
     args = parser.parse_args()
-
-    gm = GameMaster(args.infile)
+    Profile.start(args.profile)
+
+    gm = GameMaster()
+    gm.parse(args.infile, snapshot=not args.no_snapshot)
+    if args.diff is not None:
+        old_gm = GameMaster().parse(args.diff, snapshot=not args.no_snapshot)
+        json.dump(GameMaster.diff(old_gm, gm).to_json(), args.out or sys.stdout, indent=4)
+        return
+    if args.out is None:
+        args.out = open("./GBS.json", "w")
     j = gm.to_json()
     if args.minimize:
         j.pop("Pokemon")
         j.pop("PvPMoves")
         j.pop("PvEMoves")
-    json.dump(j, args.out, indent=4)
+    with Profile.stage("gamemaster.save"):
+        json.dump(j, args.out, indent=4)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,318 @@
+'''
+This module ranks the IV combinations of every species for a PvP league by stat product.
+'''
+
+import argparse
+import csv
+import os
+import sys
+
+import numpy as np
+
+from .Cache import cache_dir, digest
+from .GameMaster import GameMaster
+from .Tables import get_tables
+
+
+N_IVS = 16**3
+
+# In-memory tables, by (game master hash, target cp, max level)
+_tables = {}
+
+
+def league_cp(league):
+    '''
+    return the target cp of @param league, or None for master league.
+
+    @param league one of {"great", "ultra", "master"}, or an int for target cp
+    '''
+    if league == "master":
+        return None
+    elif league == "ultra":
+        return 2500
+    elif league == "great":
+        return 1500
+    elif type(league) is int:
+        return league
+    else:
+        raise Exception("bad league {}".format(league))
+
+
+def split_ivs(iv_index):
+    '''
+    Return (atkiv, defiv, stmiv) of IV combination index @param iv_index = atkiv * 256 + defiv * 16 + stmiv.
+    '''
+    return iv_index // 256, iv_index // 16 % 16, iv_index % 16
+
+
+def _stats(base_stats, iv_index, cpm):
+    atkiv, defiv, stmiv = split_ivs(iv_index)
+    Atk = (base_stats[..., 0] + atkiv) * cpm
+    Def = (base_stats[..., 1] + defiv) * cpm
+    Stm = (base_stats[..., 2] + stmiv) * cpm
+    cp = np.maximum(10, (Atk * np.sqrt(Def * Stm) / 10).astype(np.int64))
+    return Atk, Def, Stm, cp
+
+
+def rank_ivs(base_stats, CPMultipliers, target_cp=None, chunk_size=256):
+    '''
+    Rank all IV combinations of each base stats by stat product, at their highest level with cp not above the target.
+
+    @param base_stats integer array of shape (n, 3) of (baseAtk, baseDef, baseStm)
+    @param CPMultipliers cp multiplier of each level, in ascending order
+    @param target_cp cp cap. If None, every IV combination uses the highest level
+    @return a tuple of arrays of shape (n, 4096):
+        IV combination indexes in rank order, and the level index of each IV combination (-1 if none fits the cap)
+    '''
+    CPMultipliers = np.asarray(CPMultipliers)
+    base_stats = np.asarray(base_stats, dtype=np.int64)
+    n, n_levels = len(base_stats), len(CPMultipliers)
+    iv_index = np.arange(N_IVS)
+    order = np.empty((n, N_IVS), dtype=np.uint16)
+    best_level = np.empty((n, N_IVS), dtype=np.int8)
+
+    for start in range(0, n, chunk_size):
+        base = base_stats[start:start + chunk_size, None, :]
+        if target_cp is None:
+            level = np.full((len(base), N_IVS), n_levels - 1)
+        else:
+            # cp grows with level, so binary search the number of levels within the cap
+            lo = np.zeros((len(base), N_IVS), dtype=np.int64)
+            hi = np.full((len(base), N_IVS), n_levels)
+            while (lo < hi).any():
+                searching = lo < hi
+                mid = (lo + hi) // 2
+                cp = _stats(base, iv_index, CPMultipliers[np.minimum(mid, n_levels - 1)])[3]
+                fits = cp <= target_cp
+                lo = np.where(searching & fits, mid + 1, lo)
+                hi = np.where(searching & ~fits, mid, hi)
+            level = lo - 1
+        Atk, Def, Stm, cp = _stats(base, iv_index, CPMultipliers[np.maximum(level, 0)])
+        stat_product = np.where(level >= 0, Atk * Def * np.floor(Stm), -1)
+        order[start:start + chunk_size] = np.argsort(-stat_product, axis=1, kind="stable")
+        best_level[start:start + chunk_size] = level
+
+    return order, best_level
+
+
+def game_master_hash(game_master):
+    '''
+    Return the hash of the data IV ranking depends on: species base stats and cp multipliers.
+    '''
+    return digest({
+        "stats": species_base_stats(game_master).tolist(),
+        "cpm": game_master.CPMultipliers
+    })
+
+
+def species_base_stats(game_master):
+    '''
+    Return the distinct base stats of the species of @param game_master, as a sorted array of shape (n, 3).
+    '''
+    base_stats = get_tables(game_master).species.base_stats
+    return np.unique(base_stats, axis=0) if len(base_stats) else np.zeros((0, 3), dtype=np.int64)
+
+
+class IVRankTable:
+    '''
+    IV ranking of every species (by distinct base stats) of a GameMaster for one cp cap.
+    '''
+
+    def __init__(self, base_stats, order, level, CPMultipliers, target_cp=None):
+        self.base_stats = np.asarray(base_stats, dtype=np.int64)
+        self.order = order
+        self.level = level
+        self.CPMultipliers = np.asarray(CPMultipliers)
+        self.target_cp = target_cp
+        self._rows = {tuple(int(x) for x in stats): i for i, stats in enumerate(self.base_stats)}
+
+    @staticmethod
+    def build(game_master, target_cp=None, max_level=None, previous=None):
+        '''
+        Rank the IVs of all species in @param game_master under cp cap @param target_cp.
+        @param max_level highest level allowed. If None, all levels in the game master are allowed
+        @param previous IVRankTable of an older game master. If it has the same cp multipliers and cp cap,
+            its rankings are reused and only base stats new to it are ranked
+        '''
+        CPMultipliers = game_master.CPMultipliers
+        if max_level is not None:
+            CPMultipliers = CPMultipliers[:round(2 * float(max_level) - 1)]
+        base_stats = [tuple(stats) for stats in species_base_stats(game_master).tolist()]
+        if previous is None or not previous.compatible(CPMultipliers, target_cp):
+            order, level = rank_ivs(base_stats, CPMultipliers, target_cp)
+            return IVRankTable(base_stats, order, level, CPMultipliers, target_cp)
+
+        rows = np.array([previous._rows.get(stats, -1) for stats in base_stats], dtype=np.int64)
+        order = previous.order[np.maximum(rows, 0)]
+        level = previous.level[np.maximum(rows, 0)]
+        new_rows = np.flatnonzero(rows < 0)
+        if len(new_rows):
+            order[new_rows], level[new_rows] = rank_ivs(
+                [base_stats[i] for i in new_rows], CPMultipliers, target_cp)
+        return IVRankTable(base_stats, order, level, CPMultipliers, target_cp)
+
+    def compatible(self, CPMultipliers, target_cp):
+        '''
+        Return whether this table ranks IVs with cp multipliers @param CPMultipliers under cp cap @param target_cp.
+        '''
+        return self.target_cp == target_cp and np.array_equal(self.CPMultipliers, np.asarray(CPMultipliers))
+
+    def save(self, file):
+        np.savez_compressed(file, base_stats=self.base_stats, order=self.order, level=self.level,
+                            CPMultipliers=self.CPMultipliers,
+                            target_cp=-1 if self.target_cp is None else self.target_cp)
+
+    @staticmethod
+    def load(file):
+        with np.load(file) as data:
+            target_cp = int(data["target_cp"])
+            return IVRankTable(data["base_stats"], data["order"], data["level"], data["CPMultipliers"],
+                               None if target_cp < 0 else target_cp)
+
+    def _row(self, bAtk, bDef, bStm):
+        key = (int(bAtk), int(bDef), int(bStm))
+        if key not in self._rows:
+            # Base stats not in the game master (e.g. custom Pokemon): rank them now
+            order, level = rank_ivs([key], self.CPMultipliers, self.target_cp)
+            self.base_stats = np.concatenate([self.base_stats, [key]])
+            self.order = np.concatenate([self.order, order])
+            self.level = np.concatenate([self.level, level])
+            self._rows[key] = len(self.base_stats) - 1
+        return self._rows[key]
+
+    def top(self, bAtk, bDef, bStm, n=1, start=1):
+        '''
+        Return the IV combinations ranked @param start to @param start + n - 1 (1 being the best),
+        as a list of dict with fields "rank", "cpm", "level", "atkiv", "defiv", "stmiv", "cp", "stat_product".
+        '''
+        row = self._row(bAtk, bDef, bStm)
+        results = []
+        for rank in range(start, min(start + n, N_IVS + 1)):
+            iv_index = int(self.order[row, rank - 1])
+            level = int(self.level[row, iv_index])
+            if level < 0:
+                break
+            cpm = float(self.CPMultipliers[level])
+            Atk, Def, Stm, cp = _stats(self.base_stats[row], iv_index, cpm)
+            atkiv, defiv, stmiv = split_ivs(iv_index)
+            results.append({
+                "rank": rank,
+                "cpm": cpm,
+                "level": (level + 2) / 2,
+                "atkiv": atkiv,
+                "defiv": defiv,
+                "stmiv": stmiv,
+                "cp": int(cp),
+                "stat_product": float(Atk * Def * np.floor(Stm))
+            })
+        return results
+
+    def lookup(self, bAtk, bDef, bStm, rank=1):
+        '''
+        Return the IV combination of rank @param rank (1 being the best), or None if there is no such rank.
+        '''
+        results = self.top(bAtk, bDef, bStm, 1, rank)
+        return results[0] if results else None
+
+
+def _load_table(path):
+    if not os.path.isfile(path):
+        return None
+    try:
+        return IVRankTable.load(path)
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _previous_table(target_cp, max_level):
+    '''
+    Return the table of the same cp cap and max level built most recently for another game master, or None.
+    A game master update only changes a few species, so most of its rows can be reused.
+    '''
+    for key in reversed(list(_tables)):
+        if key[1:] == (target_cp, max_level):
+            return _tables[key]
+    suffix = "-{}-{}.npz".format(target_cp, max_level)
+    try:
+        directory = os.path.join(cache_dir(), "ivrank")
+    except OSError:
+        return None
+    if not os.path.isdir(directory):
+        return None
+    paths = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(suffix)]
+    for path in sorted(paths, key=os.path.getmtime, reverse=True):
+        table = _load_table(path)
+        if table is not None:
+            return table
+    return None
+
+
+def get_iv_rank_table(target_cp=None, game_master=None, max_level=None):
+    '''
+    Return the IVRankTable of @param game_master for cp cap @param target_cp,
+    loading it from the on-disk cache or building and caching it.
+    '''
+    if game_master is None:
+        game_master = GameMaster.CurrentInstance
+    key = (game_master_hash(game_master), target_cp, max_level)
+    if key in _tables:
+        return _tables[key]
+
+    try:
+        path = os.path.join(cache_dir(), "ivrank", "{}-{}-{}.npz".format(*key))
+    except OSError:
+        path = None
+    table = None if path is None else _load_table(path)
+    if table is None:
+        table = IVRankTable.build(game_master, target_cp, max_level, _previous_table(target_cp, max_level))
+        tmp_path = None if path is None else "{}.{}.tmp.npz".format(path[:-4], os.getpid())
+        try:
+            if path is not None:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                table.save(tmp_path)
+                os.replace(tmp_path, path)
+        except OSError:
+            # The on-disk table only saves building time; without a usable cache directory, keep the built one
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    _tables[key] = table
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("name",
+                        help="Pokemon species name")
+    parser.add_argument("--league", default="great",
+                        help="one of {great, ultra, master}, or target cp")
+    parser.add_argument("-n", "--top", type=int, default=10,
+                        help="number of IV combinations to show")
+    parser.add_argument("--max-level", type=float, default=None,
+                        help="highest level allowed. If omitted, all levels in the game master are allowed")
+    parser.add_argument("-c", "--config", default="./GBS.json",
+                        help="path to GBS configuration json")
+    parser.add_argument("-o", "--out", type=argparse.FileType('w'), default=sys.stdout,
+                        help="file to store output (csv)")
+    args = parser.parse_args()
+
+    gm = GameMaster()
+    gm.load_config(args.config)
+    gm.apply()
+
+    species = gm.search_pokemon(args.name)
+    if species is None:
+        print("Pokemon not found: {}".format(args.name))
+        return -1
+    league = int(args.league) if args.league.isdigit() else args.league
+    table = get_iv_rank_table(league_cp(league), gm, args.max_level)
+    rows = table.top(species["baseAtk"], species["baseDef"], species["baseStm"], args.top)
+
+    fields = ["rank", "level", "atkiv", "defiv", "stmiv", "cp", "stat_product", "cpm"]
+    writer = csv.DictWriter(args.out, fields)
+    writer.writeheader()
+    writer.writerows(rows)
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -4,71 +4,140 @@ This module provides methods to create, load, run and save battle matrix.
 '''
 
 import argparse
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 import copy
 import csv
 import json
 import math
+import os
 import sys
 
+import numpy as np
+
+from .Cache import MatchupCache, matchup_config_hash, matchup_key, pokemon_key
 from .GameMaster import GameMaster
+from .IVRank import get_iv_rank_table, league_cp
 from .Pokemon import Pokemon
+from . import Profile
+from . import Ranking
+from .VectorEngine import SHIELD_SCENARIOS, shield_average
 
 try:
-    from .Engine import GBS
+    from .Engine import GBS, default_session
 except Exception as e:
     GBS = e
 
+    def default_session():
+        # The engine failed to load: report why on first use
+        raise GBS
+
+
+CoreStats = ["pokeType1", "pokeType2", "attack", "defense", "maxHP"]
+CoreBaseStats = ["pokeType1", "pokeType2", "baseAtk", "baseDef", "baseStm"]
+
+
+def _set_base_stats(pkm, game_master):
+    if all([stat in pkm for stat in CoreBaseStats]):
+        return True
+    game_master.apply()
+    species = game_master.search_pokemon(pkm["name"])
+    if species is None:
+        return False
+    for stat in CoreBaseStats:
+        pkm[stat] = species[stat]
+    return True
+
+
+def _set_core_stats(pkm):
+    pkm["attack"] = (pkm["baseAtk"] + pkm["atkiv"]) * pkm["cpm"]
+    pkm["defense"] = (pkm["baseDef"] + pkm["defiv"]) * pkm["cpm"]
+    pkm["maxHP"] = math.floor((pkm["baseStm"] + pkm["stmiv"]) * pkm["cpm"])
+    return pkm
+
+
+def _set_ranked_ivs(pkm, table, iv_rank):
+    ranked = table.lookup(pkm["baseAtk"], pkm["baseDef"], pkm["baseStm"], iv_rank)
+    if ranked is None:
+        return None
+    for field in ["cpm", "atkiv", "defiv", "stmiv"]:
+        pkm[field] = ranked[field]
+    return _set_core_stats(pkm)
+
 
-def set_stats(pkm, league, game_master=None):
+def set_stats(pkm, league, game_master=None, iv_rank=None):
     '''
     set the core stats (pokeType1, pokeType2, attack, defense, maxHP) for Pokemon @param pkm according to @param league
 
     @param pkm dict-like object containing field "name", or all of the core stats to avoid GameMaster look-up
     @param league one of {"great", "ultra", "master"}, or an int for target cp
     @param game_master GameMaster to search stats data for
+    @param iv_rank if set, use the IVs of this stat product rank in the league (1 being the best),
+        instead of the first IVs that reach the league cp
     '''
     if game_master is None:
         game_master = GameMaster.CurrentInstance
 
-    CoreStats = ["pokeType1", "pokeType2", "attack", "defense", "maxHP"]
-    CoreBaseStats = ["pokeType1", "pokeType2", "baseAtk", "baseDef", "baseStm"]
-
     if all([stat in pkm for stat in CoreStats]):
         return pkm
 
-    if all([stat in pkm for stat in CoreBaseStats]):
-        pass
-    else:
-        game_master.apply()
-        species = game_master.search_pokemon(pkm["name"])
-        if species is None:
-            return None
-        for stat in CoreBaseStats:
-            pkm[stat] = species[stat]
+    if not _set_base_stats(pkm, game_master):
+        return None
 
-    if league == "master":
+    target_cp = league_cp(league)
+    if iv_rank is not None:
+        return _set_ranked_ivs(pkm, get_iv_rank_table(target_cp, game_master), iv_rank)
+    if target_cp is None:
         pkm["cpm"] = game_master.CPMultipliers[-1]
         pkm["atkiv"] = 15
         pkm["defiv"] = 15
         pkm["stmiv"] = 15
     else:
-        if league == "ultra":
-            target_cp = 2500
-        elif league == "great":
-            target_cp = 1500
-        elif type(league) is int:
-            target_cp = league
-        else:
-            raise Exception("bad league {}".format(league))
-        target_cp = 2500 if league == "ultra" else 1500
-        pkm["cpm"], pkm["atkiv"], pkm["defiv"], pkm["stmiv"] = Pokemon.infer_cpm_and_IVs(
+        ivs = Pokemon.infer_cpm_and_IVs(
             pkm["baseAtk"], pkm["baseDef"], pkm["baseStm"], target_cp)
+        if ivs is None:
+            return None
+        pkm["cpm"], pkm["atkiv"], pkm["defiv"], pkm["stmiv"] = ivs
 
-    pkm["attack"] = (pkm["baseAtk"] + pkm["atkiv"]) * pkm["cpm"]
-    pkm["defense"] = (pkm["baseDef"] + pkm["defiv"]) * pkm["cpm"]
-    pkm["maxHP"] = math.floor((pkm["baseStm"] + pkm["stmiv"]) * pkm["cpm"])
+    return _set_core_stats(pkm)
 
-    return pkm
+
+def set_stats_batch(pkm_list, league, game_master=None, iv_rank=None):
+    '''
+    set_stats() for every Pokemon of @param pkm_list, inferring the IVs of all of them in one batch.
+
+    @return a list of the same length, with None for Pokemon whose stats could not be set
+    '''
+    if game_master is None:
+        game_master = GameMaster.CurrentInstance
+    target_cp = league_cp(league)
+    if target_cp is None or iv_rank is not None:
+        return [set_stats(pkm, league, game_master, iv_rank) for pkm in pkm_list]
+
+    results = [None] * len(pkm_list)
+    pending = []
+    for i, pkm in enumerate(pkm_list):
+        if all([stat in pkm for stat in CoreStats]):
+            results[i] = pkm
+        elif _set_base_stats(pkm, game_master):
+            pending.append(i)
+    if not pending:
+        return results
+
+    game_master.apply()
+    base_stats = np.array([[pkm_list[i][stat] for stat in ["baseAtk", "baseDef", "baseStm"]]
+                           for i in pending], dtype=np.int64)
+    cpm, atkiv, defiv, stmiv, found = Pokemon.infer_cpm_and_IVs_batch(
+        base_stats[:, 0], base_stats[:, 1], base_stats[:, 2], target_cp)
+    for k, i in enumerate(pending):
+        if not found[k]:
+            continue
+        pkm = pkm_list[i]
+        pkm["cpm"] = float(cpm[k])
+        pkm["atkiv"], pkm["defiv"], pkm["stmiv"] = int(
+            atkiv[k]), int(defiv[k]), int(stmiv[k])
+        results[i] = _set_core_stats(pkm)
+    return results
 
 
 def set_moves(pkm, game_master=None):
@@ -131,11 +200,11 @@ def minimize_pokemon(pkm_list):
     pkm_list_minimized = []
     for pkm in pkm_list:
         pkm_min = {k: pkm[k] for k in CoreFields}
+        # Moves are shared with the GameMaster, so strip copies of them
         if "fmove" in pkm_min and "movetype" in pkm_min["fmove"]:
-            pkm_min["fmove"].pop("movetype")
-        for cmove in pkm_min.get("cmoves", []):
-            if "movetype" in cmove:
-                cmove.pop("movetype")
+            pkm_min["fmove"] = {k: v for k, v in pkm_min["fmove"].items() if k != "movetype"}
+        pkm_min["cmoves"] = [{k: v for k, v in cmove.items() if k != "movetype"}
+                             for cmove in pkm_min.get("cmoves", [])]
         pkm_list_minimized.append(pkm_min)
     return pkm_list_minimized
 
@@ -189,27 +258,414 @@ def do_run_matrix(row_pkm, col_pkm=[], shield=0):
     @return matrix as 2D list
     '''
 
-    reqInput = {
-        "battleMode": "battlematrix",
-        "rowPokemon": row_pkm,
-        "colPokemon": col_pkm,
-        "avergeByShield": shield != 0
-    }
+    return default_session().run_matrix(row_pkm, col_pkm, shield)
+
+
+def do_run_shield_tensor(row_pkm, col_pkm=[]):
+    '''
+    actually run the Battle Matrix in every shield scenario.
+
+    @param row_pkm list of Pokemon objects
+    @param col_pkm list of Pokemon objects
+    @return array of shape (rows, cols, row shields, col shields)
+    '''
+
+    return default_session().run_shield_tensor(row_pkm, col_pkm)
+
+
+def check_antisymmetric(engine=None):
+    '''
+    raise if @param engine (default to the engine of the default session) does not declare antisymmetric scores,
+    i.e. M[j][i] == -M[i][j], which triangular mode relies on.
+    '''
+    if engine is None:
+        engine = default_session().engine
+    if not getattr(engine, "antisymmetric", False):
+        raise Exception("triangular mode requires an engine with antisymmetric scores, not GBS {}".format(
+            engine.version()))
+
+
+def mirror_matrix(matrix):
+    '''
+    complete a square battle matrix from its upper triangle, using M[j][i] == -M[i][j].
+
+    @param matrix 2D array whose entries on and above the diagonal are set
+    @return the completed matrix as 2D array
+    '''
+    matrix = np.asarray(matrix, dtype=np.float64)
+    upper = np.triu(matrix, 1)
+    return upper - upper.T + np.diag(np.diag(matrix))
+
+
+def _matrix_tiles(shape, tile_size, triangular=False):
+    '''
+    split a matrix of @param shape into tiles of (row_start, row_end, col_start, col_end).
+    In triangular mode, each tile is a block of rows against the columns from its first row onwards.
+    '''
+    tiles = []
+    for i in range(0, shape[0], tile_size):
+        i_end = min(i + tile_size, shape[0])
+        if triangular:
+            tiles.append((i, i_end, i, shape[1]))
+            continue
+        for j in range(0, shape[1], tile_size):
+            tiles.append((i, i_end, j, min(j + tile_size, shape[1])))
+    return tiles
+
+
+def do_run_matrix_triangular(pkm_list, shield=0, block_size=None):
+    '''
+    run the square Battle Matrix of @param pkm_list against itself,
+    simulating only the upper triangle and mirroring the other half.
+
+    @param pkm_list list of Pokemon objects
+    @param shield shield setting
+    @param block_size number of rows simulated per engine call
+    @return matrix as 2D list
+    '''
+    check_antisymmetric()
+    n = len(pkm_list)
+    if block_size is None:
+        block_size = max(1, math.ceil(n / 16))
+    matrix = np.zeros((n, n))
+    for i, i_end, j, j_end in _matrix_tiles((n, n), block_size, True):
+        matrix[i:i_end, j:j_end] = do_run_matrix(
+            pkm_list[i:i_end], pkm_list[j:j_end], shield)
+    return mirror_matrix(matrix).tolist()
+
+
+def _init_worker(config):
+    if config is not None:
+        default_session().configure(config)
+
+
+def _run_tile(shm_name, shape, row_start, col_start, row_pkm, col_pkm, shield, tensor=False):
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        result = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+        if tensor:
+            tile = do_run_shield_tensor(row_pkm, col_pkm)
+        else:
+            tile = do_run_matrix(row_pkm, col_pkm, shield)
+        result[row_start:row_start + len(row_pkm),
+               col_start:col_start + len(col_pkm)] = tile
+    finally:
+        shm.close()
+
+
+def do_run_matrix_parallel(row_pkm, col_pkm=[], shield=0, workers=2, tile_size=None, config=None, triangular=False,
+                           tensor=False):
+    '''
+    run the Battle Matrix in tiles over a pool of worker processes.
+    Each worker loads its own engine and writes its tiles into a shared-memory result array.
+
+    @param row_pkm list of Pokemon objects
+    @param col_pkm list of Pokemon objects. If empty, will be the same as row Pokemon
+    @param shield shield setting
+    @param workers number of worker processes
+    @param tile_size number of rows/cols per tile. If omitted, derived from matrix size and workers
+    @param config GBS configuration each worker applies before simulating
+    @param triangular if True (and @param col_pkm is empty), only simulate the upper triangle and mirror it
+    @param tensor if True, run every shield scenario (ignoring @param shield) and return the shield tensor
+    @return matrix as 2D list, or shield tensor as array of shape (rows, cols, row shields, col shields)
+    '''
+    if triangular and col_pkm:
+        raise Exception("triangular mode requires col Pokemon to be omitted")
+    if triangular and tensor:
+        raise Exception("triangular mode does not support shield tensors")
+    if triangular:
+        check_antisymmetric()
+    col_pkm = col_pkm or row_pkm
+    shape = (len(row_pkm), len(col_pkm))
+    if tensor:
+        shape += (len(SHIELD_SCENARIOS), len(SHIELD_SCENARIOS))
+    if not all(shape):
+        return np.zeros(shape) if tensor else [[] for pkm in row_pkm]
+    if tile_size is None:
+        # Aim for a few tiles per worker to balance the load
+        if triangular:
+            tile_size = max(1, math.ceil(shape[0] / max(16, 4 * workers)))
+        else:
+            tile_size = max(1, math.ceil(
+                math.sqrt(shape[0] * shape[1] / (4 * workers))))
+
+    # Python 3.8+, so only imported for parallel runs
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(
+        create=True, size=math.prod(shape) * np.dtype(np.float64).itemsize)
+    try:
+        result = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+        result[:] = 0
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(config,)) as pool:
+            futures = []
+            for i, i_end, j, j_end in _matrix_tiles(shape, tile_size, triangular):
+                futures.append(pool.submit(_run_tile, shm.name, shape, i, j,
+                                           row_pkm[i:i_end], col_pkm[j:j_end], shield, tensor))
+            for future in futures:
+                future.result()
+        if tensor:
+            matrix = result.copy()
+        elif triangular:
+            matrix = mirror_matrix(result).tolist()
+        else:
+            matrix = result.tolist()
+        del result
+    finally:
+        shm.close()
+        shm.unlink()
+    return matrix
+
+
+def do_run_matrix_cached(row_pkm, col_pkm=[], shield=0, cache=None, config=None, workers=1, triangular=False):
+    '''
+    run the Battle Matrix, only simulating the matchups missing in @param cache, and store the new results.
+
+    @param row_pkm list of Pokemon objects
+    @param col_pkm list of Pokemon objects. If empty, will be the same as row Pokemon
+    @param shield shield setting
+    @param cache MatchupCache
+    @param config GBS configuration, which is part of the cache keys. Default to the current GameMaster's
+    @param workers number of worker processes for simulating the missing matchups
+    @param triangular if True (and @param col_pkm is empty), missing matchups are mirrored from cached ones.
+        Mirrored matchups are not stored in the cache
+    @return matrix as 2D list
+    '''
+    if config is None:
+        config = GameMaster.CurrentInstance.to_json()
+    square = not col_pkm
+    triangular = triangular and square
+    if triangular:
+        check_antisymmetric()
+    col_pkm = col_pkm or row_pkm
+    config_key = matchup_config_hash(config)
+    # Engines do not simulate alike, so their results are kept apart
+    engine = default_session().engine.version()
+
+    # Identical Pokemon share their matchups, so work with unique keys only
+    row_keys = [pokemon_key(pkm) for pkm in row_pkm]
+    col_keys = row_keys if square else [pokemon_key(pkm) for pkm in col_pkm]
+    row_by_key = dict(zip(row_keys, row_pkm))
+    col_by_key = dict(zip(col_keys, col_pkm))
+    cell_keys = {(r, c): matchup_key(r, c, shield, config_key, engine)
+                 for r in row_by_key for c in col_by_key}
+
+    cached = cache.get_many(cell_keys.values())
+    results = {cell: cached[key]
+               for cell, key in cell_keys.items() if key in cached}
+
+    def simulate(rows, cols):
+        if workers > 1:
+            return do_run_matrix_parallel(rows, cols, shield, workers, config=config)
+        return do_run_matrix(rows, cols, shield)
+
+    if not results:
+        # Nothing cached: run the whole matrix the usual way
+        if workers > 1:
+            matrix = do_run_matrix_parallel(row_pkm, [] if square else col_pkm, shield, workers,
+                                            config=config, triangular=triangular)
+        elif triangular:
+            matrix = do_run_matrix_triangular(row_pkm, shield)
+        else:
+            matrix = do_run_matrix(row_pkm, [] if square else col_pkm, shield)
+        for i, r in enumerate(row_keys):
+            for j, c in enumerate(col_keys):
+                # Only the upper triangle was simulated in triangular mode
+                if not (triangular and j < i):
+                    results[(r, c)] = matrix[i][j]
+        cache.put_many([(cell_keys[cell], score)
+                        for cell, score in results.items()])
+        return matrix
+
+    new_cells = []
+    if triangular:
+        position = {key: i for i, key in enumerate(row_by_key)}
+        for r in row_by_key:
+            for c in col_by_key:
+                if (r, c) not in results and r != c and (c, r) in results:
+                    # Subtract from 0.0 so that a mirrored draw is 0.0, not -0.0
+                    results[(r, c)] = 0.0 - results[(c, r)]
+
+    # Group rows by their set of missing cols, so that each group is one simulation
+    groups = defaultdict(list)
+    for r in row_by_key:
+        missing = tuple(c for c in col_by_key if (r, c) not in results and
+                        not (triangular and position[c] < position[r]))
+        if missing:
+            groups[missing].append(r)
+    for cols, rows in groups.items():
+        block = simulate([row_by_key[r] for r in rows],
+                         [col_by_key[c] for c in cols])
+        for i, r in enumerate(rows):
+            for j, c in enumerate(cols):
+                results[(r, c)] = block[i][j]
+                new_cells.append((r, c))
+                if triangular and (c, r) not in results:
+                    results[(c, r)] = 0.0 - block[i][j]
+
+    cache.put_many([(cell_keys[cell], results[cell]) for cell in new_cells])
+    return [[results[(r, c)] for c in col_keys] for r in row_keys]
+
+
+@Profile.profiled("matrix.run")
+def run_pokemon_matrix(row_pkm, col_pkm=[], shield=0, config=None, workers=1, triangular=False, cache=None):
+    '''
+    run the Battle Matrix of loaded Pokemon, choosing the execution strategy.
+
+    @param row_pkm list of Pokemon objects
+    @param col_pkm list of Pokemon objects. If empty, will be the same as row Pokemon
+    @param shield shield setting
+    @param config GBS configuration to apply. If omitted, the engine is used as configured
+    @param workers number of worker processes. If more than 1, the matrix is run in tiles in parallel
+    @param triangular if True (and @param col_pkm is empty), only simulate i <= j and mirror the other half
+    @param cache MatchupCache (or path to one) of previously simulated matchups
+    @return matrix as 2D list
+    '''
+    if triangular and col_pkm:
+        raise Exception("triangular mode requires col Pokemon to be omitted")
+    if triangular:
+        check_antisymmetric()
+    if config is not None and workers <= 1:
+        default_session().configure(config)
+
+    if cache is not None:
+        if not isinstance(cache, MatchupCache):
+            cache = MatchupCache(cache)
+        return do_run_matrix_cached(row_pkm, col_pkm, shield, cache, config, workers, triangular)
+    if workers > 1:
+        return do_run_matrix_parallel(row_pkm, col_pkm, shield, workers, config=config, triangular=triangular)
+    if triangular:
+        return do_run_matrix_triangular(row_pkm, shield)
+    return do_run_matrix(row_pkm, col_pkm, shield)
+
+
+@Profile.profiled("matrix.run")
+def run_shield_tensor(row_pkm, col_pkm=[], config=None, workers=1):
+    '''
+    run the Battle Matrix of loaded Pokemon in every shield scenario in one job.
+    The shield-averaged matrix is shield_average() of the result.
+
+    @param row_pkm list of Pokemon objects
+    @param col_pkm list of Pokemon objects. If empty, will be the same as row Pokemon
+    @param config GBS configuration to apply. If omitted, the engine is used as configured
+    @param workers number of worker processes. If more than 1, the tensor is run in tiles in parallel
+    @return array of shape (rows, cols, row shields, col shields), over SHIELD_SCENARIOS
+    '''
+    if workers > 1:
+        return do_run_matrix_parallel(row_pkm, col_pkm, workers=workers, config=config, tensor=True)
+    if config is not None:
+        default_session().configure(config)
+    return do_run_shield_tensor(row_pkm, col_pkm)
+
 
-    GBS.prepare(reqInput)
-    GBS.run()
-    return GBS.collect()
+@Profile.profiled("matrix.update")
+def update_matrix(old, row_pkm, col_pkm=[], shield=0, diff=None, config=None, workers=1, cache=None):
+    '''
+    re-run only the matchups of a previous Battle Matrix that are stale, and reuse the others.
 
+    @param old BattleMatrix of a previous run. Its rows and cols are matched to the Pokemon by label
+    @param row_pkm list of Pokemon objects
+    @param col_pkm list of Pokemon objects. If empty, will be the same as row Pokemon
+    @param shield shield setting, which must be the one of @param old
+    @param diff GameMasterDiff from the game master of @param old to the current one.
+        If None, the game master is taken as unchanged and only matchups missing in @param old are run
+    @param config GBS configuration to apply. If omitted, the engine is used as configured
+    @param workers number of worker processes for simulating the stale matchups
+    @param cache MatchupCache (or path to one) of previously simulated matchups
+    @return matrix as 2D float64 array
+    '''
+    col_pkm = col_pkm or row_pkm
+    row_index = old._label_index(0)
+    col_index = old._label_index(1)
+    old_rows = np.array([row_index.get(pokemon_label(pkm), -1) for pkm in row_pkm], dtype=np.int64)
+    old_cols = np.array([col_index.get(pokemon_label(pkm), -1) for pkm in col_pkm], dtype=np.int64)
+
+    if diff is not None:
+        stale = diff.affected_cells(row_pkm, col_pkm)
+    else:
+        stale = np.zeros((len(row_pkm), len(col_pkm)), dtype=bool)
+    stale[old_rows < 0, :] = True
+    stale[:, old_cols < 0] = True
+    Profile.count("matrix.stale_cells", int(stale.sum()))
 
-def load_and_set_pokemon(filepath, league="master", game_master=None):
+    matrix = np.asarray(old.values[np.ix_(np.maximum(old_rows, 0), np.maximum(old_cols, 0))], dtype=np.float64)
+    if not stale.any():
+        return matrix
+    if config is not None and workers <= 1:
+        default_session().configure(config)
+
+    # Group rows by their set of stale cols, so that each group is one simulation
+    groups = defaultdict(list)
+    for i in range(len(row_pkm)):
+        cols = tuple(np.flatnonzero(stale[i]).tolist())
+        if cols:
+            groups[cols].append(i)
+    for cols, rows in groups.items():
+        block = run_pokemon_matrix([row_pkm[i] for i in rows], [col_pkm[j] for j in cols], shield,
+                                   config if workers > 1 else None, workers, cache=cache)
+        matrix[np.ix_(rows, cols)] = block
+    return matrix
+
+
+# Estimated peak bytes per matrix cell while a block is in flight:
+# engine output encoding, the decoded Python floats and the block array
+MATRIX_CELL_BYTES = 64
+
+
+def matrix_block_rows(shape, memory_limit):
+    '''
+    Return the number of rows per block so that a block of a matrix of @param shape fits in @param memory_limit bytes.
+    '''
+    return max(1, min(shape[0], int(memory_limit // (MATRIX_CELL_BYTES * max(1, shape[1])))))
+
+
+def iter_matrix_blocks(row_pkm, col_pkm=[], shield=0, block_rows=None, memory_limit=None, config=None, workers=1,
+                       cache=None):
+    '''
+    run the Battle Matrix in blocks of rows, so that only one block is held in memory at a time.
+
+    @param row_pkm list of Pokemon objects
+    @param col_pkm list of Pokemon objects. If empty, will be the same as row Pokemon
+    @param shield shield setting
+    @param block_rows number of rows per block. If omitted, derived from @param memory_limit
+    @param memory_limit memory ceiling of a block in bytes. If both are omitted, the matrix is one block
+    @param config GBS configuration to apply. If omitted, the engine is used as configured
+    @param workers number of worker processes to run each block in parallel tiles
+    @param cache MatchupCache (or path to one) of previously simulated matchups
+    @return generator of (first row index, block as 2D array)
+    '''
+    col_pkm = col_pkm or row_pkm
+    if block_rows is None:
+        if memory_limit is None:
+            block_rows = max(1, len(row_pkm))
+        else:
+            block_rows = matrix_block_rows((len(row_pkm), len(col_pkm)), memory_limit)
+    if config is not None and workers <= 1:
+        default_session().configure(config)
+    if cache is not None and not isinstance(cache, MatchupCache):
+        cache = MatchupCache(cache)
+
+    for i in range(0, len(row_pkm), block_rows):
+        rows = row_pkm[i:i + block_rows]
+        if cache is not None:
+            block = do_run_matrix_cached(rows, col_pkm, shield, cache, config, workers)
+        elif workers > 1:
+            block = do_run_matrix_parallel(rows, col_pkm, shield, workers, config=config)
+        else:
+            block = do_run_matrix(rows, col_pkm, shield)
+        yield i, np.asarray(block, dtype=np.float64).reshape(len(rows), len(col_pkm))
+
+
+@Profile.profiled("matrix.load_pokemon")
+def load_and_set_pokemon(filepath, league="master", game_master=None, iv_rank=None):
     if game_master is None:
         game_master = GameMaster.CurrentInstance
 
     with open(filepath) as fd:
         pkm_list = load_pokemon(fd, filepath.split('.')[-1])
         pkm_list_filtered = []
-        for pkm in pkm_list:
-            if not set_stats(pkm, league, game_master):
+        for pkm in set_stats_batch(pkm_list, league, game_master, iv_rank):
+            if not pkm:
                 continue
             if not set_moves(pkm, game_master):
                 continue
@@ -217,31 +673,46 @@ def load_and_set_pokemon(filepath, league="master", game_master=None):
     return pkm_list_filtered
 
 
-def run_matrix(row_pkm, col_pkm=None, shield=-1, league="master", game_master=None):
+def run_matrix(row_pkm, col_pkm=None, shield=-1, league="master", game_master=None, workers=1, triangular=False,
+               cache=None, iv_rank=None, labeled=False):
     '''
     create and run Battle Matrix.
 
     @param row_pkm path to a Pokemon list file
     @param col_pkm path to a Pokemon list file
     @param shield shield setting
-    @return matrix as 2D list
+    @param workers number of worker processes. If more than 1, the matrix is run in tiles in parallel
+    @param triangular if True (and @param col_pkm is omitted), only simulate i <= j and mirror the other half
+    @param cache MatchupCache (or path to one). If set, only matchups missing in the cache are simulated
+    @param iv_rank if set, use the IVs of this stat product rank in the league
+    @param labeled if True, return a BattleMatrix labeled by Pokemon
+    @return matrix as 2D list, or BattleMatrix
     '''
     if game_master is None:
         game_master = GameMaster.CurrentInstance
 
-    row_pkm = load_and_set_pokemon(row_pkm, league, game_master)
+    if triangular and col_pkm is not None:
+        raise Exception("triangular mode requires col Pokemon to be omitted")
+
+    row_pkm = load_and_set_pokemon(row_pkm, league, game_master, iv_rank)
     if col_pkm is not None:
-        col_pkm = load_and_set_pokemon(col_pkm, league, game_master)
+        col_pkm = load_and_set_pokemon(col_pkm, league, game_master, iv_rank)
     else:
         col_pkm = []
 
-    return do_run_matrix(row_pkm, col_pkm, shield)
+    matrix = run_pokemon_matrix(row_pkm, col_pkm, shield, game_master.to_json(), workers, triangular, cache)
+    if labeled:
+        return BattleMatrix.from_pokemon(matrix, row_pkm, col_pkm)
+    return matrix
 
 
+@Profile.profiled("matrix.save")
 def save_matrix(matrix, file, fmt="csv"):
     '''
-    save battle matrix @param matrix to file @file with format @param fmt
+    save battle matrix @param matrix (2D list or array) to file @file with format @param fmt
     '''
+    if isinstance(matrix, np.ndarray) and fmt != "npy":
+        matrix = matrix.tolist()
     if fmt == "tsv":
         writer = csv.writer(file, dialect="excel-tab")
         writer.writerows(matrix)
@@ -250,10 +721,268 @@ def save_matrix(matrix, file, fmt="csv"):
         writer.writerows(matrix)
     elif fmt == "json":
         json.dump(matrix, file)
+    elif fmt == "npy":
+        # float32, as BattleMatrix, so that BattleMatrix.open() memory-maps it as is
+        np.save(file, np.asarray(matrix, dtype=np.float32))
+    else:
+        raise Exception("bad format {}".format(fmt))
+
+
+@Profile.profiled("matrix.save")
+def save_matrix_blocks(blocks, file, fmt="csv", shape=None):
+    '''
+    save battle matrix to file @file with format @param fmt as its row blocks are produced.
+
+    @param blocks iterable of (first row index, block as 2D array), such as from iter_matrix_blocks
+    @param shape shape of the whole matrix, required for "npy" format (then @param file must be binary)
+    '''
+    if fmt == "tsv" or fmt == "csv":
+        writer = csv.writer(file, dialect="excel-tab" if fmt == "tsv" else "excel")
+        for i, block in blocks:
+            writer.writerows(block.tolist())
+    elif fmt == "json":
+        # Same layout as json.dump of the whole matrix
+        file.write("[")
+        for i, block in blocks:
+            for k, row in enumerate(block.tolist()):
+                if i + k > 0:
+                    file.write(", ")
+                file.write(json.dumps(row))
+        file.write("]")
+    elif fmt == "npy":
+        if shape is None:
+            raise Exception("matrix shape is required for npy format")
+        np.lib.format.write_array_header_1_0(file, {
+            "descr": np.lib.format.dtype_to_descr(np.dtype(np.float32)),
+            "fortran_order": False,
+            "shape": tuple(shape)
+        })
+        for i, block in blocks:
+            file.write(np.ascontiguousarray(block, dtype=np.float32).tobytes())
     else:
         raise Exception("bad format {}".format(fmt))
 
 
+@Profile.profiled("matrix.save")
+def save_shield_tensor(tensor, file, fmt="csv", row_pkm=None, col_pkm=[]):
+    '''
+    save shield tensor @param tensor to file @file with format @param fmt.
+
+    csv and tsv have one line per matchup (row-major) with the scores of the shield scenarios
+    0v0, 0v1, ..., 2v2; json is the nested list and npy the array.
+    npz also keeps the shield-averaged matrix as "values" and the labels of @param row_pkm and @param col_pkm,
+    so that BattleMatrix.load() reads it as the averaged matrix.
+    '''
+    tensor = np.asarray(tensor, dtype=np.float64)
+    if fmt == "tsv" or fmt == "csv":
+        writer = csv.writer(file, dialect="excel-tab" if fmt == "tsv" else "excel")
+        writer.writerows(tensor.reshape(tensor.shape[0] * tensor.shape[1], -1).tolist())
+    elif fmt == "json":
+        json.dump(tensor.tolist(), file)
+    elif fmt == "npy":
+        np.save(file, tensor)
+    elif fmt == "npz":
+        matrix = BattleMatrix.from_pokemon(shield_average(tensor), row_pkm or [], col_pkm)
+        np.savez(file, values=matrix.values, row_labels=matrix.row_labels, col_labels=matrix.col_labels,
+                 shield_tensor=tensor.astype(np.float32))
+    else:
+        raise Exception("bad format {}".format(fmt))
+
+
+def pokemon_label(pkm):
+    '''
+    Return the label of battle-ready Pokemon @param pkm in a BattleMatrix: "name fmove/cmove[/cmove2]".
+    '''
+    fmove = pkm.get("fmove")
+    if type(fmove) is dict:
+        fmove = fmove.get("name")
+    cmoves = sorted(move.get("name", "") if type(move) is dict else str(move)
+                    for move in pkm.get("cmoves", []))
+    return "{} {}".format(pkm.get("name", ""), "/".join([str(fmove)] + cmoves))
+
+
+class BattleMatrix:
+    '''
+    Battle matrix as a float32 NumPy array, with a label per row and per col.
+    '''
+
+    def __init__(self, values, row_labels=None, col_labels=None):
+        '''
+        @param values 2D array-like of battle scores
+        @param row_labels labels of the rows. Default to row indexes
+        @param col_labels labels of the cols. Default to @param row_labels for a square matrix, else col indexes
+        '''
+        if isinstance(values, np.ndarray) and values.dtype == np.float32:
+            self.values = values
+        else:
+            self.values = np.asarray(values, dtype=np.float32)
+        if self.values.ndim != 2:
+            self.values = self.values.reshape(len(self.values), -1)
+        n_rows, n_cols = self.values.shape
+        if row_labels is None:
+            row_labels = [str(i) for i in range(n_rows)]
+        if col_labels is None:
+            col_labels = row_labels if n_rows == n_cols else [str(j) for j in range(n_cols)]
+        self.row_labels = np.asarray(row_labels, dtype=str)
+        self.col_labels = np.asarray(col_labels, dtype=str)
+        if len(self.row_labels) != n_rows or len(self.col_labels) != n_cols:
+            raise ValueError("labels do not match matrix shape {}".format(self.values.shape))
+        self._row_index = None
+        self._col_index = None
+
+    @staticmethod
+    def from_pokemon(values, row_pkm, col_pkm=[]):
+        '''
+        Create a BattleMatrix of @param values labeled by row Pokemon @param row_pkm and col Pokemon @param col_pkm.
+        '''
+        row_labels = [pokemon_label(pkm) for pkm in row_pkm]
+        col_labels = [pokemon_label(pkm) for pkm in col_pkm] if col_pkm else row_labels
+        return BattleMatrix(values, row_labels, col_labels)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def __len__(self):
+        return len(self.values)
+
+    def __array__(self, dtype=None, copy=None):
+        return self.values if dtype is None else self.values.astype(dtype)
+
+    def _positions(self, key, axis):
+        if isinstance(key, str):
+            return [self._label_index(axis)[key]]
+        if isinstance(key, (int, np.integer)):
+            return [key]
+        if isinstance(key, slice):
+            return key
+        key = list(key)
+        if key and all(isinstance(k, str) for k in key):
+            index = self._label_index(axis)
+            return [index[k] for k in key]
+        return np.asarray(key)
+
+    def _label_index(self, axis):
+        if axis == 0:
+            if self._row_index is None:
+                self._row_index = {label: i for i, label in enumerate(self.row_labels)}
+            return self._row_index
+        if self._col_index is None:
+            self._col_index = {label: j for j, label in enumerate(self.col_labels)}
+        return self._col_index
+
+    def __getitem__(self, key):
+        '''
+        Index by position or label: m[row] or m[row, col], where each of row and col may be
+        an int, a label, a slice, or a list of ints or labels.
+        A single matchup gives a float, anything else a BattleMatrix.
+        '''
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        single = all(isinstance(k, (str, int, np.integer)) for k in (rows, cols))
+        rows = self._positions(rows, 0)
+        cols = self._positions(cols, 1)
+        if single:
+            return float(self.values[rows[0], cols[0]])
+        if isinstance(rows, slice) or isinstance(cols, slice):
+            values = self.values[rows, cols]
+        else:
+            values = self.values[np.ix_(rows, cols)]
+        return BattleMatrix(values, self.row_labels[rows], self.col_labels[cols])
+
+    def lookup(self, row_label, col_label):
+        '''
+        Return the score of row Pokemon @param row_label vs col Pokemon @param col_label.
+        '''
+        return self[row_label, col_label]
+
+    def aggregate(self, how="mean", axis=1):
+        '''
+        Aggregate the scores of each row (@param axis = 1) or each col (@param axis = 0).
+
+        @param how one of {"mean", "min", "max", "sum", "wins"}. "wins" is the fraction of positive scores
+        @return dict of label to aggregated score
+        '''
+        if how == "wins":
+            result = (self.values > 0).mean(axis=axis)
+        elif how in ("mean", "min", "max", "sum"):
+            result = getattr(self.values, how)(axis=axis, dtype=np.float64 if how in ("mean", "sum") else None)
+        else:
+            raise Exception("bad aggregation {}".format(how))
+        labels = self.row_labels if axis == 1 else self.col_labels
+        return dict(zip(labels.tolist(), result.tolist()))
+
+    def tolist(self):
+        return self.values.tolist()
+
+    def save(self, file, fmt=None):
+        '''
+        Save to @param file (path or binary file object) in format @param fmt, "npz" or "npy".
+        If omitted, the format is derived from the file name.
+        "npz" keeps values and labels in one file. Otherwise values are saved as ".npy",
+        with labels in a "<file>.labels.json" sidecar when @param file is a path.
+        '''
+        if fmt is None:
+            name = file if isinstance(file, str) else str(getattr(file, "name", ""))
+            fmt = "npz" if name.endswith(".npz") else "npy"
+        if fmt == "npz":
+            np.savez(file, values=self.values, row_labels=self.row_labels, col_labels=self.col_labels)
+            return
+        np.save(file, self.values)
+        if isinstance(file, str):
+            with open(BattleMatrix.labels_path(file), "w") as fd:
+                json.dump({"row_labels": self.row_labels.tolist(), "col_labels": self.col_labels.tolist()}, fd)
+
+    @staticmethod
+    def labels_path(file):
+        if not file.endswith(".npy"):
+            file += ".npy"
+        return file + ".labels.json"
+
+    @staticmethod
+    def load(file, mmap_mode=None):
+        '''
+        Load a BattleMatrix saved by save(). @param mmap_mode is passed to np.load for ".npy" files.
+        '''
+        name = file if isinstance(file, str) else str(getattr(file, "name", ""))
+        if name.endswith(".npz"):
+            with np.load(file) as data:
+                return BattleMatrix(data["values"], data["row_labels"], data["col_labels"])
+        values = np.load(file, mmap_mode=mmap_mode)
+        row_labels = col_labels = None
+        if isinstance(file, str) and os.path.isfile(BattleMatrix.labels_path(file)):
+            with open(BattleMatrix.labels_path(file)) as fd:
+                labels = json.load(fd)
+            row_labels, col_labels = labels["row_labels"], labels["col_labels"]
+        if values.dtype != np.float32:
+            # e.g. float64 npy written by earlier versions; this reads the whole file
+            values = values.astype(np.float32)
+        return BattleMatrix(values, row_labels, col_labels)
+
+    @staticmethod
+    def open(file):
+        '''
+        Open a ".npy" BattleMatrix read-only as a memory map, so single matchups can be read
+        without loading the whole file.
+        '''
+        return BattleMatrix.load(file, mmap_mode="r")
+
+
+def _collect_blocks(blocks, matrix):
+    for i, block in blocks:
+        matrix[i:i + len(block)] = block
+        yield i, block
+
+
+def save_matrix_ranking(matrix, file, row_pkm, col_pkm=[], method="auto", tol=1e-3, max_iter=None):
+    '''
+    rank the row Pokemon of battle matrix @param matrix (see Ranking.rank_matrix) and save the ranking
+    to path @param file, as json if it ends with ".json", else csv.
+    '''
+    ranking = Ranking.rank_matrix(BattleMatrix.from_pokemon(matrix, row_pkm, col_pkm), method, tol, max_iter)
+    with open(file, "w", newline="") as fd:
+        Ranking.save_ranking(ranking, fd, "json" if file.endswith(".json") else "csv")
+
+
 def main():
     parser = argparse.ArgumentParser()
 
@@ -263,38 +992,85 @@ def main():
                         help="path to a file containing list of Pokemon. If omitted, will be the same as row Pokemon")
     parser.add_argument("-s", "--shield", type=int, default=0,
                         help="shield strategy setting. -1 for average")
-    parser.add_argument("--league", choices=["great", "ultra", "master"], default="master",
-                        help="PvP league to decide Pokemon stats. If not set, will use raw Pokemon input")
+    parser.add_argument("--league", default="master",
+                        help="PvP league to decide Pokemon stats: one of {great, ultra, master}, or target cp. "
+                        "If not set, will use raw Pokemon input")
     parser.add_argument("-c", "--config", default="./GBS.json",
                         help="path to GBS game master json")
+    parser.add_argument("--iv-rank", type=int, default=None,
+                        help="use the IVs of this stat product rank in the league (1 being the best), "
+                        "instead of the first IVs that reach the league cp")
     parser.add_argument("--pokemon", action="store_true",
                         help="only output the parsed row Pokemon list")
     parser.add_argument("-z", "--minimize", action="store_true",
                         help="for Pokemon list, keeping only the necessary fields")
     parser.add_argument("--input", action="store_true",
                         help="only output the battle matrix simulation input")
-    parser.add_argument("-f", "--format", choices=["tsv", "csv", "json"], default=None,
+    parser.add_argument("-f", "--format", choices=["tsv", "csv", "json", "npy", "npz"], default=None,
                         help="matrix output format. If omitted, will derive from output filepath")
     parser.add_argument("-o", "--out",
                         help="file to store output matrix")
+    parser.add_argument("-j", "--workers", type=int, default=1,
+                        help="number of worker processes to run the matrix in parallel tiles")
+    parser.add_argument("-t", "--triangular", action="store_true",
+                        help="when col Pokemon is omitted, only simulate i <= j and mirror the other half (M[j][i] = -M[i][j]). "
+                             "Requires an engine with antisymmetric scores, such as the NumPy engine")
+    parser.add_argument("--cache", nargs="?", const="",
+                        help="only simulate matchups missing in the on-disk matchup cache. Optionally, path to the cache")
+    parser.add_argument("--cache-size", type=int, default=1024,
+                        help="maximum size of the matchup cache in MB")
+    parser.add_argument("-m", "--memory-limit", type=int, default=None,
+                        help="run the matrix in row blocks within this memory ceiling in MB, writing each block as it is done")
+    parser.add_argument("--block-rows", type=int, default=None,
+                        help="run the matrix in blocks of this many rows, writing each block as it is done")
+    parser.add_argument("--update", metavar="OLD_MATRIX",
+                        help="reuse the matchups of a previous labeled matrix (npz, or npy with labels) "
+                        "and only run those that are new or affected by game master changes")
+    parser.add_argument("--old-config", metavar="OLD_CONFIG",
+                        help="with --update, path to the GBS game master json the previous matrix was run with. "
+                        "If omitted, the game master is taken as unchanged")
+    parser.add_argument("--shield-tensor", action="store_true",
+                        help="run every shield scenario (0-2 vs 0-2 shields) in one job and output the scores "
+                        "of each matchup in each scenario instead of a matrix. Overrides --shield")
+    parser.add_argument("--ranking", metavar="FILE",
+                        help="also rank the row Pokemon by win rate, weighted win rate and Nash equilibrium meta share, "
+                        "and save the ranking to this file (csv, or json)")
+    Ranking.add_arguments(parser)
+    Profile.add_argument(parser)
     args = parser.parse_args()
+    Profile.start(args.profile)
 
     if args.out is None:
-        args.out = sys.stdout
-        args.format = args.format or "csv"
+        fmt = args.format or "csv"
+        args.out = sys.stdout.buffer if fmt in ("npy", "npz") else sys.stdout
     else:
-        args.out = open(args.out, "w", newline="")
-    
-    fmt = args.format
-    if fmt is None:
-        fmt = args.out.name.split(".")[-1]
+        fmt = args.format or args.out.split(".")[-1]
+        if fmt in ("npy", "npz"):
+            args.out = open(args.out, "wb")
+        else:
+            args.out = open(args.out, "w", newline="")
+
+    if args.triangular and args.col_pokemon is not None:
+        parser.error("--triangular requires col_pokemon to be omitted")
+    chunked = args.memory_limit is not None or args.block_rows is not None
+    if args.triangular and chunked:
+        parser.error("--triangular cannot be combined with --memory-limit or --block-rows")
+    if args.update is not None and (args.triangular or chunked):
+        parser.error("--update cannot be combined with --triangular, --memory-limit or --block-rows")
+    if args.old_config is not None and args.update is None:
+        parser.error("--old-config requires --update")
+    league = int(args.league) if args.league.isdigit() else args.league
+    if league not in ("great", "ultra", "master") and type(league) is not int:
+        parser.error("bad league {}".format(args.league))
+    if args.shield_tensor and (args.triangular or chunked or args.update is not None or args.cache is not None):
+        parser.error("--shield-tensor cannot be combined with --triangular, --memory-limit, --block-rows, "
+                     "--update or --cache")
 
     gm = GameMaster()
-    with open(args.config, encoding="utf8") as fd:
-        gm.from_json(json.load(fd))
+    gm.load_config(args.config)
     gm.apply()
 
-    row_pkm = load_and_set_pokemon(args.row_pokemon, args.league)
+    row_pkm = load_and_set_pokemon(args.row_pokemon, league, iv_rank=args.iv_rank)
     if args.minimize:
         row_pkm = minimize_pokemon(row_pkm)
 
@@ -303,7 +1079,7 @@ def main():
         return 0
 
     if args.col_pokemon is not None:
-        col_pkm = load_and_set_pokemon(args.col_pokemon, args.league)
+        col_pkm = load_and_set_pokemon(args.col_pokemon, league, iv_rank=args.iv_rank)
         if args.minimize:
             col_pkm = minimize_pokemon(col_pkm)
     else:
@@ -315,20 +1091,60 @@ def main():
         "colPokemon": col_pkm,
         "avergeByShield": args.shield != 0
     }
+    if args.shield_tensor:
+        del reqInput["avergeByShield"]
+        reqInput["shieldTensor"] = True
 
     if args.input:
         json.dump(reqInput, args.out, indent=4)
         return 0
 
-    if type(GBS) is Exception:
+    if isinstance(GBS, Exception):
         raise GBS
 
-    GBS.config(gm.to_json())
-    GBS.prepare(reqInput)
-    GBS.run()
-    matrix = GBS.collect()
+    if args.shield_tensor:
+        tensor = run_shield_tensor(row_pkm, col_pkm, gm.to_json(), args.workers)
+        save_shield_tensor(tensor, args.out, fmt, row_pkm, col_pkm)
+        if args.ranking is not None:
+            save_matrix_ranking(shield_average(tensor), args.ranking, row_pkm, col_pkm,
+                                args.nash, args.nash_tol, args.nash_iter)
+        return
+
+    cache = None
+    if args.cache is not None:
+        cache = MatchupCache(args.cache or None, args.cache_size << 20)
+
+    if args.update is not None:
+        diff = None
+        if args.old_config is not None:
+            diff = GameMaster.diff(GameMaster().load_config(args.old_config), gm)
+        matrix = update_matrix(BattleMatrix.load(args.update), row_pkm, col_pkm, args.shield, diff,
+                               gm.to_json(), args.workers, cache)
+    elif chunked:
+        memory_limit = None if args.memory_limit is None else args.memory_limit << 20
+        blocks = iter_matrix_blocks(row_pkm, col_pkm, args.shield, args.block_rows, memory_limit,
+                                    gm.to_json(), args.workers, cache)
+        if fmt != "npz" and args.ranking is None:
+            save_matrix_blocks(blocks, args.out, fmt, (len(row_pkm), len(col_pkm or row_pkm)))
+            return
+        # Labeled output and ranking need the whole matrix, but only as float32
+        matrix = np.empty((len(row_pkm), len(col_pkm or row_pkm)), dtype=np.float32)
+        if fmt != "npz":
+            save_matrix_blocks(_collect_blocks(blocks, matrix), args.out, fmt, matrix.shape)
+        else:
+            for i, block in blocks:
+                matrix[i:i + len(block)] = block
+    else:
+        matrix = run_pokemon_matrix(row_pkm, col_pkm, args.shield, gm.to_json(),
+                                    args.workers, args.triangular, cache)
+
+    if fmt == "npz":
+        BattleMatrix.from_pokemon(matrix, row_pkm, col_pkm).save(args.out, fmt)
+    elif not chunked:
+        save_matrix(matrix, args.out, fmt)
 
-    save_matrix(matrix, args.out, fmt)
+    if args.ranking is not None:
+        save_matrix_ranking(matrix, args.ranking, row_pkm, col_pkm, args.nash, args.nash_tol, args.nash_iter)
 
 
 if __name__ == "__main__":
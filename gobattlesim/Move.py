@@ -30,6 +30,6 @@ class Move:
         self.power = kwargs["power"]
         self.energy = kwargs["energy"]
         self.duration = kwargs["duration"]
-        self.dws = kwargs["dws"]
+        self.dws = kwargs.get("dws", 0)
         if "effect" in kwargs:
             self.effect = kwargs["effect"]
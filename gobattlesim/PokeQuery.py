@@ -4,13 +4,19 @@ This module provides PokeQuery, a scheme to search Pokemon/Move.
 '''
 
 import argparse
+import bisect
 import copy
 import csv
+import functools
 import itertools
 import json
 import sys
+import textwrap
+
+import numpy as np
 
 from .GameMaster import PoketypeList, GameMaster
+from . import Profile
 
 
 POKE_QUERY_LOGICAL_OPERATORS = {
@@ -101,14 +107,15 @@ def BasicPokeQuery(query_str, pkm=None, movetype="fast"):
     return predicate
 
 
-def PokeQuery(query_str, pkm=None, movetype="fast"):
+@functools.lru_cache(maxsize=1024)
+@Profile.profiled("pokequery.compile")
+def compile_query(query_str):
     '''
-    Create a PokeQuery from string @param query_str.
+    Compile PokeQuery string @param query_str into an AST.
     Supports logical operators and parenthesis.
 
-    @param pkm subject Pokemon. This parameter is needed if the entity to search is Move.
-    @param movetype used with searching Move
-    @return a callback/predicate that accepts one parameter (the entity to be examined).
+    @return nested tuples: ("or", lhs, rhs), ("and", lhs, rhs), ("not", operand),
+        ("term", basic query string), or ("false",) for an empty query
     '''
 
     global POKE_QUERY_LOGICAL_OPERATORS
@@ -133,27 +140,24 @@ def PokeQuery(query_str, pkm=None, movetype="fast"):
     vstack = []
     opstack = []
 
-    def default_pred(x):
-        return False
-
     def eval_simple(op, vstack):
         if OPS[op] == 0:
             if len(vstack) < 2:
                 raise Exception(f"missing operand for operator {op}")
             rhs = vstack.pop()
             lhs = vstack.pop()
-            vstack.append(lambda x: lhs(x) or rhs(x))
+            vstack.append(("or", lhs, rhs))
         elif OPS[op] == 1:
             if len(vstack) < 2:
                 raise Exception(f"missing operand for operator {op}")
             rhs = vstack.pop()
             lhs = vstack.pop()
-            vstack.append(lambda x: lhs(x) and rhs(x))
+            vstack.append(("and", lhs, rhs))
         elif OPS[op] == 2:
             if len(vstack) < 1:
                 raise Exception(f"missing operand for operator {op}")
             rhs = vstack.pop()
-            vstack.append(lambda x: not rhs(x))
+            vstack.append(("not", rhs))
 
     for tk in tokens:
         if tk in OPS:
@@ -169,106 +173,309 @@ def PokeQuery(query_str, pkm=None, movetype="fast"):
                     break
                 eval_simple(op, vstack)
         else:
-            vstack.append(BasicPokeQuery(tk, pkm=pkm, movetype=movetype))
+            vstack.append(("term", str(tk).lower().strip(" *")))
     while opstack:
         eval_simple(opstack.pop(), vstack)
 
-    return vstack.pop() if vstack else default_pred
+    return vstack.pop() if vstack else ("false",)
 
 
-def get_unique_pokemon(pkm_list):
+def _to_bitset(positions, size):
+    bitmap = bytearray((size + 7) // 8)
+    for i in positions:
+        bitmap[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(bitmap, "little")
+
+
+class QueryIndex:
     '''
-    remove duplicates where {cmove, cmove2} are the same set.
+    Bitset indexes over a list of Pokemon or moves, to evaluate compiled PokeQuery as set algebra.
+    Bit i of a bitset stands for the i-th entity.
     '''
-    unique_pkm_list = []
-    for pkm in pkm_list:
-        unique = True
-        for pkm2 in unique_pkm_list:
-            if set([pkm['cmove'], pkm.get('cmove2')]) == set([pkm2['cmove'], pkm2.get('cmove2')]):
-                unique = any([v != pkm2.get(k) for k, v in pkm.items()
-                              if k != 'cmove' and k != 'cmove2'])
-        if unique:
-            unique_pkm_list.append(pkm)
-    return unique_pkm_list
 
+    def __init__(self, entities):
+        self.entities = entities
+        self.size = len(entities)
+        self.full = (1 << self.size) - 1
+        self.positions_by_name = {}
+        positions_by_type = {}
+        positions_by_rarity = {}
+        dex_positions = []
+        for i, entity in enumerate(entities):
+            self.positions_by_name.setdefault(entity['name'], []).append(i)
+            for field in ['pokeType', 'pokeType1', 'pokeType2']:
+                if field in entity:
+                    positions_by_type.setdefault(entity[field], set()).add(i)
+            if 'rarity' in entity:
+                positions_by_rarity.setdefault(
+                    entity['rarity'], []).append(i)
+            if entity.get('dex') is not None:
+                dex_positions.append((entity['dex'], i))
+        self.by_type = {t: _to_bitset(p, self.size)
+                        for t, p in positions_by_type.items()}
+        self.by_rarity = {r: _to_bitset(p, self.size)
+                          for r, p in positions_by_rarity.items()}
+        dex_positions.sort()
+        self.sorted_dex = [dex for dex, i in dex_positions]
+        self.dex_order = [i for dex, i in dex_positions]
+        self.terms = {}
+
+    def bitset(self, positions):
+        return _to_bitset(positions, self.size)
+
+    def dex_range(self, min_dex, max_dex):
+        lo = bisect.bisect_left(self.sorted_dex, min_dex)
+        hi = bisect.bisect_right(self.sorted_dex, max_dex)
+        return self.bitset(self.dex_order[lo:hi])
+
+    def movepool(self, names):
+        return self.bitset([i for name in names for i in self.positions_by_name.get(name, [])])
+
+    def term(self, query_str, pkm=None, movetype="fast"):
+        '''
+        Return the bitset of entities matching basic query @param query_str (see BasicPokeQuery).
+        '''
+        if query_str == "":
+            if pkm is None:
+                return 0
+            return self.term("current", pkm, movetype) | self.term("legacy", pkm, movetype) | \
+                self.term("exclusive", pkm, movetype)
+        elif query_str == "current":
+            return self.movepool(pkm.get(movetype + "Moves", []))
+        elif query_str == "legacy":
+            return self.movepool(pkm.get(movetype + "Moves_legacy", []))
+        elif query_str == "exclusive":
+            return self.movepool(pkm.get(movetype + "Moves_exclusive", []))
+
+        # The other basic queries do not depend on the subject Pokemon, so they are cached
+        if query_str in self.terms:
+            return self.terms[query_str]
+        if query_str.isdigit():
+            bits = self.dex_range(int(query_str), int(query_str))
+        elif query_str[:3] == 'dex':
+            num_part = query_str[3:]
+            if '-' in num_part:
+                min_dex, max_dex = [int(v.strip())
+                                    for v in num_part.split('-')][:2]
+            else:
+                min_dex = max_dex = int(num_part)
+            bits = self.dex_range(min_dex, max_dex)
+        elif query_str in PoketypeList or query_str == 'none':
+            bits = self.by_type.get(query_str, 0)
+        elif query_str == "legendary":
+            bits = self.by_rarity.get("POKEMON_RARITY_LEGENDARY", 0)
+        elif query_str == "mythic" or query_str == "mythical":
+            bits = self.by_rarity.get("POKEMON_RARITY_MYTHIC", 0)
+        else:
+            bits = self.bitset([i for i, entity in enumerate(self.entities)
+                                if query_str in entity['name']])
+        self.terms[query_str] = bits
+        return bits
+
+    def evaluate(self, ast, pkm=None, movetype="fast"):
+        '''
+        Evaluate compiled PokeQuery @param ast into a bitset.
+        '''
+        op = ast[0]
+        if op == "term":
+            return self.term(ast[1], pkm, movetype)
+        elif op == "or":
+            return self.evaluate(ast[1], pkm, movetype) | self.evaluate(ast[2], pkm, movetype)
+        elif op == "and":
+            return self.evaluate(ast[1], pkm, movetype) & self.evaluate(ast[2], pkm, movetype)
+        elif op == "not":
+            return self.full & ~self.evaluate(ast[1], pkm, movetype)
+        return 0
 
-def batch_pokemon(pkm_qry, game_master: GameMaster):
+    def select(self, bits):
+        '''
+        Return the entities in bitset @param bits, in their original order.
+        '''
+        flags = np.unpackbits(np.frombuffer(bits.to_bytes((self.size + 7) // 8, "little"), dtype=np.uint8),
+                              count=self.size, bitorder="little")
+        return [self.entities[i] for i in np.flatnonzero(flags)]
+
+
+class CompiledPokeQuery:
+    '''
+    A compiled PokeQuery bound to a subject Pokemon.
+    Call it on an entity to test it, or select() the matches of a whole list at once.
     '''
-    Return a list of Pokemon-Move combinations that match the query input @param pkm_qry in GameMaster @param game_master.
 
-    @param pkm_qry is a dict, which may have the following fields:
+    def __init__(self, ast, pkm=None, movetype="fast"):
+        self.ast = ast
+        self.pkm = pkm
+        self.movetype = movetype
+        self._predicate = None
+
+    def __call__(self, entity):
+        if self._predicate is None:
+            self._predicate = self._build_predicate(self.ast)
+        return self._predicate(entity)
+
+    def _build_predicate(self, ast):
+        op = ast[0]
+        if op == "term":
+            return BasicPokeQuery(ast[1], pkm=self.pkm, movetype=self.movetype)
+        elif op == "or":
+            lhs, rhs = self._build_predicate(ast[1]), self._build_predicate(ast[2])
+            return lambda x: lhs(x) or rhs(x)
+        elif op == "and":
+            lhs, rhs = self._build_predicate(ast[1]), self._build_predicate(ast[2])
+            return lambda x: lhs(x) and rhs(x)
+        elif op == "not":
+            rhs = self._build_predicate(ast[1])
+            return lambda x: not rhs(x)
+        return lambda x: False
+
+    @Profile.profiled("pokequery.select")
+    def select(self, universe):
+        '''
+        Return all entities of @param universe that match this query, in order.
+
+        @param universe a list of entities, or an object with fields "entities" (the list)
+            and "cache" (a dict where the bitset indexes are kept for reuse)
+        '''
+        cache = getattr(universe, "cache", None)
+        if cache is None:
+            index = QueryIndex(list(universe))
+        else:
+            index = cache.get("query")
+            if index is None:
+                index = cache["query"] = QueryIndex(universe.entities)
+        return index.select(index.evaluate(self.ast, self.pkm, self.movetype))
 
-        name
-        fmove
-        cmove
-        [optional] cmove2
 
-    All fields must be str, and can be PokeQuery.
+def PokeQuery(query_str, pkm=None, movetype="fast"):
     '''
-    matches = []
+    Create a PokeQuery from string @param query_str.
+    Supports logical operators and parenthesis.
+    Compiled queries are cached by string.
+
+    @param pkm subject Pokemon. This parameter is needed if the entity to search is Move.
+    @param movetype used with searching Move
+    @return a CompiledPokeQuery, which is also a callback/predicate that accepts one parameter (the entity to be examined).
+    '''
+    return CompiledPokeQuery(compile_query(query_str), pkm, movetype)
+
+
+def _hashable(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, _hashable(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_hashable(v) for v in value)
+    return value
+
 
+def unique_pokemon_key(pkm):
+    '''
+    Return the dedup key of Pokemon @param pkm: the unordered {cmove, cmove2} pair plus all other fields.
+    '''
+    moves = frozenset([pkm.get('cmove'), pkm.get('cmove2')])
+    return moves, _hashable({k: v for k, v in pkm.items() if k != 'cmove' and k != 'cmove2'})
+
+
+def iter_unique_pokemon(pkm_iter):
+    '''
+    Yield the Pokemon of @param pkm_iter, skipping duplicates where {cmove, cmove2} are the same set.
+    '''
+    seen = set()
+    for pkm in pkm_iter:
+        key = unique_pokemon_key(pkm)
+        if key not in seen:
+            seen.add(key)
+            yield pkm
+
+
+def get_unique_pokemon(pkm_list):
+    '''
+    remove duplicates where {cmove, cmove2} are the same set.
+    '''
+    return list(iter_unique_pokemon(pkm_list))
+
+
+def iter_batch_pokemon(pkm_qry, game_master: GameMaster):
+    '''
+    Generate the Pokemon-Move combinations that match the query input @param pkm_qry in GameMaster @param game_master.
+    Combinations are produced lazily, species by species. See batch_pokemon for the query fields.
+    '''
     species_qry = pkm_qry["name"]
     fmove_qry = pkm_qry["fmove"]
     cmove_qry = pkm_qry["cmove"]
     cmove2_qry = pkm_qry.get("cmove2", "")
 
-    species_matches = []
-    fmove_matches = []
-    cmove_matches = []
-    cmove2_matches = []
-
     species_direct_match = game_master.search_pokemon(species_qry)
     if species_direct_match:
-        species_matches.append(species_direct_match)
+        species_matches = [species_direct_match]
     else:
         species_matches = game_master.search_pokemon(
             PokeQuery(species_qry), True)
 
-    for species in species_matches:
-        cur_matches = []
+    # Direct matches do not depend on the species
+    fmove_direct_match = game_master.search_pve_fmove(fmove_qry)
+    cmove_direct_match = game_master.search_pve_cmove(cmove_qry)
+    cmove2_direct_match = game_master.search_pve_cmove(cmove2_qry)
 
-        fmove_direct_match = game_master.search_pve_fmove(fmove_qry)
+    for species in species_matches:
         if fmove_direct_match:
-            fmove_matches.append(fmove_direct_match)
+            fmove_matches = [fmove_direct_match]
         else:
             fmove_matches = game_master.search_pve_fmove(
                 PokeQuery(fmove_qry, species, "fast"), True)
 
-        cmove_direct_match = game_master.search_pve_cmove(cmove_qry)
         if cmove_direct_match:
-            cmove_matches.append(cmove_direct_match)
+            cmove_matches = [cmove_direct_match]
         else:
             cmove_matches = game_master.search_pve_cmove(
                 PokeQuery(cmove_qry, species, "charged"), True)
 
-        cmove2_direct_match = game_master.search_pve_cmove(cmove2_qry)
         if cmove2_direct_match:
-            cmove2_matches.append(cmove2_direct_match)
+            cmove2_matches = [cmove2_direct_match]
         else:
             cmove2_matches = game_master.search_pve_cmove(
                 PokeQuery(cmove2_qry, species, "charged"), True)
 
+        base = copy.copy(pkm_qry)
+        for k in species:
+            base[k] = species[k]
+
+        # All combinations of a species share the other fields, so the move names make the dedup key
+        seen = set()
         for fmove, cmove in itertools.product(fmove_matches, cmove_matches):
-            pkm = copy.copy(pkm_qry)
-            for k in species:
-                pkm[k] = species[k]
-            pkm["fmove"] = fmove["name"]
-            pkm["cmove"] = cmove["name"]
             if cmove2_matches:
                 for cmove2 in cmove2_matches:
-                    if cmove2["name"] != cmove["name"]:
-                        pkm = copy.copy(pkm)
-                        pkm["cmove2"] = cmove2["name"]
-                        cur_matches.append(pkm)
+                    if cmove2["name"] == cmove["name"]:
+                        continue
+                    key = (fmove["name"], frozenset([cmove["name"], cmove2["name"]]))
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    pkm = copy.copy(base)
+                    pkm["fmove"] = fmove["name"]
+                    pkm["cmove"] = cmove["name"]
+                    pkm["cmove2"] = cmove2["name"]
+                    yield pkm
             else:
-                cur_matches.append(pkm)
+                pkm = copy.copy(base)
+                pkm["fmove"] = fmove["name"]
+                pkm["cmove"] = cmove["name"]
+                yield pkm
 
-        if cmove2_matches:
-            cur_matches = get_unique_pokemon(cur_matches)
 
-        matches.extend(cur_matches)
+def batch_pokemon(pkm_qry, game_master: GameMaster):
+    '''
+    Return a list of Pokemon-Move combinations that match the query input @param pkm_qry in GameMaster @param game_master.
 
-    return matches
+    @param pkm_qry is a dict, which may have the following fields:
+
+        name
+        fmove
+        cmove
+        [optional] cmove2
+
+    All fields must be str, and can be PokeQuery.
+    '''
+    return list(iter_batch_pokemon(pkm_qry, game_master))
 
 
 def main():
@@ -285,7 +492,9 @@ def main():
                         help="format of output. If omitted, will derive from output filepath")
     parser.add_argument("-o", "--out",
                         help="file to store output")
+    Profile.add_argument(parser)
     args = parser.parse_args()
+    Profile.start(args.profile)
 
     if args.out is None:
         args.out = sys.stdout
@@ -298,8 +507,7 @@ def main():
         fmt = args.out.name.split('.')[-1]
 
     gm = GameMaster()
-    with open(args.config, encoding="utf8") as fd:
-        gm.from_json(json.load(fd))
+    gm.load_config(args.config)
     gm.apply()
 
     fields = []
@@ -307,7 +515,7 @@ def main():
 
     if len(args.query) == 1:
         fields = ["name"]
-        matches = list(filter(PokeQuery(args.query[0]), gm.Pokemon))
+        matches = gm.search_pokemon(PokeQuery(args.query[0]), True)
     elif len(args.query) >= 3:
         fields = ["name", "fmove", "cmove"]
         pkm_qry = {
@@ -318,24 +526,27 @@ def main():
         if len(args.query) >= 4:
             fields.append("cmove2")
             pkm_qry["cmove2"] = args.query[3]
-        matches = batch_pokemon(pkm_qry, gm)
+        matches = iter_batch_pokemon(pkm_qry, gm)
     else:
         print("cannot query fast move but not primary charged move")
         return -2
 
-    number = len(matches)
     if args.number:
-        print(number)
-        return 0
-    if number == 0:
+        print(sum(1 for pkm in matches))
         return 0
 
+    # Matches are written as they are produced
+    matches = iter(matches)
+    first = next(matches, None)
+    if first is None:
+        return 0
     if args.verbose:
-        for attr in matches[0].keys():
+        for attr in first.keys():
             if attr not in fields:
                 fields.append(attr)
-    else:
-        matches = [{k: pkm[k] for k in fields} for pkm in matches]
+    matches = itertools.chain([first], matches)
+    if not args.verbose:
+        matches = ({k: pkm[k] for k in fields} for pkm in matches)
 
     if fmt == "tsv":
         writer = csv.DictWriter(args.out, fields, dialect="excel-tab")
@@ -346,7 +557,13 @@ def main():
         writer.writeheader()
         writer.writerows(matches)
     elif fmt == "json":
-        json.dump(matches, args.out, indent=4)
+        # Same layout as json.dump(list, indent=4), one element at a time
+        args.out.write("[\n")
+        for i, pkm in enumerate(matches):
+            if i > 0:
+                args.out.write(",\n")
+            args.out.write(textwrap.indent(json.dumps(pkm, indent=4), " " * 4))
+        args.out.write("\n]")
     else:
         raise Exception("bad format {}".format(fmt))
 
@@ -1,5 +1,8 @@
 
+import numpy as np
+
 from .GameMaster import GameMaster
+from . import Profile
 from .Move import Move
 
 ROLE_PVE_ATTACKER = "ae"
@@ -19,31 +22,77 @@ class Pokemon:
 
     @staticmethod
     def infer_cpm_and_IVs(bAtk, bDef, bStm, target_cp):
-        CPMultipliers = GameMaster.CurrentInstance.CPMultipliers
-        closest = None
-        closest_cp = 0
-        min_cpm_i = 0
-        max_cpm_i = len(CPMultipliers) - 1
-        while min_cpm_i < max_cpm_i:
-            if Pokemon.calc_cp(bAtk, bDef, bStm, CPMultipliers[min_cpm_i], 15, 15, 15) >= target_cp:
-                break
-            min_cpm_i += 1
-        while max_cpm_i > min_cpm_i:
-            if Pokemon.calc_cp(bAtk, bDef, bStm, CPMultipliers[max_cpm_i], 0, 0, 0) <= target_cp:
-                break
-            max_cpm_i -= 1
-        for cpm in CPMultipliers[min_cpm_i: max_cpm_i + 1]:
-            for stmiv in range(16):
-                for defiv in range(16):
-                    for atkiv in range(16):
-                        cp = Pokemon.calc_cp(
-                            bAtk, bDef, bStm, cpm, atkiv, defiv, stmiv)
-                        if cp == target_cp:
-                            return (cpm, atkiv, defiv, stmiv)
-                        elif closest_cp < cp and cp < target_cp:
-                            closest_cp = cp
-                            closest = (cpm, atkiv, defiv, stmiv)
-        return closest
+        '''
+        Find the first (cpm, atkiv, defiv, stmiv), in order of level, stmiv, defiv and atkiv,
+        that gives exactly @param target_cp, or else the one with the closest cp below it.
+        Return None if there is no such combination.
+        '''
+        cpm, atkiv, defiv, stmiv, found = Pokemon.infer_cpm_and_IVs_batch(
+            [bAtk], [bDef], [bStm], [target_cp])
+        if not found[0]:
+            return None
+        return (float(cpm[0]), int(atkiv[0]), int(defiv[0]), int(stmiv[0]))
+
+    @staticmethod
+    @Profile.profiled("pokemon.infer_ivs")
+    def infer_cpm_and_IVs_batch(bAtk, bDef, bStm, target_cp, chunk_size=1024):
+        '''
+        Batched version of infer_cpm_and_IVs() over arrays of base stats and target cp.
+        Levels are searched one at a time for all distinct inputs at once, computing the cp of
+        all IV combinations in one step, until each input has an exact match or runs out of levels.
+
+        @param chunk_size maximum number of inputs processed together
+        @return a tuple of arrays (cpm, atkiv, defiv, stmiv, found)
+        '''
+        CPMultipliers = np.asarray(GameMaster.CurrentInstance.CPMultipliers)
+        inputs = np.stack(np.broadcast_arrays(
+            bAtk, bDef, bStm, target_cp), axis=-1).astype(np.int64)
+        unique, inverse = np.unique(inputs.reshape(-1, 4), axis=0, return_inverse=True)
+        n, n_levels, n_ivs = len(unique), len(CPMultipliers), 16**3
+        ivs = np.arange(16)
+        target = unique[:, 3, None]
+
+        def calc_cp(base, cpm, atkiv, defiv, stmiv):
+            Atk = (base[:, 0, None] + atkiv) * cpm
+            Def = (base[:, 1, None] + defiv) * cpm
+            Stm = (base[:, 2, None] + stmiv) * cpm
+            return np.maximum(10, (Atk * np.sqrt(Def * Stm) / 10).astype(np.int64))
+
+        # Level range that can reach the target cp, as the loops of the scalar search did
+        levels = np.arange(n_levels)
+        reach = calc_cp(unique, CPMultipliers, 15, 15, 15) >= target
+        min_i = np.where(reach.any(axis=1), reach.argmax(axis=1), n_levels - 1)
+        below = (calc_cp(unique, CPMultipliers, 0, 0, 0) <= target) & (levels >= min_i[:, None])
+        max_i = np.where(below.any(axis=1),
+                         n_levels - 1 - below[:, ::-1].argmax(axis=1), min_i)
+
+        # IV combinations in search order: stmiv, defiv, atkiv
+        stmiv, defiv, atkiv = [a.reshape(-1) for a in np.meshgrid(ivs, ivs, ivs, indexing="ij")]
+
+        index = np.zeros(n, dtype=np.int64)
+        exact = np.zeros(n, dtype=bool)
+        closest_cp = np.zeros(n, dtype=np.int64)
+        for level in range(min_i.min(), max_i.max() + 1):
+            pending = np.flatnonzero(~exact & (min_i <= level) & (level <= max_i))
+            for i in range(0, len(pending), chunk_size):
+                chunk = pending[i:i + chunk_size]
+                cp = calc_cp(unique[chunk], CPMultipliers[level], atkiv, defiv, stmiv)
+                hit = cp == target[chunk]
+                has_exact = hit.any(axis=1)
+                closest = np.where(cp < target[chunk], cp, 0)
+                # Only strictly closer cp replaces the earlier candidate
+                closer = ~has_exact & (closest.max(axis=1) > closest_cp[chunk])
+                index[chunk[has_exact]] = level * n_ivs + hit[has_exact].argmax(axis=1)
+                index[chunk[closer]] = level * n_ivs + closest[closer].argmax(axis=1)
+                closest_cp[chunk[closer]] = closest[closer].max(axis=1)
+                exact[chunk[has_exact]] = True
+        found = exact | (closest_cp > 0)
+
+        inverse = inverse.reshape(-1)
+        index = index[inverse].reshape(inputs.shape[:-1])
+        found = found[inverse].reshape(inputs.shape[:-1])
+        level, stmiv, defiv, atkiv = np.unravel_index(index, (n_levels, 16, 16, 16))
+        return CPMultipliers[level], atkiv, defiv, stmiv, found
 
     def __init__(self, *args, **kwargs):
         '''
@@ -0,0 +1,195 @@
+'''
+This module provides lightweight stage timing, counters and peak memory sampling for the tools.
+
+Profiling is off unless enabled; then the stages of this package record their calls, wall time and the peak RSS
+at their end, and hooks are called with each finished stage:
+
+    profiler = Profile.enable()
+    profiler.add_hook(lambda record: print(record))
+    run_matrix(...)
+    print(profiler.report())
+'''
+
+import atexit
+import contextlib
+import functools
+import json
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+def peak_rss():
+    '''
+    Return the peak resident set size of this process in bytes, or None if unknown.
+    '''
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+class Profiler:
+    '''
+    Stage timers, counters and peak RSS samples of one profiling run.
+    '''
+
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+        self.hooks = []
+        self.start_time = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def add_hook(self, hook):
+        '''
+        Call @param hook with a dict {"stage", "seconds", "peak_rss"} each time a stage finishes.
+        '''
+        self.hooks.append(hook)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''
+        Time the enclosed code as stage @param name. A stage entered again from within itself counts once.
+        '''
+        active = getattr(self._local, "active", None)
+        if active is None:
+            active = self._local.active = set()
+        if name in active:
+            yield
+            return
+        active.add(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            active.discard(name)
+            rss = peak_rss()
+            with self._lock:
+                record = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0, "peak_rss": None})
+                record["calls"] += 1
+                record["seconds"] += seconds
+                record["peak_rss"] = rss
+            for hook in self.hooks:
+                hook({"stage": name, "seconds": seconds, "peak_rss": rss})
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        '''
+        Return the profile as a dict with fields "stages", "counters", "wall_seconds" and "peak_rss".
+        '''
+        with self._lock:
+            return {
+                "stages": {name: dict(record) for name, record in self.stages.items()},
+                "counters": dict(self.counters),
+                "wall_seconds": time.perf_counter() - self.start_time,
+                "peak_rss": peak_rss()
+            }
+
+    def format(self, fmt="text"):
+        '''
+        Return the report as text table (@param fmt = "text") or json (@param fmt = "json").
+        '''
+        report = self.report()
+        if fmt == "json":
+            return json.dumps(report, indent=4)
+
+        def mb(rss):
+            return "-" if rss is None else "{:.1f}".format(rss / (1 << 20))
+
+        lines = ["{:<28}{:>8}{:>12}{:>10}{:>16}".format("stage", "calls", "seconds", "%", "peak RSS (MB)")]
+        wall = report["wall_seconds"] or 1
+        for name, record in report["stages"].items():
+            lines.append("{:<28}{:>8}{:>12.4f}{:>10.1f}{:>16}".format(
+                name, record["calls"], record["seconds"], 100 * record["seconds"] / wall, mb(record["peak_rss"])))
+        for name, value in report["counters"].items():
+            lines.append("{:<28}{:>8}".format(name, value))
+        lines.append("{:<28}{:>8}{:>12.4f}{:>10}{:>16}".format(
+            "total", "", report["wall_seconds"], "", mb(report["peak_rss"])))
+        return "\n".join(lines)
+
+
+_profiler = None
+_null_stage = contextlib.nullcontext()
+
+
+def enable(profiler=None):
+    '''
+    Start recording into @param profiler (a new Profiler if omitted) and return it.
+    '''
+    global _profiler
+    _profiler = profiler or Profiler()
+    return _profiler
+
+
+def disable():
+    '''
+    Stop recording and return the Profiler that was recording, if any.
+    '''
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+
+def current():
+    return _profiler
+
+
+def stage(name):
+    '''
+    Context manager timing stage @param name, if profiling is enabled.
+    '''
+    if _profiler is None:
+        return _null_stage
+    return _profiler.stage(name)
+
+
+def count(name, n=1):
+    if _profiler is not None:
+        _profiler.count(name, n)
+
+
+def profiled(name):
+    '''
+    Decorator timing each call of the function as stage @param name, if profiling is enabled.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return func(*args, **kwargs)
+            with _profiler.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add_argument(parser):
+    '''
+    Add the "--profile" option to argparse @param parser.
+    '''
+    parser.add_argument("--profile", nargs="?", const="text", choices=["text", "json"], default=None,
+                        help="print a breakdown of time and memory by stage to stderr, as text (default) or json")
+
+
+def start(fmt, out=sys.stderr):
+    '''
+    If @param fmt (the "--profile" option) is set, enable profiling and print the report to @param out on exit.
+    '''
+    if fmt is None:
+        return None
+    profiler = enable()
+    atexit.register(lambda: print(profiler.format(fmt), file=out))
+    return profiler
@@ -6,6 +6,8 @@ Convert smogon pokemon data to Pokemon Go style data.
 import argparse
 import json
 
+from .GameMaster import GameMaster
+
 
 def toTitleCase(string):
     return ' '.join([w.capitalize() for w in string.split()])
@@ -302,8 +304,7 @@ def main():
         with open(fp) as F:
             smogon_pkm.extend(json.load(F))
 
-    with open(args.config) as F:
-        GBSData = json.load(F)
+    GBSData = GameMaster().load_config(args.config).to_json()
     fmoves, cmoves = loadMoveNames(GBSData)
 
     pkm_list = convertPokemon(smogon_pkm, fmoves, cmoves)
@@ -0,0 +1,444 @@
+'''
+This module provides a NumPy raid simulator: parties of attackers against a raid boss of a tier.
+
+Like the PvP simulator in VectorEngine, battles are simulated in lock-step: every (party, weather, trial) is a lane
+of a set of NumPy arrays, and each step resolves the next hit of every lane at once.
+
+The model follows the usual raid mechanics, simplified:
+    - damage is floor(0.5 * power * attack / defense * multipliers) + 1, with STAB, type effectiveness,
+      weather boost and (for attackers) the friendship bonus;
+    - a move deals its damage at its damage window start (dws) and the next move starts when it ends;
+    - attackers use their charged move whenever they have the energy, and never dodge;
+    - the boss waits a random delay after each move, and uses its charged move half of the time it can;
+    - both sides gain energy from their fast moves and from the damage they take;
+    - a fainted attacker is replaced by the next one of its party after the swap duration,
+      and the battle is lost when the party runs out or time runs out.
+Trials differ by the boss' random delays and move choices.
+'''
+
+import argparse
+import csv
+import sys
+
+import numpy as np
+
+from .Damage import damage, get_damage_table, pair_index, type_index
+from .GameMaster import GameMaster
+from .Matrix import load_pokemon
+from . import Profile
+
+
+# Weather name for no weather boost
+NO_WEATHER = "NONE"
+
+
+class RaidSettings:
+    '''
+    Battle constants the raid simulator needs, read from a GameMaster.
+    '''
+
+    def __init__(self, game_master, tier="5", friendship=0):
+        pve = game_master.PvEBattleSettings
+        self.max_energy = pve.get("maximumEnergy", 100)
+        self.energy_per_hp_lost = pve.get("energyDeltaPerHealthLost", 0.5)
+        self.swap_duration = pve.get("swapDurationMs", 1000)
+        self.boss_delay = 1000 * pve.get("enemyAttackInterval", 1.5)
+        self.friend_bonus = game_master.search_friend(friendship)
+        tier_setting = game_master.search_raid_tier(tier)
+        if tier_setting is None:
+            raise Exception("bad raid tier {}".format(tier))
+        self.tier = tier_setting
+        self.time_limit = tier_setting["timelimit"]
+        self.damage = get_damage_table(game_master, pve=True)
+        self.weathers = self.damage.weathers
+
+    def weather_index(self, weather):
+        '''
+        Return the index of @param weather in the damage table, or None for NO_WEATHER.
+        '''
+        return None if weather == NO_WEATHER else self.weathers.index(weather)
+
+
+def raid_boss(name, fmove, cmove, tier="5", game_master=None):
+    '''
+    Return the raid boss Pokemon @param name of raid tier @param tier with PvE moves @param fmove and @param cmove.
+    '''
+    if game_master is None:
+        game_master = GameMaster.CurrentInstance
+    species = game_master.search_pokemon(name)
+    if species is None:
+        raise Exception("Pokemon not found: {}".format(name))
+    tier_setting = game_master.search_raid_tier(str(tier))
+    if tier_setting is None:
+        raise Exception("bad raid tier {}".format(tier))
+    boss = {
+        "name": species["name"],
+        "pokeType1": species["pokeType1"],
+        "pokeType2": species["pokeType2"],
+        "attack": (species["baseAtk"] + 15) * tier_setting["cpm"],
+        "defense": (species["baseDef"] + 15) * tier_setting["cpm"],
+        "maxHP": tier_setting["maxHP"],
+        "fmove": game_master.search_pve_fmove(fmove),
+        "cmove": game_master.search_pve_cmove(cmove)
+    }
+    if boss["fmove"] is None or boss["cmove"] is None:
+        raise Exception("move not found: {} / {}".format(fmove, cmove))
+    return boss
+
+
+def set_raid_attacker(pkm, game_master=None, level=40):
+    '''
+    set the stats and PvE moves of raid attacker @param pkm, which has fields "name", "fmove" and "cmove"
+    (or "cmoves"), and optionally "level", "atkiv", "defiv" and "stmiv" (default to @param level and 15).
+
+    @return @param pkm, or None if the species or a move is not found
+    '''
+    if game_master is None:
+        game_master = GameMaster.CurrentInstance
+    if not all(stat in pkm for stat in ["pokeType1", "pokeType2", "attack", "defense", "maxHP"]):
+        species = game_master.search_pokemon(pkm["name"])
+        if species is None:
+            return None
+        cpm = game_master.search_cpm(pkm.get("level") or level)
+        ivs = [15 if pkm.get(iv) in (None, "") else int(pkm[iv]) for iv in ["atkiv", "defiv", "stmiv"]]
+        pkm["pokeType1"] = species["pokeType1"]
+        pkm["pokeType2"] = species["pokeType2"]
+        pkm["attack"] = (species["baseAtk"] + ivs[0]) * cpm
+        pkm["defense"] = (species["baseDef"] + ivs[1]) * cpm
+        pkm["maxHP"] = int((species["baseStm"] + ivs[2]) * cpm)
+    if type(pkm.get("fmove")) is not dict:
+        pkm["fmove"] = game_master.search_pve_fmove(pkm.get("fmove", ""))
+    if type(pkm.get("cmove")) is not dict:
+        cmove = pkm.get("cmove") or (pkm.get("cmoves") or [""])[0]
+        pkm["cmove"] = cmove if type(cmove) is dict else game_master.search_pve_cmove(cmove)
+    if pkm["fmove"] is None or pkm["cmove"] is None:
+        return None
+    return pkm
+
+
+class AttackerArrays:
+    '''
+    Per (attacker, weather) damage and move tables of raid attackers against one boss.
+    '''
+
+    def __init__(self, attackers, boss, weathers, settings):
+        n, w = len(attackers), len(weathers)
+        boss_pair = pair_index(type_index(boss["pokeType1"]), type_index(boss.get("pokeType2", "none")))
+        pairs = np.array([pair_index(type_index(pkm["pokeType1"]), type_index(pkm.get("pokeType2", "none")))
+                          for pkm in attackers], dtype=np.int64)
+        attack = np.array([pkm["attack"] for pkm in attackers], dtype=float)
+        defense = np.array([pkm["defense"] for pkm in attackers], dtype=float)
+
+        self.size = n
+        self.max_hp = np.array([pkm["maxHP"] for pkm in attackers], dtype=float)
+        # Move timing and energy; charged move energy is its (positive) cost
+        self.f_dws = np.array([pkm["fmove"].get("dws", 0) for pkm in attackers], dtype=float)
+        self.f_duration = np.array([pkm["fmove"]["duration"] for pkm in attackers], dtype=float)
+        self.f_energy = np.array([pkm["fmove"]["energy"] for pkm in attackers], dtype=float)
+        self.c_dws = np.array([pkm["cmove"].get("dws", 0) for pkm in attackers], dtype=float)
+        self.c_duration = np.array([pkm["cmove"]["duration"] for pkm in attackers], dtype=float)
+        self.c_cost = np.array([-pkm["cmove"]["energy"] for pkm in attackers], dtype=float)
+
+        # Damage by the attacker to the boss, and by the boss to the attacker, per weather
+        self.f_damage = np.empty((n, w))
+        self.c_damage = np.empty((n, w))
+        self.boss_f_damage = np.empty((n, w))
+        self.boss_c_damage = np.empty((n, w))
+        for k, weather in enumerate(weathers):
+            weather = settings.weather_index(weather)
+            for move, out in (("fmove", self.f_damage), ("cmove", self.c_damage)):
+                move_type = np.array([type_index(pkm[move]["pokeType"]) for pkm in attackers], dtype=np.int64)
+                power = np.array([pkm[move]["power"] for pkm in attackers], dtype=float)
+                mult = settings.damage.lookup(move_type, pairs, boss_pair, weather) * settings.friend_bonus
+                out[:, k] = damage(power, attack, boss["defense"], mult)
+            for move, out in (("fmove", self.boss_f_damage), ("cmove", self.boss_c_damage)):
+                mult = settings.damage.lookup(type_index(boss[move]["pokeType"]), boss_pair, pairs, weather)
+                out[:, k] = damage(boss[move]["power"], boss["attack"], defense, mult)
+
+
+class _Lanes:
+    '''
+    Per-lane state of a batch of raid battles.
+    '''
+
+    def __init__(self, parties, party_size, weather, boss, time_limit):
+        n = len(parties)
+        self.lane_id = np.arange(n)
+        self.parties = parties
+        self.party_size = party_size
+        self.weather = weather
+        self.member = np.zeros(n, dtype=int)
+        self.attacker = parties[:, 0]
+        self.hp = np.zeros(n)
+        self.energy = np.zeros(n)
+        # Time of the next hit of the attacker, whether it is a charged move, and when its move ends
+        self.att_hit = np.zeros(n)
+        self.att_charged = np.zeros(n, dtype=bool)
+        self.att_end = np.zeros(n)
+        self.boss_hp = np.full(n, float(boss["maxHP"]))
+        self.boss_energy = np.zeros(n)
+        self.boss_hit = np.zeros(n)
+        self.boss_charged = np.zeros(n, dtype=bool)
+        self.boss_end = np.zeros(n)
+        self.time_limit = time_limit
+
+    def compress(self, keep):
+        for name, value in self.__dict__.items():
+            if isinstance(value, np.ndarray) and value.shape[:1] == keep.shape:
+                setattr(self, name, value[keep])
+
+
+def _next_attacker_move(lanes, mask, arrays, start):
+    '''
+    Start the next move of the attacker in lanes @param mask at time @param start.
+    '''
+    a = lanes.attacker
+    charged = mask & (lanes.energy >= arrays.c_cost[a])
+    fast = mask & ~charged
+    lanes.energy -= np.where(charged, arrays.c_cost[a], 0)
+    lanes.att_charged = np.where(mask, charged, lanes.att_charged)
+    lanes.att_hit = np.where(charged, start + arrays.c_dws[a], np.where(fast, start + arrays.f_dws[a], lanes.att_hit))
+    lanes.att_end = np.where(charged, start + arrays.c_duration[a],
+                             np.where(fast, start + arrays.f_duration[a], lanes.att_end))
+
+
+def _next_boss_move(lanes, mask, boss, start, settings, rng):
+    '''
+    Start the next move of the boss in lanes @param mask at time @param start (before its random delay).
+    '''
+    start = start + settings.boss_delay + rng.uniform(0, 1000, len(start))
+    cost = -boss["cmove"]["energy"]
+    charged = mask & (lanes.boss_energy >= cost) & (rng.random(len(start)) < 0.5)
+    fast = mask & ~charged
+    lanes.boss_energy -= np.where(charged, cost, 0)
+    lanes.boss_charged = np.where(mask, charged, lanes.boss_charged)
+    lanes.boss_hit = np.where(charged, start + boss["cmove"].get("dws", 0),
+                              np.where(fast, start + boss["fmove"].get("dws", 0), lanes.boss_hit))
+    lanes.boss_end = np.where(charged, start + boss["cmove"]["duration"],
+                              np.where(fast, start + boss["fmove"]["duration"], lanes.boss_end))
+
+
+def simulate_lanes(arrays, boss, parties, party_size, weather, settings, rng):
+    '''
+    Simulate one raid battle per lane.
+
+    @param arrays AttackerArrays of the attackers
+    @param boss raid boss Pokemon (see raid_boss())
+    @param parties array of shape (lanes, max party size) of attacker indexes, in order of entry
+    @param party_size number of attackers of each lane's party
+    @param weather weather index (in the weathers of @param arrays) of each lane
+    @param settings RaidSettings
+    @param rng numpy random Generator
+    @return dict of per-lane arrays: "win", "time" (ms), "damage" (dealt to the boss) and "fainted"
+    '''
+    n = len(parties)
+    result = {
+        "win": np.zeros(n, dtype=bool),
+        "time": np.zeros(n),
+        "damage": np.zeros(n),
+        "fainted": np.zeros(n, dtype=int)
+    }
+    lanes = _Lanes(parties, party_size, weather, boss, settings.time_limit)
+    lanes.hp = arrays.max_hp[lanes.attacker].copy()
+    everyone = np.ones(n, dtype=bool)
+    _next_attacker_move(lanes, everyone, arrays, np.zeros(n))
+    _next_boss_move(lanes, everyone, boss, np.zeros(n), settings, rng)
+    max_energy = settings.max_energy
+
+    while len(lanes.lane_id):
+        a, w = lanes.attacker, lanes.weather
+        att_turn = lanes.att_hit <= lanes.boss_hit
+        boss_turn = ~att_turn
+        t = np.where(att_turn, lanes.att_hit, lanes.boss_hit)
+        timeout = t > settings.time_limit
+
+        # Attacker hits: energy from the fast move, and the boss gains energy from the damage
+        dmg = np.where(lanes.att_charged, arrays.c_damage[a, w], arrays.f_damage[a, w])
+        dmg = np.where(att_turn & ~timeout, np.minimum(dmg, np.maximum(lanes.boss_hp, 0)), 0)
+        lanes.boss_hp -= dmg
+        lanes.boss_energy = np.minimum(lanes.boss_energy + settings.energy_per_hp_lost * dmg, max_energy)
+        gain = np.where(att_turn & ~lanes.att_charged, arrays.f_energy[a], 0)
+        lanes.energy = np.minimum(lanes.energy + gain, max_energy)
+        _next_attacker_move(lanes, att_turn, arrays, lanes.att_end)
+
+        # Boss hits: the attacker gains energy from the damage
+        dmg = np.where(lanes.boss_charged, arrays.boss_c_damage[a, w], arrays.boss_f_damage[a, w])
+        dmg = np.where(boss_turn & ~timeout, dmg, 0)
+        lanes.hp -= dmg
+        lanes.energy = np.minimum(lanes.energy + settings.energy_per_hp_lost * dmg, max_energy)
+        gain = np.where(boss_turn & ~lanes.boss_charged, boss["fmove"]["energy"], 0)
+        lanes.boss_energy = np.minimum(lanes.boss_energy + gain, max_energy)
+        _next_boss_move(lanes, boss_turn, boss, lanes.boss_end, settings, rng)
+
+        # Fainted attackers are replaced by the next one of the party
+        fainted = (lanes.hp <= 0) & ~timeout
+        if fainted.any():
+            lanes.member += fainted
+            out = fainted & (lanes.member >= lanes.party_size)
+            swap = fainted & ~out
+            rows = np.arange(len(lanes.lane_id))
+            lanes.attacker = np.where(swap, lanes.parties[rows, np.minimum(lanes.member, lanes.parties.shape[1] - 1)],
+                                      lanes.attacker)
+            lanes.hp = np.where(swap, arrays.max_hp[lanes.attacker], lanes.hp)
+            lanes.energy = np.where(swap, 0, lanes.energy)
+            _next_attacker_move(lanes, swap, arrays, t + settings.swap_duration)
+
+        win = (lanes.boss_hp <= 0) & ~timeout
+        done = win | timeout | (lanes.member >= lanes.party_size)
+        if done.any():
+            ids = lanes.lane_id[done]
+            result["win"][ids] = win[done]
+            result["time"][ids] = np.minimum(t[done], settings.time_limit)
+            result["damage"][ids] = boss["maxHP"] - np.maximum(lanes.boss_hp[done], 0)
+            result["fainted"][ids] = lanes.member[done]
+            lanes.compress(~done)
+
+    return result
+
+
+@Profile.profiled("raid.simulate")
+def simulate_raid(parties, boss, settings, weathers=(NO_WEATHER,), trials=100, seed=None, batch_size=1 << 17):
+    '''
+    Simulate parties of raid attackers against a raid boss, in every weather, @param trials times each.
+
+    @param parties list of parties, each a list of battle-ready raid attackers (see set_raid_attacker())
+    @param boss raid boss Pokemon (see raid_boss())
+    @param settings RaidSettings
+    @param weathers weather names (NO_WEATHER for no weather boost)
+    @param trials number of battles per party and weather
+    @param seed seed of the random delays and move choices of the boss
+    @param batch_size maximum number of battles simulated at once
+    @return dict of arrays of shape (len(parties), len(weathers), trials):
+        "win", "time" (ms), "damage" (dealt to the boss) and "fainted" (number of fainted attackers)
+    '''
+    rng = np.random.default_rng(seed)
+    attackers = []
+    party_index = []
+    for party in parties:
+        party_index.append(list(range(len(attackers), len(attackers) + len(party))))
+        attackers.extend(party)
+    arrays = AttackerArrays(attackers, boss, weathers, settings)
+    max_size = max([len(party) for party in party_index] + [1])
+    party_table = np.array([party + [party[-1] if party else 0] * (max_size - len(party)) for party in party_index],
+                           dtype=int).reshape(len(parties), max_size)
+    party_size = np.array([len(party) for party in party_index], dtype=int)
+
+    shape = (len(parties), len(weathers), trials)
+    n_lanes = int(np.prod(shape))
+    results = {"win": np.zeros(n_lanes, dtype=bool), "time": np.zeros(n_lanes),
+               "damage": np.zeros(n_lanes), "fainted": np.zeros(n_lanes, dtype=int)}
+    for start in range(0, n_lanes, batch_size):
+        lane = np.arange(start, min(start + batch_size, n_lanes))
+        party, weather = lane // (len(weathers) * trials), lane // trials % len(weathers)
+        result = simulate_lanes(arrays, boss, party_table[party], party_size[party], weather, settings, rng)
+        for name, values in result.items():
+            results[name][lane] = values
+    return {name: values.reshape(shape) for name, values in results.items()}
+
+
+def summarize(results):
+    '''
+    Summarize the trials of simulate_raid() @param results.
+
+    @return dict of arrays of shape (parties, weathers): "win_rate", "dps" (damage per second to the boss),
+        "tdo" (total damage output) and "time_to_win" (mean ms of the won battles, NaN if none)
+    '''
+    seconds = np.maximum(results["time"], 1) / 1000
+    wins = results["win"].sum(axis=-1)
+    time_to_win = np.where(results["win"], results["time"], 0).sum(axis=-1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        time_to_win = np.where(wins > 0, time_to_win / wins, np.nan)
+    return {
+        "win_rate": results["win"].mean(axis=-1),
+        "dps": (results["damage"] / seconds).mean(axis=-1),
+        "tdo": results["damage"].mean(axis=-1),
+        "time_to_win": time_to_win
+    }
+
+
+def raid_counters(attackers, boss, settings, weathers=(NO_WEATHER,), party_size=6, trials=100, seed=None):
+    '''
+    Rank raid attackers by simulating a party of @param party_size copies of each against @param boss.
+
+    @return list of dict with fields "name", "fmove", "cmove", "weather", "win_rate", "dps", "tdo" and "time_to_win",
+        per attacker and weather, sorted by weather and then by descending dps
+    '''
+    summary = summarize(simulate_raid([[pkm] * party_size for pkm in attackers], boss, settings,
+                                      weathers, trials, seed))
+    rows = []
+    for k, weather in enumerate(weathers):
+        for i, pkm in enumerate(attackers):
+            rows.append({
+                "name": pkm["name"],
+                "fmove": pkm["fmove"]["name"],
+                "cmove": pkm["cmove"]["name"],
+                "weather": weather,
+                "win_rate": float(summary["win_rate"][i, k]),
+                "dps": float(summary["dps"][i, k]),
+                "tdo": float(summary["tdo"][i, k]),
+                "time_to_win": float(summary["time_to_win"][i, k])
+            })
+    rows.sort(key=lambda row: (weathers.index(row["weather"]), -row["dps"]))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("attackers",
+                        help="path to a file (csv, tsv or json) containing list of attackers with name, fmove and cmove")
+    parser.add_argument("--boss", nargs=3, required=True, metavar=("NAME", "FMOVE", "CMOVE"),
+                        help="raid boss and its moves")
+    parser.add_argument("--tier", default="5",
+                        help="raid tier")
+    parser.add_argument("-w", "--weather", action="append",
+                        help="weather to simulate in (repeatable), \"none\", or \"all\" for every weather. "
+                        "Default to none")
+    parser.add_argument("--friend", default="none",
+                        help="friendship level: none, good, great, ultra or best")
+    parser.add_argument("--level", type=float, default=40,
+                        help="level of attackers that do not set their own")
+    parser.add_argument("-p", "--party-size", type=int, default=6,
+                        help="number of copies of each attacker in its party")
+    parser.add_argument("-n", "--trials", type=int, default=100,
+                        help="number of battles per attacker and weather")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="random seed")
+    parser.add_argument("-c", "--config", default="./GBS.json",
+                        help="path to GBS configuration json")
+    parser.add_argument("-o", "--out", type=argparse.FileType('w'), default=sys.stdout,
+                        help="file to store output (csv)")
+    Profile.add_argument(parser)
+    args = parser.parse_args()
+    Profile.start(args.profile)
+
+    gm = GameMaster()
+    gm.load_config(args.config)
+    gm.apply()
+
+    settings = RaidSettings(gm, args.tier, args.friend)
+    weathers = []
+    for weather in args.weather or [NO_WEATHER]:
+        if weather.lower() == "all":
+            weathers.extend(settings.weathers)
+        elif weather.upper() == NO_WEATHER:
+            weathers.append(NO_WEATHER)
+        elif weather.upper() in settings.weathers:
+            weathers.append(weather.upper())
+        else:
+            parser.error("unknown weather {}".format(weather))
+
+    boss = raid_boss(*args.boss, args.tier, gm)
+    with open(args.attackers) as fd:
+        pkm_list = load_pokemon(fd, args.attackers.split('.')[-1])
+    attackers = [pkm for pkm in (set_raid_attacker(pkm, gm, args.level) for pkm in pkm_list) if pkm]
+
+    rows = raid_counters(attackers, boss, settings, weathers, args.party_size, args.trials, args.seed)
+    fields = ["name", "fmove", "cmove", "weather", "dps", "tdo", "time_to_win", "win_rate"]
+    writer = csv.DictWriter(args.out, fields)
+    writer.writeheader()
+    writer.writerows(rows)
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
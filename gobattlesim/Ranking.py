@@ -0,0 +1,403 @@
+'''
+This module ranks the Pokemon of a battle matrix: win rates, iterative weighted win rates and Nash equilibrium
+meta shares, computed as NumPy operations on the whole matrix.
+
+Scores are from the point of view of the row Pokemon (positive means the row Pokemon wins), so rankings treat
+the matrix as a zero-sum game where the row side maximizes and the col side minimizes:
+
+    ranking = rank_matrix(BattleMatrix.load("matrix.npz"))
+    save_ranking(ranking, open("ranking.csv", "w", newline=""))
+'''
+
+import argparse
+import csv
+import json
+import sys
+import warnings
+
+import numpy as np
+
+from . import Profile
+
+try:
+    from scipy.optimize import linprog
+except ImportError:
+    # Nash equilibria then fall back to regret matching
+    linprog = None
+
+
+NashMethods = ["auto", "lp", "rm", "fp"]
+
+# Default maximum number of iterations of the iterative Nash solvers
+NashMaxIter = {"rm": 10000, "fp": 100000}
+
+
+def win_matrix(values):
+    '''
+    Return the outcome of each matchup of @param values: 1 for a win, 0.5 for a tie and 0 for a loss.
+    '''
+    values = np.asarray(values)
+    dtype = values.dtype if values.dtype.kind == "f" else np.float64
+    return ((values > 0) + 0.5 * (values == 0)).astype(dtype)
+
+
+def win_rate(values):
+    '''
+    Return the fraction of matchups each row Pokemon wins (ties count half).
+    '''
+    return win_matrix(values).mean(axis=1, dtype=np.float64)
+
+
+class WeightedWinRate:
+    '''
+    Result of weighted_win_rate(): "row_rating" and "col_rating" (win rates weighted by the other side),
+    "row_weights" and "col_weights", "iterations", "delta" (L1 change of the last iteration) and "converged".
+    '''
+
+    def __init__(self, row_rating, col_rating, row_weights, col_weights, iterations, delta, converged):
+        self.row_rating = row_rating
+        self.col_rating = col_rating
+        self.row_weights = row_weights
+        self.col_weights = col_weights
+        self.iterations = iterations
+        self.delta = delta
+        self.converged = converged
+
+
+@Profile.profiled("ranking.weighted")
+def weighted_win_rate(values, tol=1e-6, max_iter=1000, smoothing=0.05):
+    '''
+    Rate each Pokemon by its win rate against the other side, weighting the opponents by their own rating,
+    until the weights converge.
+
+    Row ratings are the win rates of the rows weighted by col weights; col ratings are the rates of the cols
+    winning against the rows weighted by row weights; each side's weights are its ratings normalized to sum to 1.
+    For a square matrix of a Pokemon list against itself, both sides agree.
+
+    @param values battle matrix (2D array-like or BattleMatrix)
+    @param tol stop when the weights change by less than this (L1 norm). Matrices of float32 scores
+        are rated in float32, so do not go much below 1e-7
+    @param max_iter maximum number of iterations
+    @param smoothing share of uniform weights mixed into each update, which guarantees convergence
+    @return WeightedWinRate
+    '''
+    wins = win_matrix(values)
+    n_rows, n_cols = wins.shape
+    dtype = wins.dtype
+    row_weights = np.full(n_rows, 1 / n_rows)
+    col_weights = np.full(n_cols, 1 / n_cols)
+
+    def normalize(rating, n):
+        total = rating.sum()
+        weights = rating / total if total > 0 else np.full(n, 1 / n)
+        return (1 - smoothing) * weights + smoothing / n
+
+    delta = np.inf
+    iterations = 0
+    while iterations < max_iter and delta >= tol:
+        iterations += 1
+        row_rating = (wins @ col_weights.astype(dtype)).astype(np.float64)
+        new_row_weights = normalize(row_rating, n_rows)
+        col_rating = 1 - (new_row_weights.astype(dtype) @ wins).astype(np.float64)
+        new_col_weights = normalize(col_rating, n_cols)
+        delta = np.abs(new_row_weights - row_weights).sum() + np.abs(new_col_weights - col_weights).sum()
+        row_weights, col_weights = new_row_weights, new_col_weights
+
+    if delta >= tol:
+        warnings.warn("weighted win rates did not converge: change {:g} after {} iterations".format(delta, iterations))
+    row_rating = (wins @ col_weights.astype(dtype)).astype(np.float64)
+    col_rating = 1 - (row_weights.astype(dtype) @ wins).astype(np.float64)
+    return WeightedWinRate(row_rating, col_rating, row_weights, col_weights, iterations, delta, delta < tol)
+
+
+class Equilibrium:
+    '''
+    Result of nash_equilibrium(): "row_strategy" and "col_strategy" (meta shares of each side), "value" (the
+    expected score of the row side), "gap" (how much a side could gain by deviating; 0 at an exact equilibrium),
+    "iterations", "method" and "converged".
+    '''
+
+    def __init__(self, row_strategy, col_strategy, value, gap, iterations, method, converged):
+        self.row_strategy = row_strategy
+        self.col_strategy = col_strategy
+        self.value = value
+        self.gap = gap
+        self.iterations = iterations
+        self.method = method
+        self.converged = converged
+
+
+def equilibrium_gap(payoff, row_strategy, col_strategy):
+    '''
+    Return the duality gap of mixed strategies in zero-sum game @param payoff:
+    best response value against @param col_strategy minus best response value against @param row_strategy.
+    '''
+    payoff = np.asarray(payoff)
+    best_row = (payoff @ col_strategy.astype(payoff.dtype)).max()
+    best_col = (row_strategy.astype(payoff.dtype) @ payoff).min()
+    return float(best_row) - float(best_col)
+
+
+def regret_matching(payoff, tol=1e-3, max_iter=10000, check_every=10):
+    '''
+    Approximate the Nash equilibrium of zero-sum game @param payoff (row player maximizes) by alternating
+    regret matching+: each side plays in proportion to its positive cumulative regrets, and the strategies
+    are averaged with weights growing linearly with the iteration. An iteration is two matrix-vector products;
+    the duality gap usually falls below 1e-3 within a few thousand iterations, even on large matrices.
+
+    @param tol stop when the duality gap of the average strategies is below this
+    @param max_iter maximum number of iterations
+    @param check_every number of iterations between two computations of the duality gap
+    @return Equilibrium
+    '''
+    payoff = np.asarray(payoff)
+    dtype = payoff.dtype
+    n_rows, n_cols = payoff.shape
+    payoff_t = np.ascontiguousarray(payoff.T)
+    row_strategy = np.full(n_rows, 1 / n_rows)
+    col_strategy = np.full(n_cols, 1 / n_cols)
+    row_regrets = np.zeros(n_rows)
+    col_regrets = np.zeros(n_cols)
+    row_average = np.zeros(n_rows)
+    col_average = np.zeros(n_cols)
+
+    def strategy(regrets):
+        total = regrets.sum()
+        return regrets / total if total > 0 else np.full(len(regrets), 1 / len(regrets))
+
+    gap = np.inf
+    iterations = 0
+    while iterations < max_iter:
+        iterations += 1
+        row_payoffs = (payoff @ col_strategy.astype(dtype)).astype(np.float64)
+        row_regrets = np.maximum(row_regrets + row_payoffs - row_strategy @ row_payoffs, 0)
+        row_strategy = strategy(row_regrets)
+        # The col side minimizes the score
+        col_payoffs = -(payoff_t @ row_strategy.astype(dtype)).astype(np.float64)
+        col_regrets = np.maximum(col_regrets + col_payoffs - col_strategy @ col_payoffs, 0)
+        col_strategy = strategy(col_regrets)
+        row_average += iterations * row_strategy
+        col_average += iterations * col_strategy
+        if iterations % check_every == 0 or iterations == max_iter:
+            gap = equilibrium_gap(payoff, row_average / row_average.sum(), col_average / col_average.sum())
+            if gap < tol:
+                break
+
+    row_strategy = row_average / row_average.sum()
+    col_strategy = col_average / col_average.sum()
+    value = float(row_strategy.astype(dtype) @ payoff @ col_strategy.astype(dtype))
+    return Equilibrium(row_strategy, col_strategy, value, gap, iterations, "rm", gap < tol)
+
+
+def fictitious_play(payoff, tol=1e-3, max_iter=100000):
+    '''
+    Approximate the Nash equilibrium of zero-sum game @param payoff (row player maximizes) by alternating
+    fictitious play: each side repeatedly plays its best response to the empirical mix of the other side.
+    Running payoffs are updated by one row or col per iteration, so an iteration is O(rows + cols),
+    but the gap shrinks slowly: regret_matching() reaches small gaps much sooner.
+
+    @param tol stop when the duality gap of the empirical mixes is below this
+    @param max_iter maximum number of iterations
+    @return Equilibrium
+    '''
+    payoff = np.asarray(payoff)
+    n_rows, n_cols = payoff.shape
+    # Cols are read once per iteration, so keep them contiguous
+    payoff_t = np.ascontiguousarray(payoff.T)
+    row_counts = np.zeros(n_rows)
+    col_counts = np.zeros(n_cols)
+    # Total payoff of each row against the col plays so far, and of each col against the row plays so far
+    row_totals = np.zeros(n_rows)
+    col_totals = np.zeros(n_cols)
+
+    # Start from the col Pokemon that does best against a uniform row mix
+    j = int(np.argmin(payoff.mean(axis=0, dtype=np.float64)))
+    col_counts[j] += 1
+    row_totals += payoff_t[j]
+    gap = np.inf
+    iterations = 0
+    while iterations < max_iter:
+        iterations += 1
+        i = int(np.argmax(row_totals))
+        row_counts[i] += 1
+        col_totals += payoff[i]
+        j = int(np.argmin(col_totals))
+        col_counts[j] += 1
+        row_totals += payoff_t[j]
+        # Bounds of the game value: best row response to the col mix, best col response to the row mix
+        gap = row_totals.max() / (iterations + 1) - col_totals.min() / iterations
+        if gap < tol:
+            break
+
+    row_strategy = row_counts / row_counts.sum()
+    col_strategy = col_counts / col_counts.sum()
+    value = float(row_strategy.astype(payoff.dtype) @ payoff @ col_strategy.astype(payoff.dtype))
+    gap = equilibrium_gap(payoff, row_strategy, col_strategy)
+    return Equilibrium(row_strategy, col_strategy, value, gap, iterations, "fp", gap < tol)
+
+
+def nash_lp(payoff):
+    '''
+    Solve the Nash equilibrium of zero-sum game @param payoff (row player maximizes) exactly as a linear program:
+    maximize v such that the row mix scores at least v against every col. Requires scipy.
+
+    @return Equilibrium
+    '''
+    if linprog is None:
+        raise Exception("scipy is required for the linear programming solver")
+    payoff = np.asarray(payoff, dtype=np.float64)
+    n_rows, n_cols = payoff.shape
+    # Variables: row strategy, then v. Minimize -v
+    c = np.zeros(n_rows + 1)
+    c[-1] = -1
+    a_ub = np.hstack([-payoff.T, np.ones((n_cols, 1))])
+    a_eq = np.ones((1, n_rows + 1))
+    a_eq[0, -1] = 0
+    result = linprog(c, A_ub=a_ub, b_ub=np.zeros(n_cols), A_eq=a_eq, b_eq=[1],
+                     bounds=[(0, None)] * n_rows + [(None, None)], method="highs")
+    if result.status != 0:
+        raise Exception("linear programming failed: {}".format(result.message))
+    row_strategy = np.maximum(result.x[:n_rows], 0)
+    row_strategy /= row_strategy.sum()
+    # The col strategy is the dual of the col constraints
+    col_strategy = np.maximum(-result.ineqlin.marginals, 0)
+    col_strategy = col_strategy / col_strategy.sum() if col_strategy.sum() > 0 else np.full(n_cols, 1 / n_cols)
+    gap = equilibrium_gap(payoff, row_strategy, col_strategy)
+    return Equilibrium(row_strategy, col_strategy, float(result.x[-1]), gap, int(result.nit), "lp", True)
+
+
+@Profile.profiled("ranking.nash")
+def nash_equilibrium(values, method="auto", tol=1e-3, max_iter=None):
+    '''
+    Return the Nash equilibrium meta shares of battle matrix @param values, as the zero-sum game
+    where the row side maximizes the score.
+
+    @param method "lp" (exact, requires scipy), "rm" (regret matching), "fp" (fictitious play),
+        or "auto" for "lp" if scipy is available and "rm" otherwise
+    @param tol, max_iter convergence settings of the iterative solvers. @param max_iter defaults to NashMaxIter
+    @return Equilibrium
+    '''
+    if method not in NashMethods:
+        raise Exception("bad method {}".format(method))
+    values = np.asarray(values)
+    if values.dtype.kind != "f":
+        values = values.astype(np.float64)
+    if method == "auto":
+        method = "lp" if linprog is not None else "rm"
+    if method == "lp":
+        return nash_lp(values)
+    if max_iter is None:
+        max_iter = NashMaxIter[method]
+    solve = regret_matching if method == "rm" else fictitious_play
+    equilibrium = solve(values, tol, max_iter)
+    if not equilibrium.converged:
+        warnings.warn("Nash equilibrium did not converge: gap {:g} after {} iterations. Install scipy "
+                      "(pip install gobattlesim[lp]) to solve it exactly".format(equilibrium.gap, equilibrium.iterations))
+    return equilibrium
+
+
+class MatrixRanking(list):
+    '''
+    Result of rank_matrix(): list of dict {"label", "score", "win_rate", "weighted_win_rate", "nash_share"},
+    with the solver results "weighted" (WeightedWinRate) and "nash" (Equilibrium), and "converged"
+    if both solvers converged.
+    '''
+
+    def __init__(self, rows, weighted, nash):
+        list.__init__(self, rows)
+        self.weighted = weighted
+        self.nash = nash
+        self.converged = bool(weighted.converged and nash.converged)
+
+
+def rank_matrix(matrix, method="auto", tol=1e-3, max_iter=None):
+    '''
+    Rank the row Pokemon of @param matrix (BattleMatrix, or 2D array-like labeled by position).
+
+    @param method, tol, max_iter settings of the Nash equilibrium solver
+    @return MatrixRanking, sorted by weighted win rate, best first
+    '''
+    values = np.asarray(matrix)
+    if values.dtype.kind != "f":
+        values = values.astype(np.float64)
+    labels = getattr(matrix, "row_labels", None)
+    if labels is None:
+        labels = [str(i) for i in range(len(values))]
+    score = values.mean(axis=1, dtype=np.float64)
+    rate = win_rate(values)
+    weighted = weighted_win_rate(values)
+    nash = nash_equilibrium(values, method, tol, max_iter)
+    ranking = [{
+        "label": str(label),
+        "score": float(score[i]),
+        "win_rate": float(rate[i]),
+        "weighted_win_rate": float(weighted.row_rating[i]),
+        "nash_share": float(nash.row_strategy[i])
+    } for i, label in enumerate(labels)]
+    ranking.sort(key=lambda row: -row["weighted_win_rate"])
+    return MatrixRanking(ranking, weighted, nash)
+
+
+RankingFields = ["label", "score", "win_rate", "weighted_win_rate", "nash_share"]
+
+
+@Profile.profiled("ranking.save")
+def save_ranking(ranking, file, fmt="csv"):
+    '''
+    save @param ranking (from rank_matrix) to file @param file with format @param fmt.
+    '''
+    if fmt == "tsv" or fmt == "csv":
+        writer = csv.DictWriter(file, RankingFields, dialect="excel-tab" if fmt == "tsv" else "excel")
+        writer.writeheader()
+        writer.writerows(ranking)
+    elif fmt == "json":
+        json.dump(ranking, file, indent=4)
+    else:
+        raise Exception("bad format {}".format(fmt))
+
+
+def add_arguments(parser):
+    '''
+    Add the options of the Nash equilibrium solver to argparse @param parser.
+    '''
+    parser.add_argument("--nash", choices=NashMethods, default="auto",
+                        help="Nash equilibrium solver: linear programming (requires scipy), regret matching, "
+                        "fictitious play, or auto for linear programming if scipy is available and regret matching "
+                        "otherwise")
+    parser.add_argument("--nash-tol", type=float, default=1e-3,
+                        help="regret matching and fictitious play stop when the duality gap is below this")
+    parser.add_argument("--nash-iter", type=int, default=None,
+                        help="maximum number of regret matching or fictitious play iterations. Default to {}".format(
+                            ", ".join("{} for {}".format(n, m) for m, n in NashMaxIter.items())))
+
+
+def main():
+    # Imported here, as Matrix uses this module for its ranking output
+    from .Matrix import BattleMatrix
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("matrix",
+                        help="path to a labeled battle matrix (npz, or npy with labels)")
+    add_arguments(parser)
+    parser.add_argument("-f", "--format", choices=["tsv", "csv", "json"], default=None,
+                        help="output format. If omitted, will derive from output filepath")
+    parser.add_argument("-o", "--out",
+                        help="file to store the ranking")
+    Profile.add_argument(parser)
+    args = parser.parse_args()
+    Profile.start(args.profile)
+
+    if args.out is None:
+        fmt = args.format or "csv"
+        out = sys.stdout
+    else:
+        fmt = args.format or args.out.split(".")[-1]
+        out = open(args.out, "w", newline="")
+
+    with Profile.stage("ranking.load"):
+        matrix = BattleMatrix.load(args.matrix)
+    save_ranking(rank_matrix(matrix, args.nash, args.nash_tol, args.nash_iter), out, fmt)
+
+
+if __name__ == "__main__":
+    main()
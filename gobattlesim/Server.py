@@ -0,0 +1,352 @@
+'''
+This module provides a long-running simulation server that keeps a parsed Game Master and a configured engine warm.
+
+Clients connect over a Unix or TCP socket and send one JSON job per line. Each job gets one JSON response line:
+
+    {"id": <job id>, "ok": true, "result": ...}
+    {"id": <job id>, "ok": false, "error": "..."}
+
+Jobs of one connection may complete out of order; use "id" to match responses.
+'''
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+
+from .Cache import MatchupCache
+from .GameMaster import GameMaster
+from .Matrix import minimize_pokemon, pokemon_label, run_pokemon_matrix, set_moves, set_stats_batch
+from .PokeQuery import PokeQuery, iter_batch_pokemon
+
+try:
+    from .Engine import GBS, default_session
+except Exception as e:
+    GBS = e
+
+    def default_session():
+        # The engine failed to load: report why on first use
+        raise GBS
+
+
+DEFAULT_PORT = 8765
+
+
+class ServerBusy(Exception):
+    pass
+
+
+class SimulationServer:
+    '''
+    Job handlers over one warm GameMaster and engine, with a bounded job queue.
+    '''
+
+    def __init__(self, config_path="./GBS.json", concurrency=4, max_queue=256, cache=None):
+        '''
+        @param config_path path to GBS configuration json
+        @param concurrency maximum number of jobs running at once
+        @param max_queue maximum number of jobs waiting or running; more are rejected as busy
+        @param cache MatchupCache (or path to one) for matrix jobs
+        '''
+        self.config_path = config_path
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        # The engine and the current GameMaster (applied for stats) are global state,
+        # so jobs using them run one at a time
+        self.engine_lock = threading.Lock()
+        self.pending = 0
+        self.pending_lock = threading.Lock()
+        if cache is not None and not isinstance(cache, MatchupCache):
+            cache = MatchupCache(cache)
+        self.cache = cache
+        self.handlers = {
+            "ping": self.ping,
+            "version": self.version,
+            "reload": self.reload,
+            "stats": self.stats,
+            "query": self.query,
+            "matrix": self.matrix
+        }
+        self.reload({})
+
+    def submit(self, job, callback):
+        '''
+        Queue @param job and call @param callback with its response dict when done.
+        '''
+        with self.pending_lock:
+            if self.pending >= self.max_queue:
+                callback(self._response(job, error=ServerBusy("server busy")))
+                return
+            self.pending += 1
+
+        def run():
+            try:
+                response = self.handle(job)
+            finally:
+                with self.pending_lock:
+                    self.pending -= 1
+            callback(response)
+
+        self.executor.submit(run)
+
+    def handle(self, job):
+        '''
+        Run @param job and return its response dict.
+        '''
+        try:
+            job_type = job.get("type")
+            if job_type not in self.handlers:
+                raise Exception("bad job type {}".format(job_type))
+            return self._response(job, result=self.handlers[job_type](job))
+        except Exception as e:
+            return self._response(job, error=e)
+
+    @staticmethod
+    def _response(job, result=None, error=None):
+        response = {"id": job.get("id") if isinstance(job, dict) else None}
+        if error is None:
+            response["ok"] = True
+            response["result"] = result
+        else:
+            response["ok"] = False
+            response["error"] = str(error)
+        return response
+
+    def ping(self, job):
+        return "pong"
+
+    def version(self, job):
+        return GBS.version()
+
+    def reload(self, job):
+        '''
+        (Re)load the GBS configuration, optionally from job field "config".
+        '''
+        config_path = job.get("config", self.config_path)
+        game_master = GameMaster().load_config(config_path)
+        with self.engine_lock:
+            game_master.apply()
+            default_session().configure(game_master)
+            self.game_master = game_master
+            self.config_path = config_path
+        return {"pokemon": len(game_master.Pokemon), "pvp_moves": len(game_master.PvPMoves)}
+
+    def _battle_ready(self, pkm_list, league, iv_rank):
+        # Applies self.game_master as the current GameMaster: call with self.engine_lock held
+        pkm_list = [copy.deepcopy(pkm) for pkm in pkm_list]
+        ready = []
+        for pkm in set_stats_batch(pkm_list, league, self.game_master, iv_rank):
+            if pkm and set_moves(pkm, self.game_master):
+                ready.append(pkm)
+        return ready
+
+    def stats(self, job):
+        '''
+        Derive the stats and moves of job field "pokemon" (list of Pokemon) for job field "league".
+        '''
+        with self.engine_lock:
+            pkm_list = self._battle_ready(job["pokemon"], job.get("league", "master"), job.get("iv_rank"))
+        return minimize_pokemon(pkm_list)
+
+    def query(self, job):
+        '''
+        Run job field "query": [species_query [, fmove_query, cmove_query [, cmove2_query]]].
+        Job field "fields" selects the fields of each match. Default to the queried ones.
+        '''
+        query = job["query"]
+        if isinstance(query, str):
+            query = [query]
+        if len(query) == 2:
+            raise Exception("cannot query fast move but not primary charged move")
+        limit = job.get("limit")
+        results = []
+        # Matches are generated lazily from the current GameMaster
+        with self.engine_lock:
+            if len(query) == 1:
+                fields = ["name"]
+                matches = self.game_master.search_pokemon(PokeQuery(query[0]), True)
+            else:
+                fields = ["name", "fmove", "cmove"]
+                pkm_qry = {"name": query[0], "fmove": query[1], "cmove": query[2]}
+                if len(query) >= 4:
+                    fields.append("cmove2")
+                    pkm_qry["cmove2"] = query[3]
+                matches = iter_batch_pokemon(pkm_qry, self.game_master)
+            fields = job.get("fields", fields)
+            for pkm in matches:
+                if limit is not None and len(results) >= limit:
+                    break
+                results.append({k: pkm.get(k) for k in fields})
+        return results
+
+    def matrix(self, job):
+        '''
+        Run the battle matrix of job fields "row_pokemon" and (optional) "col_pokemon" (lists of Pokemon).
+        Other job fields: "league", "shield", "iv_rank", "cache" (whether to use the server's matchup cache).
+        '''
+        league = job.get("league", "master")
+        iv_rank = job.get("iv_rank")
+        cache = self.cache if job.get("cache", True) else None
+        with self.engine_lock:
+            row_pkm = self._battle_ready(job["row_pokemon"], league, iv_rank)
+            col_pkm = self._battle_ready(job.get("col_pokemon", []), league, iv_rank)
+            matrix = run_pokemon_matrix(row_pkm, col_pkm, job.get("shield", 0), cache=cache)
+        row_labels = [pokemon_label(pkm) for pkm in row_pkm]
+        return {
+            "matrix": matrix,
+            "row_labels": row_labels,
+            "col_labels": [pokemon_label(pkm) for pkm in col_pkm] if col_pkm else row_labels
+        }
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if self.cache is not None:
+            self.cache.close()
+
+
+class _JobHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        server = self.server.simulation_server
+        write_lock = threading.Lock()
+        done = threading.Condition()
+        outstanding = [0]
+
+        def respond(response):
+            line = (json.dumps(response) + "\n").encode()
+            with write_lock:
+                try:
+                    self.wfile.write(line)
+                    self.wfile.flush()
+                except OSError:
+                    # Client went away
+                    pass
+            with done:
+                outstanding[0] -= 1
+                done.notify_all()
+
+        for line in self.rfile:
+            line = line.strip()
+            if not line:
+                continue
+            with done:
+                outstanding[0] += 1
+            try:
+                job = json.loads(line)
+                if not isinstance(job, dict):
+                    raise ValueError("job must be a json object")
+            except ValueError as e:
+                respond(SimulationServer._response({}, error=e))
+                continue
+            server.submit(job, respond)
+
+        # Keep the connection until all its jobs are answered
+        with done:
+            done.wait_for(lambda: outstanding[0] == 0)
+
+
+class _ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socketserver, "ThreadingUnixStreamServer"):
+
+    class _ThreadingUnixServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+else:
+    _ThreadingUnixServer = None
+
+
+def make_server(simulation_server, socket_path=None, host="127.0.0.1", port=DEFAULT_PORT):
+    '''
+    Create the socket server for @param simulation_server, on Unix socket @param socket_path if set, else on TCP.
+    '''
+    if socket_path is not None:
+        if _ThreadingUnixServer is None:
+            raise Exception("Unix sockets are not supported on this platform")
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = _ThreadingUnixServer(socket_path, _JobHandler)
+    else:
+        server = _ThreadingTCPServer((host, port), _JobHandler)
+    server.simulation_server = simulation_server
+    return server
+
+
+def request(jobs, socket_path=None, host="127.0.0.1", port=DEFAULT_PORT):
+    '''
+    Send @param jobs (a job dict, or a list of them) to a running server and wait for all responses.
+
+    @return the response dict, or a list of them in the order of @param jobs
+    '''
+    single = isinstance(jobs, dict)
+    if single:
+        jobs = [jobs]
+    jobs = [dict(job, id=job.get("id", i)) for i, job in enumerate(jobs)]
+    if socket_path is not None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(socket_path)
+    else:
+        sock = socket.create_connection((host, port))
+    with sock, sock.makefile("rwb") as stream:
+        for job in jobs:
+            stream.write((json.dumps(job) + "\n").encode())
+        stream.flush()
+        sock.shutdown(socket.SHUT_WR)
+        responses = {}
+        for line in stream:
+            response = json.loads(line)
+            responses[response["id"]] = response
+    ordered = [responses.get(job["id"]) for job in jobs]
+    return ordered[0] if single else ordered
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="gobattlesim serve")
+    parser.add_argument("-c", "--config", default="./GBS.json",
+                        help="path to GBS configuration json")
+    parser.add_argument("--socket",
+                        help="path of the Unix socket to listen on. If omitted, listen on TCP")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="TCP host to listen on")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+                        help="TCP port to listen on")
+    parser.add_argument("-j", "--concurrency", type=int, default=4,
+                        help="maximum number of jobs running at once")
+    parser.add_argument("--max-queue", type=int, default=256,
+                        help="maximum number of jobs waiting or running; more are rejected as busy")
+    parser.add_argument("--cache", nargs="?", const="",
+                        help="use the on-disk matchup cache for matrix jobs. Optionally, path to the cache")
+    args = parser.parse_args(argv)
+
+    if isinstance(GBS, Exception):
+        raise GBS
+
+    cache = None
+    if args.cache is not None:
+        cache = MatchupCache(args.cache or None)
+    simulation_server = SimulationServer(args.config, args.concurrency, args.max_queue, cache)
+    server = make_server(simulation_server, args.socket, args.host, args.port)
+    print("GoBattleSim server listening on {}".format(
+        args.socket or "{}:{}".format(args.host, args.port)), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        simulation_server.close()
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
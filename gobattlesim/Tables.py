@@ -0,0 +1,257 @@
+'''
+This module provides columnar, array-backed views of the Pokemon and moves of a GameMaster.
+
+Row i of a table stands for the i-th entity of the list it is built from, so the dict of row i of the species table
+is game_master.Pokemon[i], and likewise for PvEMoves and PvPMoves. Names are interned, and types are encoded as
+indexes in PoketypeList, with -1 for none:
+
+    species = get_tables(game_master).species
+    bulky = (species.base_stats[:, 1] * species.base_stats[:, 2] > 40000) & species.has_type("water")
+    names = species.names_of(bulky)
+'''
+
+import numpy as np
+
+from .GameMaster import GameMaster, InversedPoketypeList
+
+
+FAST = 0
+CHARGED = 1
+
+# Movepool fields of a species, and the movetype of their moves
+MovepoolFields = {
+    "fastMoves": FAST,
+    "chargedMoves": CHARGED,
+    "fastMoves_legacy": FAST,
+    "chargedMoves_legacy": CHARGED,
+    "fastMoves_exclusive": FAST,
+    "chargedMoves_exclusive": CHARGED
+}
+
+
+def encode_type(poketype):
+    '''
+    Return the index of @param poketype in PoketypeList, or -1 if it is none or unknown.
+    '''
+    return InversedPoketypeList.get(poketype, -1)
+
+
+class Names:
+    '''
+    Interned strings. Each distinct string has a code: its position in names.
+    '''
+
+    def __init__(self, strings=()):
+        self.names = []
+        self._codes = {}
+        for s in strings:
+            self.intern(s)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, code):
+        return self.names[code]
+
+    def intern(self, name):
+        '''
+        Return the code of @param name, adding it if new.
+        '''
+        code = self._codes.get(name)
+        if code is None:
+            code = self._codes[name] = len(self.names)
+            self.names.append(name)
+        return code
+
+    def intern_all(self, names):
+        return np.fromiter((self.intern(name) for name in names), dtype=np.int32)
+
+    def code(self, name):
+        '''
+        Return the code of @param name, or -1 if it is not interned.
+        '''
+        return self._codes.get(name, -1)
+
+
+class Movepools:
+    '''
+    Movepools of all species in CSR layout: the moves of species i are the move name codes
+    moves[indptr[i]:indptr[i + 1]].
+    '''
+
+    def __init__(self, movepools, names):
+        lengths = np.fromiter((len(movepool) for movepool in movepools), dtype=np.int64, count=len(movepools))
+        self.indptr = np.zeros(len(movepools) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.indptr[1:])
+        self.moves = names.intern_all(move for movepool in movepools for move in movepool)
+
+    def of(self, i):
+        return self.moves[self.indptr[i]:self.indptr[i + 1]]
+
+    def species_with(self, code):
+        '''
+        Return the boolean mask of the species whose movepool has move name code @param code.
+        '''
+        mask = np.zeros(len(self.indptr) - 1, dtype=bool)
+        positions = np.flatnonzero(self.moves == code)
+        mask[np.searchsorted(self.indptr, positions, side="right") - 1] = True
+        return mask
+
+
+class MoveTable:
+    '''
+    Columns of a list of moves: "name" (code in names), "movetype" (FAST or CHARGED), "type",
+    "power", "energy", "duration" and "dws" (0 for PvP moves).
+    PvP buffs are in "buff_chance" and "buffs", whose columns are the stage deltas of
+    self attack, self defense, target attack and target defense.
+    '''
+
+    def __init__(self, moves, names):
+        self.names = names
+        self.size = len(moves)
+        self.name = names.intern_all(move["name"] for move in moves)
+        self.movetype = np.array([CHARGED if move.get("movetype") == "charged" else FAST for move in moves],
+                                 dtype=np.int8)
+        self.type = np.array([encode_type(move.get("pokeType")) for move in moves], dtype=np.int8)
+        for field in ["power", "energy", "duration", "dws"]:
+            setattr(self, field, np.array([move.get(field, 0) for move in moves], dtype=np.int32))
+        self.buff_chance = np.zeros(self.size, dtype=np.float64)
+        self.buffs = np.zeros((self.size, 4), dtype=np.int8)
+        for i, move in enumerate(moves):
+            effect = move.get("effect")
+            if effect:
+                self.buff_chance[i] = float(effect.get("activation_chance", 0))
+                self.buffs[i] = [effect.get("self_attack_stage_delta", 0), effect.get("self_defense_stage_delta", 0),
+                                 effect.get("target_attack_stage_delta", 0), effect.get("target_defense_stage_delta", 0)]
+        self._lookup = None
+
+    def __len__(self):
+        return self.size
+
+    def rows(self, codes, movetype=None):
+        '''
+        Return the rows of the moves with name codes @param codes (and movetype @param movetype, if set),
+        -1 for none.
+        '''
+        if self._lookup is None or len(self._lookup[0]) < len(self.names):
+            # Indexed by movetype (FAST, CHARGED, any), then name code
+            self._lookup = np.full((3, len(self.names)), -1, dtype=np.int32)
+            rows = np.arange(self.size, dtype=np.int32)
+            # Assign in reverse, so that the first of duplicate names wins
+            self._lookup[self.movetype[::-1], self.name[::-1]] = rows[::-1]
+            self._lookup[2, self.name[::-1]] = rows[::-1]
+        codes = np.asarray(codes)
+        return self._lookup[2 if movetype is None else movetype, codes]
+
+    def find(self, name, movetype=None):
+        '''
+        Return the row of move @param name, or -1 if there is none.
+        '''
+        code = self.names.code(name)
+        if code < 0:
+            return -1
+        return int(self.rows(code, movetype))
+
+
+class SpeciesTable:
+    '''
+    Columns of a list of Pokemon species: "name" (code in names), "dex" (-1 for none),
+    "base_stats" (baseAtk, baseDef and baseStm), "types" (pokeType1 and pokeType2)
+    and "rarity" (code in rarities, -1 for none).
+    Movepools are in "movepools", by field ("fastMoves", "chargedMoves", ...), as Movepools of move name codes.
+    '''
+
+    def __init__(self, pokemon, move_names):
+        self.names = Names()
+        self.move_names = move_names
+        self.rarities = Names()
+        self.size = len(pokemon)
+        self.name = self.names.intern_all(pkm["name"] for pkm in pokemon)
+        self.dex = np.array([-1 if pkm.get("dex") is None else pkm["dex"] for pkm in pokemon], dtype=np.int32)
+        self.base_stats = np.array([[pkm.get("baseAtk", 0), pkm.get("baseDef", 0), pkm.get("baseStm", 0)]
+                                    for pkm in pokemon], dtype=np.int32).reshape(-1, 3)
+        self.types = np.array([[encode_type(pkm.get("pokeType1")), encode_type(pkm.get("pokeType2"))]
+                               for pkm in pokemon], dtype=np.int8).reshape(-1, 2)
+        self.rarity = np.array([self.rarities.intern(pkm["rarity"]) if "rarity" in pkm else -1
+                                for pkm in pokemon], dtype=np.int8)
+        self.movepools = {}
+        for field in MovepoolFields:
+            if any(field in pkm for pkm in pokemon):
+                self.movepools[field] = Movepools([pkm.get(field, []) for pkm in pokemon], move_names)
+        self._by_name = None
+
+    def __len__(self):
+        return self.size
+
+    def find(self, name):
+        '''
+        Return the rows of species @param name (case-insensitive).
+        '''
+        if self._by_name is None:
+            self._by_name = {}
+            for i, code in enumerate(self.name):
+                self._by_name.setdefault(self.names[code].strip().lower(), []).append(i)
+        return np.array(self._by_name.get(name.strip().lower(), []), dtype=np.int64)
+
+    def has_type(self, poketype):
+        '''
+        Return the boolean mask of the species of type @param poketype.
+        '''
+        return (self.types == encode_type(poketype)).any(axis=1)
+
+    def names_of(self, rows):
+        '''
+        Return the names of @param rows (indexes or boolean mask).
+        '''
+        rows = np.flatnonzero(rows) if np.asarray(rows).dtype == bool else rows
+        return [self.names[code] for code in self.name[rows]]
+
+    def movepool(self, i, field="fastMoves"):
+        '''
+        Return the move names of movepool @param field of species row @param i.
+        '''
+        if field not in self.movepools:
+            return []
+        return [self.move_names[code] for code in self.movepools[field].of(i)]
+
+
+class Tables:
+    '''
+    Columnar views of one GameMaster: "species", "pve_moves" and "pvp_moves".
+    Move names of all tables and movepools share the table "move_names".
+    '''
+
+    def __init__(self, game_master):
+        self.move_names = Names()
+        self.pve_moves = MoveTable(game_master.PvEMoves, self.move_names)
+        self.pvp_moves = MoveTable(game_master.PvPMoves, self.move_names)
+        self.species = SpeciesTable(game_master.Pokemon, self.move_names)
+
+    def movepool_rows(self, i, field="fastMoves", pvp=True):
+        '''
+        Return the rows in the PvP (@param pvp = True) or PvE move table of movepool @param field of species row @param i,
+        -1 for moves not in the table.
+        '''
+        if field not in self.species.movepools:
+            return np.zeros(0, dtype=np.int32)
+        table = self.pvp_moves if pvp else self.pve_moves
+        return table.rows(self.species.movepools[field].of(i), MovepoolFields[field])
+
+    def species_with_move(self, name, field="fastMoves"):
+        '''
+        Return the boolean mask of the species with move @param name in movepool @param field.
+        '''
+        code = self.move_names.code(name)
+        if field not in self.species.movepools or code < 0:
+            return np.zeros(len(self.species), dtype=bool)
+        return self.species.movepools[field].species_with(code)
+
+
+def get_tables(game_master=None):
+    '''
+    Return the Tables of @param game_master (default to the current one).
+    They are built on first use, and built again whenever the GameMaster rebuilds its indexes.
+    '''
+    if game_master is None:
+        game_master = GameMaster.CurrentInstance
+    return game_master.derived("tables", Tables)
@@ -0,0 +1,545 @@
+'''
+This module searches the best teams of row Pokemon of a battle matrix against its col Pokemon (the meta).
+
+A team faces each threat (col Pokemon) with its best member, so its score against a threat is the best score of
+its members. Teams are ranked by one of TeamObjectives:
+
+    "meta"   weighted mean of the team's scores against the threats
+    "worst"  the team's score against its worst threat
+    "wins"   number of threats beaten by at least one member, from win bitsets
+
+The search is a depth-first branch and bound: candidates are ordered by their own value, and a branch is pruned
+once an upper bound of the teams it contains cannot beat the K-th best team found so far:
+
+    teams = search_teams(BattleMatrix.load("matrix.npz"), size=3, top=10, objective="worst")
+'''
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import heapq
+import itertools
+import json
+import multiprocessing
+import sys
+
+import numpy as np
+
+from .GameMaster import GameMaster
+from . import Profile
+from . import Ranking
+
+
+TeamObjectives = ["meta", "worst", "wins"]
+
+TeamWeights = ["uniform", "weighted", "nash"]
+
+# Number of matrix cells evaluated at once
+CHUNK_CELLS = 1 << 22
+
+# Number of set bits of each byte, for NumPy versions without np.bitwise_count (before 2.0)
+_BYTE_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def win_bitsets(values):
+    '''
+    Return the wins (score > 0) of each row of @param values against the cols, packed as array of uint64 words.
+    '''
+    wins = np.packbits(np.asarray(values) > 0, axis=1, bitorder="little")
+    words = -(-wins.shape[1] // 8)
+    padded = np.zeros((len(wins), words * 8), dtype=np.uint8)
+    padded[:, :wins.shape[1]] = wins
+    return padded.view(np.uint64)
+
+
+def popcount(words):
+    '''
+    Return the number of set bits of bitsets @param words (uint64 words along the last axis).
+    '''
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+    return _BYTE_POPCOUNT[np.ascontiguousarray(words).view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+
+def col_weights(values, how="uniform"):
+    '''
+    Return the weights of the threats (cols) of battle matrix @param values, summing to 1.
+
+    @param how "uniform", "weighted" (weights of the col side of Ranking.weighted_win_rate)
+        or "nash" (the col strategy of Ranking.nash_equilibrium)
+    '''
+    values = np.asarray(values)
+    if how == "uniform":
+        return np.full(values.shape[1], 1 / values.shape[1])
+    if how == "weighted":
+        return Ranking.weighted_win_rate(values).col_weights
+    if how == "nash":
+        return Ranking.nash_equilibrium(values).col_strategy
+    raise Exception("bad weights {}".format(how))
+
+
+def label_species(labels, game_master=None):
+    '''
+    Return the dex of the Pokemon of each BattleMatrix label ("name fmove/cmove"), or the name if not found.
+    As names and moves may both contain spaces, the name is the longest prefix of the label that is a Pokemon.
+    '''
+    if game_master is None:
+        game_master = GameMaster.CurrentInstance
+    species = []
+    for label in labels:
+        words = str(label).split(" ")
+        found = words[0]
+        for i in range(len(words), 0, -1):
+            pkm = game_master.search_pokemon(" ".join(words[:i]))
+            if pkm is not None:
+                found = pkm.get("dex", pkm["name"])
+                break
+        species.append(found)
+    return species
+
+
+def is_banned(label, banned):
+    '''
+    Return whether BattleMatrix label @param label is one of @param banned (labels or Pokemon names, lowercase).
+    '''
+    label = str(label).strip().lower()
+    return any(label == ban or label.startswith(ban + " ") for ban in banned)
+
+
+def _distinct_combinations(positions, r, species=None):
+    '''
+    Yield the combinations of @param r of @param positions, of different species if @param species is set.
+    '''
+    for team in itertools.combinations(positions.tolist(), r):
+        if species is None or len(set(species[list(team)].tolist())) == r:
+            yield team
+
+
+class _TeamSearch:
+    '''
+    Best @param top teams of @param size found by a search.
+    The search is split into root branches (see branches()), which may run in different processes.
+    '''
+
+    def __init__(self, size, top, shared=None):
+        self.size = size
+        self.top = top
+        # Value shared by worker processes: the best K-th team value found by any of them
+        self.shared = shared
+        self.heap = []
+
+    def threshold(self):
+        '''
+        Return the value a team must exceed to be among the best teams.
+        '''
+        local = self.heap[0][0] if len(self.heap) >= self.top else -np.inf
+        if self.shared is not None:
+            return max(local, self.shared.value)
+        return local
+
+    def push(self, value, team):
+        team = tuple(sorted(team))
+        if len(self.heap) < self.top:
+            heapq.heappush(self.heap, (value, team))
+        elif value > self.heap[0][0]:
+            heapq.heapreplace(self.heap, (value, team))
+        else:
+            return
+        if self.shared is not None and len(self.heap) >= self.top and self.heap[0][0] > self.shared.value:
+            with self.shared.get_lock():
+                self.shared.value = max(self.shared.value, self.heap[0][0])
+
+    def results(self):
+        return sorted(self.heap, key=lambda item: (-item[0], item[1]))
+
+
+class _GainSearch(_TeamSearch):
+    '''
+    Depth-first branch and bound for the submodular objectives "meta" and "wins", over teams of @param rows
+    (score rows, or win bitsets for "wins") taken in order.
+
+    A member adds at most its gain to a smaller team, so the gain of candidate c to a team is capped by
+    its gain to the empty team and to each member i alone: value({i, c}) - value({i}).
+    Those pair gains are computed for a candidate once it is a member of a team that is searched.
+    '''
+
+    def __init__(self, rows, objective, weights, size, top, species=None, shared=None):
+        _TeamSearch.__init__(self, size, top, shared)
+        self.rows = rows
+        self.objective = objective
+        self.weights = weights
+        self.species = species
+        self.chunk = max(1, CHUNK_CELLS // max(1, rows.shape[1]))
+        if objective == "wins":
+            self.combine = np.bitwise_or
+            self.init = np.zeros(rows.shape[1], dtype=rows.dtype)
+            self.slack = 0.0
+        else:
+            self.combine = np.maximum
+            # Every team does at least as well as the worst candidate against each threat
+            self.init = rows.min(axis=0)
+            # Float32 sums may break submodularity by rounding, so caps get some slack
+            self.slack = 1e-5
+        self.empty = float(self.value(self.init))
+        self.single = self.values(self.init, np.arange(len(rows)))
+        # Value of the ideal team, with the best candidate against each threat, which no team can exceed
+        self.best = float(self.value(self.combine.reduce(rows, axis=0))) + self.slack if len(rows) else -np.inf
+        self._caps = {}
+
+    def value(self, states):
+        if self.objective == "meta":
+            return (states @ self.weights).astype(np.float64)
+        return popcount(states).astype(np.float64)
+
+    def values(self, state, positions):
+        '''
+        Return the values of the teams of combined row @param state plus each candidate at @param positions.
+        '''
+        Profile.count("teams.evaluated", len(positions))
+        vals = np.empty(len(positions))
+        for i in range(0, len(positions), self.chunk):
+            block = positions[i:i + self.chunk]
+            vals[i:i + len(block)] = self.value(self.combine(self.rows[block], state))
+        return vals
+
+    def caps(self, c):
+        '''
+        Return the gain of each candidate to candidate @param c alone.
+        '''
+        caps = self._caps.get(c)
+        if caps is None:
+            caps = self._caps[c] = self.values(self.rows[c], np.arange(len(self.rows))) - self.single[c] + self.slack
+        return caps
+
+    def available(self, g, c):
+        g = np.minimum(g, self.caps(c))
+        if self.species is not None:
+            g[self.species == self.species[c]] = -np.inf
+        return g
+
+    def branches(self):
+        '''
+        Return the root branches: the first member of a team, as positions (best first).
+        '''
+        return list(range(len(self.rows)))
+
+    def search_branch(self, c):
+        # Candidates are ordered by value, so the best gain after c is that of c + 1
+        later = self.single[c + 1] - self.empty + self.slack if c + 1 < len(self.rows) else -np.inf
+        if self.size > 1 and min(self.single[c] + (self.size - 1) * later, self.best) <= self.threshold():
+            return
+        g = self.single - self.empty + self.slack
+        self.expand((c,), self.rows[c], self.single[c], self.available(g, c) if self.size > 1 else g, c + 1)
+
+    def expand(self, team, state, value, g, start):
+        '''
+        Search the teams made of @param team (with combined row @param state and value @param value)
+        and members after position @param start, whose gains are capped by @param g.
+        '''
+        picks = self.size - len(team)
+        if picks == 0:
+            if value > self.threshold():
+                self.push(value, team)
+            return
+        if self.best <= self.threshold():
+            return
+        Profile.count("teams.nodes")
+        positions = start + np.flatnonzero(g[start:] > -np.inf)
+        if len(positions) < picks:
+            return
+        caps = g[positions]
+        if picks == 1:
+            positions = positions[value + caps > self.threshold()]
+            vals = self.values(state, positions)
+            for i in np.argsort(-vals, kind="stable"):
+                if vals[i] <= self.threshold():
+                    break
+                self.push(float(vals[i]), team + (int(positions[i]),))
+            return
+        # Best cap after each candidate
+        later = np.full(len(caps), -np.inf)
+        later[:-1] = np.maximum.accumulate(caps[::-1])[::-1][1:]
+        keep = value + caps + (picks - 1) * later > self.threshold()
+        positions, later = positions[keep], later[keep]
+        vals = self.values(state, positions)
+        for i in np.argsort(-vals, kind="stable"):
+            if vals[i] + (picks - 1) * later[i] <= self.threshold():
+                continue
+            c = int(positions[i])
+            self.expand(team + (c,), self.combine(state, self.rows[c]), float(vals[i]), self.available(g, c), c + 1)
+
+
+class _WorstSearch(_TeamSearch):
+    '''
+    Branch and bound for objective "worst" over teams of score rows @param rows.
+
+    To beat the K-th best team, every threat must be countered by some member with a higher score.
+    So the search branches on the members that counter the hardest threat not yet countered, excluding the
+    members of earlier branches from later ones, which visits each team once. Whether the candidates left
+    can still counter every threat is checked on bitsets of the threats each candidate counters.
+    '''
+
+    def __init__(self, rows, size, top, species=None, shared=None):
+        _TeamSearch.__init__(self, size, top, shared)
+        self.rows = rows
+        self.species = species
+        self._branches = None
+        self._level = None
+
+    def counters(self, threshold):
+        '''
+        Return the bitsets of the threats each candidate scores above @param threshold against,
+        and the number of candidates that do against each threat.
+        '''
+        if self._level is None or self._level[0] != threshold:
+            above = self.rows > threshold
+            self._level = (threshold, win_bitsets(above), above.sum(axis=0))
+        return self._level[1], self._level[2]
+
+    def branches(self):
+        '''
+        Return the root branches: the first member of a team, as the counters of the hardest threat (best first).
+        '''
+        if self._branches is None:
+            threat = int(np.argmin(self.rows.max(axis=0)))
+            self._branches = np.argsort(-self.rows[:, threat], kind="stable")
+        return list(range(len(self._branches)))
+
+    def search_branch(self, k):
+        branches = self._branches
+        available = np.ones(len(self.rows), dtype=bool)
+        available[branches[:k + 1]] = False
+        x = int(branches[k])
+        if self.species is not None:
+            available &= self.species != self.species[x]
+        self.expand((x,), self.rows[x], available)
+
+    def expand(self, team, state, available):
+        '''
+        Search the teams made of @param team (with combined row @param state) and members in mask @param available.
+        '''
+        picks = self.size - len(team)
+        threshold = self.threshold()
+        if picks == 0:
+            if state.min() > threshold:
+                self.push(float(state.min()), team)
+            return
+        Profile.count("teams.nodes")
+        candidates = np.flatnonzero(available)
+        if len(candidates) < picks:
+            return
+
+        uncovered = state <= threshold
+        if uncovered.any():
+            bits, counts = self.counters(threshold)
+            # Threats still to counter, and those the candidates left counter
+            wanted = win_bitsets(uncovered[None, :])[0]
+            hits = bits[candidates] & wanted
+            if (np.bitwise_or.reduce(hits, axis=0) != wanted).any():
+                return
+            if picks * popcount(hits).max() < uncovered.sum():
+                return
+            uncovered = np.flatnonzero(uncovered)
+            threat = int(uncovered[np.argmin(counts[uncovered])])
+            counters = candidates[self.rows[candidates, threat] > threshold]
+        else:
+            # The team beats the threshold already: either a member improves its worst threat, or its value is final
+            threat = int(np.argmin(state))
+            counters = candidates[self.rows[candidates, threat] > state[threat]]
+
+        available = available.copy()
+        for x in counters[np.argsort(-self.rows[counters, threat], kind="stable")]:
+            x = int(x)
+            available[x] = False
+            child = available if self.species is None else available & (self.species != self.species[x])
+            self.expand(team + (x,), np.maximum(state, self.rows[x]), child)
+
+        value = float(state[threat])
+        if value > self.threshold():
+            # Teams completed by members that do not improve the worst threat
+            for rest in itertools.islice(_distinct_combinations(np.flatnonzero(available), picks, self.species),
+                                         self.top):
+                self.push(value, team + rest)
+
+
+def _make_search(rows, objective, weights, size, top, species=None, shared=None):
+    if objective == "worst":
+        return _WorstSearch(rows, size, top, species, shared)
+    return _GainSearch(rows, objective, weights, size, top, species, shared)
+
+
+_worker_search = None
+
+
+def _init_worker(shm_name, shape, dtype, objective, weights, size, top, species, shared):
+    global _worker_search
+    from multiprocessing import shared_memory
+    # Keep the shared memory block open for the lifetime of the worker
+    _init_worker.shm = shared_memory.SharedMemory(name=shm_name)
+    rows = np.ndarray(shape, dtype=dtype, buffer=_init_worker.shm.buf)
+    _worker_search = _make_search(rows, objective, weights, size, top, species, shared)
+    _worker_search.branches()
+
+
+def _search_branches(branches):
+    search = _worker_search
+    search.heap = []
+    for branch in branches:
+        search.search_branch(branch)
+    return search.results()
+
+
+@Profile.profiled("teams.search")
+def search_teams(matrix, size=3, top=10, objective="meta", weights="uniform", species=None, banned=(), workers=1):
+    '''
+    Search the best teams of row Pokemon of battle matrix @param matrix against its col Pokemon.
+
+    @param matrix BattleMatrix, or 2D array-like labeled by position
+    @param size number of members of a team
+    @param top number of teams to return
+    @param objective one of TeamObjectives
+    @param weights weights of the threats for objective "meta": one of TeamWeights, or an array with one weight per col
+    @param species species of each row Pokemon (e.g. from label_species). If set, members of a team are
+        of different species
+    @param banned row Pokemon (labels or names) that may not be in a team
+    @param workers number of worker processes. If more than 1, the root branches are searched in parallel
+    @return list of dict {"members" (labels), "value", "meta", "worst", "wins"}, best first
+    '''
+    if objective not in TeamObjectives:
+        raise Exception("bad objective {}".format(objective))
+    values = np.asarray(matrix, dtype=np.float32)
+    labels = getattr(matrix, "row_labels", None)
+    if labels is None:
+        labels = [str(i) for i in range(len(values))]
+    labels = np.asarray(labels, dtype=str)
+    if isinstance(weights, str):
+        weights = col_weights(values, weights)
+    weights = np.asarray(weights, dtype=np.float32)
+
+    banned = [str(ban).strip().lower() for ban in banned]
+    candidates = np.flatnonzero([not is_banned(label, banned) for label in labels])
+    if species is not None:
+        # Species as codes, for vectorized comparison
+        species = np.unique(np.asarray(species, dtype=str), return_inverse=True)[1].reshape(-1)
+
+    # Order candidates by their own value, so that good teams are found first
+    if objective == "wins":
+        single = _GainSearch(win_bitsets(values[candidates]), "wins", weights, 1, 1).single
+    else:
+        single = _GainSearch(values[candidates], "meta", weights, 1, 1).single
+    order = candidates[np.argsort(-single, kind="stable")]
+    rows = np.ascontiguousarray(win_bitsets(values[order]) if objective == "wins" else values[order])
+    species = None if species is None else species[order]
+
+    if workers > 1 and len(rows) > 1:
+        # Python 3.8+, so only imported for parallel searches
+        from multiprocessing import shared_memory
+        shared = multiprocessing.Value("d", -np.inf)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, rows.nbytes))
+        try:
+            np.ndarray(rows.shape, dtype=rows.dtype, buffer=shm.buf)[:] = rows
+            initargs = (shm.name, rows.shape, rows.dtype, objective, weights, size, top, species, shared)
+            branches = _make_search(rows, objective, weights, size, top, species).branches()
+            # Interleave the branches, so that each task gets good and bad branches alike
+            n_tasks = min(4 * workers, len(branches))
+            teams = {}
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=initargs) as pool:
+                for results in pool.map(_search_branches, [branches[i::n_tasks] for i in range(n_tasks)]):
+                    for value, team in results:
+                        teams[team] = value
+        finally:
+            shm.close()
+            shm.unlink()
+        results = sorted(((value, team) for team, value in teams.items()), key=lambda item: (-item[0], item[1]))[:top]
+    else:
+        search = _make_search(rows, objective, weights, size, top, species)
+        for branch in search.branches():
+            search.search_branch(branch)
+        results = search.results()
+
+    teams = []
+    for value, team in results:
+        members = order[list(team)]
+        best = values[members].max(axis=0)
+        teams.append({
+            "members": labels[members].tolist(),
+            "value": value,
+            "meta": float(best @ weights),
+            "worst": float(best.min()),
+            "wins": int((best > 0).sum())
+        })
+    return teams
+
+
+@Profile.profiled("teams.save")
+def save_teams(teams, file, fmt="csv"):
+    '''
+    save @param teams (from search_teams) to file @param file with format @param fmt.
+    '''
+    if fmt == "tsv" or fmt == "csv":
+        size = max([len(team["members"]) for team in teams] + [0])
+        writer = csv.writer(file, dialect="excel-tab" if fmt == "tsv" else "excel")
+        writer.writerow(["member{}".format(i + 1) for i in range(size)] + ["value", "meta", "worst", "wins"])
+        for team in teams:
+            writer.writerow(team["members"] + [team["value"], team["meta"], team["worst"], team["wins"]])
+    elif fmt == "json":
+        json.dump(teams, file, indent=4)
+    else:
+        raise Exception("bad format {}".format(fmt))
+
+
+def main():
+    # Imported here, as Matrix depends on Ranking, which this module uses too
+    from .Matrix import BattleMatrix
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("matrix",
+                        help="path to a labeled battle matrix (npz, or npy with labels). "
+                        "Teams are made of its row Pokemon, against its col Pokemon")
+    parser.add_argument("-k", "--size", type=int, default=3,
+                        help="number of Pokemon in a team")
+    parser.add_argument("-n", "--top", type=int, default=10,
+                        help="number of teams to output")
+    parser.add_argument("--objective", choices=TeamObjectives, default="meta",
+                        help="rank teams by weighted mean score against the threats (meta), "
+                        "by score against their worst threat (worst), or by number of threats beaten (wins)")
+    parser.add_argument("--weights", choices=TeamWeights, default="uniform",
+                        help="weights of the threats for the meta objective: uniform, "
+                        "iterative weighted win rates or Nash equilibrium meta shares of the col Pokemon")
+    parser.add_argument("--unique-species", action="store_true",
+                        help="do not allow two Pokemon of the same species (dex) in a team")
+    parser.add_argument("--ban", action="append", default=[],
+                        help="a Pokemon name or matrix label that may not be in a team (repeatable)")
+    parser.add_argument("-c", "--config", default="./GBS.json",
+                        help="path to GBS game master json, to tell species apart for --unique-species")
+    parser.add_argument("-j", "--workers", type=int, default=1,
+                        help="number of worker processes to search in parallel")
+    parser.add_argument("-f", "--format", choices=["tsv", "csv", "json"], default=None,
+                        help="output format. If omitted, will derive from output filepath")
+    parser.add_argument("-o", "--out",
+                        help="file to store the teams")
+    Profile.add_argument(parser)
+    args = parser.parse_args()
+    Profile.start(args.profile)
+
+    if args.out is None:
+        fmt = args.format or "csv"
+        out = sys.stdout
+    else:
+        fmt = args.format or args.out.split(".")[-1]
+        out = open(args.out, "w", newline="")
+
+    with Profile.stage("teams.load"):
+        matrix = BattleMatrix.load(args.matrix)
+    species = None
+    if args.unique_species:
+        gm = GameMaster()
+        gm.load_config(args.config)
+        species = label_species(matrix.row_labels, gm)
+
+    teams = search_teams(matrix, args.size, args.top, args.objective, args.weights, species, args.ban, args.workers)
+    save_teams(teams, out, fmt)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,422 @@
+'''
+This module provides a pure-Python/NumPy PvP simulator with the same interface as the native GoBattleSim engine.
+
+Battles are simulated in lock-step: every matchup of a battle matrix is a lane of a set of NumPy arrays,
+and each turn advances all lanes at once.
+'''
+
+import json
+
+import numpy as np
+
+from .Damage import NO_TYPE, DamageTable, pair_index, type_index
+from .GameMaster import GameMaster
+
+
+# Shield counts covered when averaging by shield
+SHIELD_SCENARIOS = (0, 1, 2)
+
+# Version of the battle model, part of the engine version. Bump it whenever a change alters scores,
+# so that matchups cached with the previous model are not reused
+MODEL_VERSION = 1
+
+
+class PvPSettings:
+    '''
+    Battle constants the simulator needs, read from a GoBattleSim configuration.
+    '''
+
+    def __init__(self, game_master_json):
+        pvp = game_master_json.get("PvPBattleSettings", {})
+        self.max_turns = int(pvp.get("roundDurationSeconds", 240) /
+                             pvp.get("turnDurationSeconds", 0.5))
+        self.max_energy = pvp.get("maxEnergy", 100)
+        self.stab = pvp.get("sameTypeAttackBonusMultiplier", 1.2)
+        self.fast_bonus = pvp.get("fastAttackBonusMultiplier", 1.3)
+        self.charged_bonus = pvp.get("chargeAttackBonusMultiplier", 1.3)
+        self.min_stage = pvp.get("minimumStatStage", -4)
+        self.max_stage = pvp.get("maximumStatStage", 4)
+        n_stages = self.max_stage - self.min_stage + 1
+        self.attack_buff = np.array(
+            pvp.get("attackBuffMultiplier", [1.0] * n_stages), dtype=float)
+        self.defense_buff = np.array(
+            pvp.get("defenseBuffMultiplier", [1.0] * n_stages), dtype=float)
+        self.damage = DamageTable(game_master_json, self.stab)
+
+
+class PokemonArrays:
+    '''
+    Column arrays of a list of battle-ready Pokemon (as built by Matrix.set_stats and Matrix.set_moves).
+    '''
+
+    def __init__(self, pkm_list):
+        n = len(pkm_list)
+        k = max([len(pkm.get("cmoves", [])) for pkm in pkm_list] + [1])
+        self.size = n
+        self.type1 = np.empty(n, dtype=int)
+        self.type2 = np.empty(n, dtype=int)
+        self.attack = np.empty(n)
+        self.defense = np.empty(n)
+        self.max_hp = np.empty(n)
+        self.shields = np.empty(n, dtype=int)
+        self.f_type = np.empty(n, dtype=int)
+        self.f_power = np.empty(n)
+        self.f_energy = np.empty(n)
+        self.f_turns = np.empty(n, dtype=int)
+        self.c_type = np.full((n, k), NO_TYPE, dtype=int)
+        self.c_power = np.zeros((n, k))
+        self.c_cost = np.full((n, k), np.inf)
+        # Stat stage deltas: self attack, self defense, target attack, target defense
+        self.c_buffs = np.zeros((n, k, 4), dtype=int)
+
+        for i, pkm in enumerate(pkm_list):
+            self.type1[i] = type_index(pkm["pokeType1"])
+            self.type2[i] = type_index(pkm.get("pokeType2", "none"))
+            self.attack[i] = pkm["attack"]
+            self.defense[i] = pkm["defense"]
+            self.max_hp[i] = int(pkm["maxHP"])
+            self.shields[i] = int(pkm.get("num_shields", 0))
+            fmove = pkm["fmove"]
+            self.f_type[i] = type_index(fmove["pokeType"])
+            self.f_power[i] = fmove["power"]
+            self.f_energy[i] = fmove["energy"]
+            self.f_turns[i] = max(1, int(fmove["duration"]))
+            for j, cmove in enumerate(pkm.get("cmoves", [])):
+                self.c_type[i, j] = type_index(cmove["pokeType"])
+                self.c_power[i, j] = cmove["power"]
+                self.c_cost[i, j] = -cmove["energy"]
+                effect = cmove.get("effect")
+                # Only guaranteed effects are applied to keep the simulation deterministic
+                if effect and effect.get("activation_chance", 0) >= 1:
+                    self.c_buffs[i, j] = [effect.get("self_attack_stage_delta", 0),
+                                          effect.get("self_defense_stage_delta", 0),
+                                          effect.get("target_attack_stage_delta", 0),
+                                          effect.get("target_defense_stage_delta", 0)]
+        self.pair = pair_index(self.type1, self.type2)
+
+
+class _Side:
+    '''
+    Per-lane state of one side of a batch of battles.
+    '''
+
+    def __init__(self, me, opp, idx, opp_idx, shields, settings):
+        pair, opp_pair = me.pair[idx], opp.pair[opp_idx]
+
+        def multiplier(move_type, bonus):
+            if move_type.ndim == 2:
+                return settings.damage.lookup(move_type, pair[:, None], opp_pair[:, None]) * bonus
+            return settings.damage.lookup(move_type, pair, opp_pair) * bonus
+
+        self.attack = me.attack[idx]
+        self.defense = me.defense[idx]
+        self.max_hp = me.max_hp[idx]
+        self.hp = self.max_hp.copy()
+        self.energy = np.zeros(len(idx))
+        self.cooldown = np.zeros(len(idx), dtype=int)
+        self.shields = shields.copy()
+        self.atk_stage = np.zeros(len(idx), dtype=int)
+        self.def_stage = np.zeros(len(idx), dtype=int)
+
+        self.f_power = me.f_power[idx]
+        self.f_energy = me.f_energy[idx]
+        self.f_turns = me.f_turns[idx]
+        self.f_mult = multiplier(me.f_type[idx], settings.fast_bonus)
+        self.c_power = me.c_power[idx]
+        self.c_cost = me.c_cost[idx]
+        self.c_buffs = me.c_buffs[idx]
+        self.c_mult = multiplier(me.c_type[idx], settings.charged_bonus)
+
+        # Strategy: bait with the cheapest move while the opponent has shields,
+        # otherwise wait for the move with the highest damage
+        lanes = np.arange(len(idx))
+        self.cheapest = np.argmin(self.c_cost, axis=1)
+        nuke = np.where(np.isfinite(self.c_cost),
+                        self.c_power * self.c_mult, -1.0)
+        self.strongest = np.argmax(nuke, axis=1)
+        self.cheapest_cost = self.c_cost[lanes, self.cheapest]
+        self.strongest_cost = self.c_cost[lanes, self.strongest]
+
+    def compress(self, keep):
+        for name, value in self.__dict__.items():
+            setattr(self, name, value[keep])
+
+    def damage(self, opp, power, mult, settings):
+        atk = self.attack * \
+            settings.attack_buff[self.atk_stage - settings.min_stage]
+        dfs = opp.defense * \
+            settings.defense_buff[opp.def_stage - settings.min_stage]
+        return np.floor(0.5 * power * atk / dfs * mult) + 1
+
+
+def _charged_hit(me, opp, mask, choice, settings):
+    '''
+    Compute the outcome of charged move @param choice fired by @param me in lanes @param mask.
+    '''
+    lanes = np.arange(len(choice))
+    power = me.c_power[lanes, choice]
+    mult = me.c_mult[lanes, choice]
+    shielded = mask & (opp.shields > 0)
+    dmg = np.where(shielded, 1, me.damage(opp, power, mult, settings))
+    return mask, choice, shielded, np.where(mask, dmg, 0)
+
+
+def _commit_charged(me, opp, hit, settings):
+    mask, choice, shielded, dmg = hit
+    lanes = np.arange(len(choice))
+    opp.hp -= dmg
+    opp.shields -= shielded
+    me.energy -= np.where(mask, me.c_cost[lanes, choice], 0)
+    buffs = np.where(mask[:, None], me.c_buffs[lanes, choice], 0)
+    me.atk_stage = np.clip(me.atk_stage + buffs[:, 0],
+                           settings.min_stage, settings.max_stage)
+    me.def_stage = np.clip(me.def_stage + buffs[:, 1],
+                           settings.min_stage, settings.max_stage)
+    opp.atk_stage = np.clip(opp.atk_stage + buffs[:, 2],
+                            settings.min_stage, settings.max_stage)
+    opp.def_stage = np.clip(opp.def_stage + buffs[:, 3],
+                            settings.min_stage, settings.max_stage)
+
+
+def simulate_lanes(row, col, row_idx, col_idx, row_shields, col_shields, settings):
+    '''
+    Simulate one battle per lane, between row Pokemon @param row_idx and col Pokemon @param col_idx.
+
+    @param row PokemonArrays of the row Pokemon
+    @param col PokemonArrays of the col Pokemon
+    @param row_shields, col_shields number of shields per lane
+    @param settings PvPSettings
+    @return battle score per lane: remaining HP fraction of row Pokemon minus that of col Pokemon
+    '''
+    a = _Side(row, col, row_idx, col_idx, row_shields, settings)
+    b = _Side(col, row, col_idx, row_idx, col_shields, settings)
+    score = np.zeros(len(row_idx))
+    lane_id = np.arange(len(row_idx))
+
+    for turn in range(settings.max_turns):
+        # Decide: charged move if the chosen one is affordable, else (continue) a fast move
+        choice_a = np.where(b.shields > 0, a.cheapest, a.strongest)
+        choice_b = np.where(a.shields > 0, b.cheapest, b.strongest)
+        cost_a = np.where(b.shields > 0, a.cheapest_cost, a.strongest_cost)
+        cost_b = np.where(a.shields > 0, b.cheapest_cost, b.strongest_cost)
+        fire_a = (a.cooldown == 0) & (a.energy >= cost_a)
+        fire_b = (b.cooldown == 0) & (b.energy >= cost_b)
+        for side, fire in ((a, fire_a), (b, fire_b)):
+            start = (side.cooldown == 0) & ~fire
+            side.cooldown = np.where(start, side.f_turns, side.cooldown) - 1
+            side.cooldown[fire] = 0
+        land_a = (a.cooldown == 0) & ~fire_a
+        land_b = (b.cooldown == 0) & ~fire_b
+
+        # Fast moves land simultaneously
+        dmg_a = np.where(land_a, a.damage(b, a.f_power, a.f_mult, settings), 0)
+        dmg_b = np.where(land_b, b.damage(a, b.f_power, b.f_mult, settings), 0)
+        b.hp -= dmg_a
+        a.hp -= dmg_b
+        a.energy = np.minimum(
+            a.energy + np.where(land_a, a.f_energy, 0), settings.max_energy)
+        b.energy = np.minimum(
+            b.energy + np.where(land_b, b.f_energy, 0), settings.max_energy)
+
+        # Charged moves: higher attack goes first; ties resolve simultaneously
+        go_a = fire_a & (a.hp > 0)
+        go_b = fire_b & (b.hp > 0)
+        tie = go_a & go_b & (a.attack == b.attack)
+        first_a = go_a & (~go_b | (a.attack > b.attack))
+        first_b = go_b & (~go_a | (b.attack > a.attack))
+        hit_a = _charged_hit(a, b, first_a | tie, choice_a, settings)
+        hit_b = _charged_hit(b, a, first_b | tie, choice_b, settings)
+        _commit_charged(a, b, hit_a, settings)
+        _commit_charged(b, a, hit_b, settings)
+        second_a = go_a & go_b & ~tie & ~first_a & (a.hp > 0)
+        second_b = go_a & go_b & ~tie & ~first_b & (b.hp > 0)
+        _commit_charged(a, b, _charged_hit(
+            a, b, second_a, choice_a, settings), settings)
+        _commit_charged(b, a, _charged_hit(
+            b, a, second_b, choice_b, settings), settings)
+
+        active = (a.hp > 0) & (b.hp > 0)
+        if not active.all():
+            done = ~active
+            score[lane_id[done]] = _score(a, b)[done]
+            if not active.any():
+                return score
+            a.compress(active)
+            b.compress(active)
+            lane_id = lane_id[active]
+
+    score[lane_id] = _score(a, b)
+    return score
+
+
+def _score(a, b):
+    return np.maximum(a.hp, 0) / a.max_hp - np.maximum(b.hp, 0) / b.max_hp
+
+
+def _scenario_scores(row, col, settings, scenarios, batch_size):
+    '''
+    Simulate every row Pokemon against every col Pokemon in each shield scenario.
+
+    @param row, col PokemonArrays
+    @param scenarios list of (row shields, col shields), or [None] for the own "num_shields" of each Pokemon
+    @return scores as array of shape (len(scenarios), rows, cols)
+    '''
+    n_rows, n_cols = row.size, col.size
+    n_cells = n_rows * n_cols
+    n_lanes = n_cells * len(scenarios)
+    scores = np.empty(n_lanes)
+
+    for start in range(0, n_lanes, batch_size):
+        lane = np.arange(start, min(start + batch_size, n_lanes))
+        cell = lane % n_cells
+        row_idx, col_idx = cell // n_cols, cell % n_cols
+        if scenarios[0] is None:
+            row_shields, col_shields = row.shields[row_idx], col.shields[col_idx]
+        else:
+            scenario = np.array(scenarios)[lane // n_cells]
+            row_shields, col_shields = scenario[:, 0], scenario[:, 1]
+        scores[lane] = simulate_lanes(row, col, row_idx, col_idx,
+                                      row_shields, col_shields, settings)
+
+    return scores.reshape(len(scenarios), n_rows, n_cols)
+
+
+def battle_matrix(row_pkm, col_pkm, settings, average_by_shield=False, batch_size=1 << 18):
+    '''
+    Simulate every row Pokemon against every col Pokemon.
+
+    @param row_pkm list of battle-ready Pokemon
+    @param col_pkm list of battle-ready Pokemon. If empty, row Pokemon are used
+    @param settings PvPSettings
+    @param average_by_shield if True, average over all 0-2 shield scenarios;
+        otherwise each Pokemon uses its own "num_shields" (default 0)
+    @param batch_size maximum number of lanes simulated at once
+    @return matrix as 2D array
+    '''
+    if average_by_shield:
+        return shield_average(shield_tensor(row_pkm, col_pkm, settings, batch_size))
+    col_pkm = col_pkm or row_pkm
+    return _scenario_scores(PokemonArrays(row_pkm), PokemonArrays(col_pkm), settings, [None], batch_size)[0]
+
+
+def shield_tensor(row_pkm, col_pkm, settings, batch_size=1 << 18):
+    '''
+    Simulate every row Pokemon against every col Pokemon in every shield scenario at once.
+    Pokemon are prepared once and the lanes of all scenarios share batches.
+
+    @param row_pkm list of battle-ready Pokemon
+    @param col_pkm list of battle-ready Pokemon. If empty, row Pokemon are used
+    @param settings PvPSettings
+    @param batch_size maximum number of lanes simulated at once
+    @return array of shape (rows, cols, row shields, col shields), over SHIELD_SCENARIOS
+    '''
+    col_pkm = col_pkm or row_pkm
+    row = PokemonArrays(row_pkm)
+    col = PokemonArrays(col_pkm)
+    n = len(SHIELD_SCENARIOS)
+    scenarios = [(sa, sb) for sa in SHIELD_SCENARIOS for sb in SHIELD_SCENARIOS]
+    scores = _scenario_scores(row, col, settings, scenarios, batch_size)
+    return np.ascontiguousarray(scores.reshape(n, n, row.size, col.size).transpose(2, 3, 0, 1))
+
+
+def shield_average(tensor):
+    '''
+    Return the shield-averaged matrix of a shield tensor of shape (rows, cols, row shields, col shields).
+    '''
+    tensor = np.asarray(tensor, dtype=np.float64)
+    n_rows, n_cols = tensor.shape[:2]
+    # Average scenario by scenario, in the order of a scenario-major simulation
+    return np.ascontiguousarray(tensor.reshape(n_rows, n_cols, -1).transpose(2, 0, 1)).mean(axis=0)
+
+
+class VectorGBS:
+    '''
+    Drop-in replacement of the native GBS interface backed by the NumPy simulator.
+    Only "battlematrix" battle mode is supported. With "shieldTensor" set in the input, the output is the
+    score of every matchup in every shield scenario, as nested list of shape (rows, cols, 3, 3).
+    '''
+
+    # Input is simulated as Python objects, so encoded input would only be decoded again
+    encoded_input = False
+    # Input may ask for the scores of every shield scenario at once ("shieldTensor")
+    shield_tensor_output = True
+    # Battles are simulated the same from either side, so M[j][i] == -M[i][j]
+    antisymmetric = True
+
+    _config = None
+    _settings = None
+    _input = None
+    _output = None
+    _error = ""
+
+    @staticmethod
+    def version():
+        return "numpy-{}".format(MODEL_VERSION)
+
+    @staticmethod
+    def error():
+        return VectorGBS._error
+
+    @staticmethod
+    def config(game_master=None):
+        if game_master is not None:
+            VectorGBS._config = json.loads(json.dumps(game_master))
+            VectorGBS._settings = None
+        return VectorGBS._get_config()
+
+    @staticmethod
+    def _get_config():
+        if VectorGBS._config is not None:
+            return VectorGBS._config
+        if GameMaster.CurrentInstance is not None:
+            return GameMaster.CurrentInstance.to_json()
+        return {}
+
+    @staticmethod
+    def _get_settings():
+        # Settings (with their damage table) are built once per configuration
+        if VectorGBS._config is None:
+            return PvPSettings(VectorGBS._get_config())
+        if VectorGBS._settings is None:
+            VectorGBS._settings = PvPSettings(VectorGBS._config)
+        return VectorGBS._settings
+
+    @staticmethod
+    def prepare(sim_input):
+        VectorGBS._error = ""
+        VectorGBS._output = None
+        battle_mode = sim_input.get("battleMode")
+        if battle_mode != "battlematrix":
+            VectorGBS._error = "unsupported battleMode {}".format(battle_mode)
+            raise ValueError(VectorGBS._error)
+        VectorGBS._input = sim_input
+
+    @staticmethod
+    def prepare_encoded(in_bytes):
+        VectorGBS.prepare(json.loads(in_bytes))
+
+    @staticmethod
+    def run():
+        sim_input = VectorGBS._input
+        if sim_input is None:
+            VectorGBS._error = "no simulation input prepared"
+            raise RuntimeError(VectorGBS._error)
+        try:
+            settings = VectorGBS._get_settings()
+            if sim_input.get("shieldTensor", False):
+                VectorGBS._output = shield_tensor(sim_input["rowPokemon"],
+                                                  sim_input.get("colPokemon", []),
+                                                  settings).tolist()
+                return
+            matrix = battle_matrix(sim_input["rowPokemon"],
+                                   sim_input.get("colPokemon", []),
+                                   settings,
+                                   sim_input.get("avergeByShield", False))
+        except Exception as e:
+            VectorGBS._error = str(e)
+            raise
+        VectorGBS._output = matrix.tolist()
+
+    @staticmethod
+    def collect():
+        return VectorGBS._output
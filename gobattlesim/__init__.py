@@ -1,2 +1,2 @@
 
-__all__ = ["Engine", "GameMaster", "PokeQuery", "Matrix"]
+__all__ = ["Engine", "GameMaster", "PokeQuery", "Matrix", "Server"]
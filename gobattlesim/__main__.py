@@ -1,5 +1,9 @@
+import sys
 
 from .Engine import main
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["serve"]:
+        from .Server import main as serve
+        exit(serve(sys.argv[2:]))
     main()
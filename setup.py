@@ -17,6 +17,9 @@ setuptools.setup(
         "Development Status :: 4 - Beta"
     ],
 
-    packages=setuptools.find_packages(),
+    packages=setuptools.find_packages(exclude=["benchmarks"]),
+    install_requires=["numpy"],
+    # Exact Nash equilibria in module Ranking
+    extras_require={"lp": ["scipy"]},
     package_data={'gobattlesim': ['libGoBattleSim.dll', 'libGoBattleSim.so']},
 )
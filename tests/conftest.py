@@ -0,0 +1,51 @@
+import json
+import os
+
+import pytest
+
+from gobattlesim.GameMaster import GameMaster
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GAME_MASTER_PATH = os.path.join(ROOT, "game_master", "GAME_MASTER.json")
+POKEMON_PATH = os.path.join(ROOT, "examples", "kanto_starters.csv")
+
+
+@pytest.fixture(scope="session", autouse=True)
+def cache_dir(tmp_path_factory):
+    # Keep snapshots, IV rankings and matchups out of the user's cache
+    path = str(tmp_path_factory.mktemp("cache"))
+    old = os.environ.get("GBS_CACHE_DIR")
+    os.environ["GBS_CACHE_DIR"] = path
+    yield path
+    if old is None:
+        del os.environ["GBS_CACHE_DIR"]
+    else:
+        os.environ["GBS_CACHE_DIR"] = old
+
+
+@pytest.fixture(scope="session")
+def game_master():
+    gm = GameMaster().parse(GAME_MASTER_PATH)
+    gm.apply()
+    return gm
+
+
+@pytest.fixture(scope="session")
+def config_path(game_master, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("config") / "GBS.json")
+    with open(path, "w") as fd:
+        json.dump(game_master.to_json(), fd)
+    return path
+
+
+@pytest.fixture
+def pokemon_path():
+    return POKEMON_PATH
+
+
+@pytest.fixture(scope="session")
+def great_league_pokemon(game_master):
+    # Imported here, so that conftest loads without the engine
+    from gobattlesim.Matrix import load_and_set_pokemon
+    return load_and_set_pokemon(POKEMON_PATH, "great", game_master)
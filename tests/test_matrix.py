@@ -0,0 +1,92 @@
+import csv
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from gobattlesim.Cache import MatchupCache
+from gobattlesim.Engine import default_session
+from gobattlesim.Matrix import (BattleMatrix, check_antisymmetric, do_run_matrix, do_run_matrix_triangular,
+                                run_pokemon_matrix, save_matrix)
+
+from conftest import ROOT
+
+
+def run_cli(*args):
+    subprocess.run([sys.executable, "-m", "gobattlesim.Matrix"] + [str(arg) for arg in args],
+                   cwd=ROOT, env=os.environ.copy(), check=True)
+
+
+def read_matrix(path, fmt):
+    if fmt in ("csv", "tsv"):
+        with open(path, newline="") as fd:
+            rows = csv.reader(fd, dialect="excel-tab" if fmt == "tsv" else "excel")
+            return np.array([[float(x) for x in row] for row in rows])
+    if fmt == "json":
+        with open(path) as fd:
+            return np.array(json.load(fd))
+    return np.asarray(BattleMatrix.load(str(path)).values)
+
+
+@pytest.mark.parametrize("fmt", ["csv", "json", "npy"])
+def test_save_matrix_accepts_arrays(tmp_path, fmt):
+    matrix = np.array([[0.0, 0.25], [-0.25, 0.0]])
+    path = tmp_path / ("matrix." + fmt)
+    with open(path, "wb" if fmt == "npy" else "w", newline=None if fmt == "npy" else "") as fd:
+        save_matrix(matrix, fd, fmt)
+    assert np.allclose(read_matrix(path, fmt), matrix)
+
+
+@pytest.mark.parametrize("fmt", ["csv", "tsv", "json", "npy", "npz"])
+def test_update_matches_full_run(tmp_path, config_path, pokemon_path, fmt):
+    # The old matrix only covers the first Pokemon, so the update simulates the others
+    with open(pokemon_path) as fd:
+        lines = fd.readlines()
+    old_pokemon = tmp_path / "old.csv"
+    old_pokemon.write_text("".join(lines[:8]))
+    run_cli(old_pokemon, "-c", config_path, "--league", "great", "-o", tmp_path / "old.npz")
+
+    run_cli(pokemon_path, "-c", config_path, "--league", "great", "-o", tmp_path / "full.csv")
+    run_cli(pokemon_path, "-c", config_path, "--league", "great", "--update", tmp_path / "old.npz",
+            "-o", tmp_path / ("updated." + fmt))
+
+    full = read_matrix(tmp_path / "full.csv", "csv")
+    updated = read_matrix(tmp_path / ("updated." + fmt), fmt)
+    assert updated.shape == full.shape
+    assert np.allclose(updated, full, atol=1e-6)
+
+
+def test_triangular_matches_full_run(game_master, great_league_pokemon):
+    default_session().configure(game_master)
+    full = np.array(do_run_matrix(great_league_pokemon, [], 0))
+    for block_size in [1, 4, None]:
+        assert np.array_equal(np.array(do_run_matrix_triangular(great_league_pokemon, 0, block_size)), full)
+
+
+def test_triangular_cache_keeps_simulated_matchups_only(tmp_path, game_master, great_league_pokemon):
+    default_session().configure(game_master)
+    full = np.array(do_run_matrix(great_league_pokemon, [], 0))
+    cache = MatchupCache(str(tmp_path / "matchups.sqlite"))
+    # Part of the matchups are cached first, so that the others are mirrored from them
+    run_pokemon_matrix(great_league_pokemon[:6], [], 0, triangular=True, cache=cache)
+    matrix = run_pokemon_matrix(great_league_pokemon, [], 0, triangular=True, cache=cache)
+    assert np.array_equal(np.array(matrix), full)
+    # Only the upper triangle, diagonal included, was simulated and stored
+    n = len(great_league_pokemon)
+    assert cache.db.execute("SELECT COUNT(*) FROM matchup").fetchone()[0] == n * (n + 1) // 2
+    assert np.array_equal(np.array(run_pokemon_matrix(great_league_pokemon, [], 0, cache=cache)), full)
+    cache.close()
+
+
+def test_triangular_requires_antisymmetric_engine(great_league_pokemon):
+    class Engine:
+        @staticmethod
+        def version():
+            return "test"
+
+    with pytest.raises(Exception, match="antisymmetric"):
+        check_antisymmetric(Engine)
+    check_antisymmetric(default_session().engine)
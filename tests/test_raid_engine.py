@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from gobattlesim.RaidEngine import (NO_WEATHER, RaidSettings, raid_boss, raid_counters, set_raid_attacker,
+                                    simulate_raid, summarize)
+
+
+@pytest.fixture(scope="module")
+def settings(game_master):
+    return RaidSettings(game_master, "5")
+
+
+@pytest.fixture(scope="module")
+def boss(game_master):
+    return raid_boss("tyranitar", "bite", "crunch", "5", game_master)
+
+
+def attacker(game_master, name, fmove, cmove, level=40):
+    return set_raid_attacker({"name": name, "fmove": fmove, "cmove": cmove, "level": level}, game_master)
+
+
+def test_same_seed_same_results(game_master, settings, boss):
+    party = [attacker(game_master, "machamp", "counter", "dynamic punch")] * 6
+    first = simulate_raid([party], boss, settings, trials=20, seed=1)
+    second = simulate_raid([party], boss, settings, trials=20, seed=1)
+    for name in first:
+        assert np.array_equal(first[name], second[name])
+
+
+def test_results_are_consistent(game_master, settings, boss):
+    party = [attacker(game_master, "machamp", "counter", "dynamic punch")] * 6
+    results = simulate_raid([party, party[:1]], boss, settings, (NO_WEATHER, "CLOUDY"), trials=20, seed=0)
+    assert results["win"].shape == (2, 2, 20)
+    assert np.all(results["damage"] <= boss["maxHP"])
+    assert np.all(results["time"] <= settings.time_limit)
+    # One trainer cannot beat a tier 5 boss: the whole party faints, and a bigger party deals more damage
+    assert not results["win"].any()
+    assert np.all(results["fainted"] == [[[6]], [[1]]])
+    summary = summarize(results)
+    assert np.all(summary["tdo"][0] > 3 * summary["tdo"][1])
+    assert np.all(np.isnan(summary["time_to_win"]))
+
+
+def test_weak_boss_is_beaten(game_master):
+    settings = RaidSettings(game_master, "1")
+    boss = raid_boss("tyranitar", "bite", "crunch", "1", game_master)
+    party = [attacker(game_master, "machamp", "counter", "dynamic punch")]
+    results = simulate_raid([party], boss, settings, trials=20, seed=0)
+    assert results["win"].all()
+    # Won battles dealt all the boss HP
+    assert np.all(results["damage"] == boss["maxHP"])
+    summary = summarize(results)
+    assert summary["time_to_win"][0, 0] == pytest.approx(results["time"].mean())
+
+
+def test_weather_boosts_damage(game_master, settings, boss):
+    machamp = attacker(game_master, "machamp", "counter", "dynamic punch")
+    rows = raid_counters([machamp], boss, settings, (NO_WEATHER, "CLOUDY", "RAINY"), trials=20, seed=0)
+    dps = {row["weather"]: row["dps"] for row in rows}
+    # Cloudy boosts fighting moves; rainy does not boost machamp's moves
+    assert dps["CLOUDY"] > dps[NO_WEATHER]
+    assert dps["RAINY"] == pytest.approx(dps[NO_WEATHER], rel=0.1)
+
+
+def test_counters_are_ranked_by_dps(game_master, settings, boss):
+    attackers = [attacker(game_master, "magikarp", "splash", "struggle"),
+                 attacker(game_master, "machamp", "counter", "dynamic punch"),
+                 attacker(game_master, "machamp", "counter", "dynamic punch", level=20)]
+    rows = raid_counters(attackers, boss, settings, trials=20, seed=0)
+    assert [row["dps"] for row in rows] == sorted([row["dps"] for row in rows], reverse=True)
+    assert rows[0]["name"] == "machamp" and rows[-1]["name"] == "magikarp"
+    assert rows[-1]["win_rate"] == 0
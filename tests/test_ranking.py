@@ -0,0 +1,100 @@
+import numpy as np
+import pytest
+
+from gobattlesim.Matrix import BattleMatrix
+from gobattlesim.Ranking import (equilibrium_gap, fictitious_play, nash_equilibrium, nash_lp, rank_matrix,
+                                 regret_matching, weighted_win_rate, win_rate)
+
+
+ROCK_PAPER_SCISSORS = np.array([[0, -1, 1], [1, 0, -1], [-1, 1, 0]], dtype=float)
+
+# Unique equilibrium: row (3/7, 4/7), col (2/7, 5/7), value 1/7
+TWO_BY_TWO = np.array([[3, -1], [-2, 1]], dtype=float)
+
+
+def random_antisymmetric(n, seed=0):
+    values = np.triu(np.random.default_rng(seed).uniform(-1, 1, (n, n)), 1)
+    return (values - values.T).astype(np.float32)
+
+
+def test_regret_matching_solves_known_games():
+    equilibrium = regret_matching(ROCK_PAPER_SCISSORS, 1e-6, 100000)
+    assert equilibrium.converged
+    assert np.allclose(equilibrium.row_strategy, 1 / 3, atol=1e-4)
+    assert equilibrium.value == pytest.approx(0, abs=1e-6)
+
+    equilibrium = regret_matching(TWO_BY_TWO, 1e-4, 100000)
+    assert equilibrium.converged
+    assert equilibrium.gap < 1e-4
+    assert np.allclose(equilibrium.row_strategy, [3 / 7, 4 / 7], atol=1e-3)
+    assert np.allclose(equilibrium.col_strategy, [2 / 7, 5 / 7], atol=1e-3)
+    assert equilibrium.value == pytest.approx(1 / 7, abs=1e-4)
+
+
+def test_fictitious_play_approximates_known_games():
+    # Fictitious play converges slowly, so only to a loose tolerance
+    equilibrium = fictitious_play(TWO_BY_TWO, 1e-2, 100000)
+    assert equilibrium.converged
+    assert np.allclose(equilibrium.row_strategy, [3 / 7, 4 / 7], atol=1e-2)
+    assert equilibrium.value == pytest.approx(1 / 7, abs=1e-2)
+
+
+@pytest.mark.parametrize("n", [50, 300])
+def test_regret_matching_reaches_tolerance(n):
+    values = random_antisymmetric(n)
+    equilibrium = regret_matching(values, 1e-3, 10000)
+    assert equilibrium.converged
+    assert equilibrium.gap < 1e-3
+    assert equilibrium.gap == pytest.approx(
+        equilibrium_gap(values, equilibrium.row_strategy, equilibrium.col_strategy))
+    assert equilibrium.row_strategy.sum() == pytest.approx(1)
+    # Symmetric game: the value is 0
+    assert equilibrium.value == pytest.approx(0, abs=1e-3)
+
+
+def test_dominated_pokemon_get_no_share():
+    # Row 2 loses to everything the others beat
+    values = np.array([[0, 0.5, 0.8], [-0.5, 0, 0.6], [-0.8, -0.6, 0]])
+    equilibrium = nash_equilibrium(values, "rm", 1e-6)
+    assert equilibrium.row_strategy[0] == pytest.approx(1, abs=1e-3)
+
+
+def test_nash_equilibrium_reports_convergence():
+    values = random_antisymmetric(100)
+    with pytest.warns(UserWarning, match="did not converge"):
+        equilibrium = nash_equilibrium(values, "rm", 1e-9, 5)
+    assert not equilibrium.converged
+    assert equilibrium.iterations == 5
+
+
+def test_linear_programming_matches_regret_matching():
+    pytest.importorskip("scipy")
+    values = random_antisymmetric(60)
+    exact = nash_lp(values)
+    assert exact.gap < 1e-6
+    approximate = regret_matching(values, 1e-4, 100000)
+    assert approximate.value == pytest.approx(exact.value, abs=1e-4)
+
+
+def test_weighted_win_rate_of_transitive_meta():
+    # Pokemon i beats every Pokemon j > i
+    n = 6
+    values = np.sign(np.arange(n)[None, :] - np.arange(n)[:, None]).astype(np.float32)
+    assert np.allclose(win_rate(values), (n - 1 - np.arange(n) + 0.5) / n)
+    weighted = weighted_win_rate(values)
+    assert weighted.converged
+    assert np.all(np.diff(weighted.row_rating) < 0)
+    assert np.allclose(weighted.row_rating, weighted.col_rating, atol=1e-5)
+
+
+def test_rank_matrix():
+    values = random_antisymmetric(40, seed=1)
+    labels = ["pkm{}".format(i) for i in range(40)]
+    ranking = rank_matrix(BattleMatrix(values, labels))
+    assert ranking.converged
+    assert sorted(row["label"] for row in ranking) == sorted(labels)
+    assert [row["weighted_win_rate"] for row in ranking] == sorted(
+        [row["weighted_win_rate"] for row in ranking], reverse=True)
+    assert sum(row["nash_share"] for row in ranking) == pytest.approx(1)
+    scores = {row["label"]: row["score"] for row in ranking}
+    assert scores["pkm3"] == pytest.approx(values[3].mean())
@@ -0,0 +1,79 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from gobattlesim.Matrix import BattleMatrix
+from gobattlesim.TeamBuilder import popcount, search_teams, win_bitsets
+
+
+N_ROWS = 16
+N_COLS = 24
+TOP = 7
+
+
+@pytest.fixture(scope="module")
+def matrix():
+    rng = np.random.default_rng(3)
+    labels = ["mon{} fast/charged".format(i) for i in range(N_ROWS)]
+    return BattleMatrix(rng.uniform(-1, 1, (N_ROWS, N_COLS)), labels, [str(j) for j in range(N_COLS)])
+
+
+@pytest.fixture(scope="module")
+def weights():
+    weights = np.random.default_rng(4).uniform(0, 1, N_COLS)
+    return (weights / weights.sum()).astype(np.float32)
+
+
+def team_value(best, objective, weights):
+    if objective == "meta":
+        return float(best @ weights)
+    if objective == "worst":
+        return float(best.min())
+    return float((best > 0).sum())
+
+
+def brute_force(matrix, size, objective, weights, species=None, banned=()):
+    values = matrix.values
+    allowed = [i for i in range(N_ROWS) if matrix.row_labels[i].split(" ")[0] not in banned]
+    results = []
+    for team in itertools.combinations(allowed, size):
+        if species is not None and len({species[i] for i in team}) < size:
+            continue
+        results.append(team_value(values[list(team)].max(axis=0), objective, weights))
+    return sorted(results, reverse=True)[:TOP]
+
+
+@pytest.mark.parametrize("objective", ["meta", "worst", "wins"])
+@pytest.mark.parametrize("size", [1, 2, 3])
+@pytest.mark.parametrize("restricted", [False, True])
+def test_search_matches_brute_force(matrix, weights, objective, size, restricted):
+    species = [i % 5 for i in range(N_ROWS)] if restricted else None
+    banned = ["mon0", "mon7"] if restricted else ()
+    teams = search_teams(matrix, size, TOP, objective, weights, species, banned)
+
+    expected = brute_force(matrix, size, objective, weights, species, banned)
+    assert np.allclose([team["value"] for team in teams], expected, atol=1e-5)
+    positions = {label: i for i, label in enumerate(matrix.row_labels)}
+    for team in teams:
+        members = [positions[label] for label in team["members"]]
+        assert len(set(members)) == size
+        assert team["value"] == pytest.approx(
+            team_value(matrix.values[members].max(axis=0), objective, weights), abs=1e-5)
+        if restricted:
+            assert len({species[i] for i in members}) == size
+            assert not {"mon0", "mon7"} & {label.split(" ")[0] for label in team["members"]}
+
+
+@pytest.mark.parametrize("objective", ["meta", "worst", "wins"])
+def test_parallel_search_matches_serial(matrix, weights, objective):
+    serial = search_teams(matrix, 3, TOP, objective, weights)
+    parallel = search_teams(matrix, 3, TOP, objective, weights, workers=2)
+    assert np.allclose([team["value"] for team in parallel], [team["value"] for team in serial], atol=1e-5)
+
+
+def test_win_bitsets(matrix):
+    bitsets = win_bitsets(matrix.values)
+    assert np.array_equal(popcount(bitsets), (matrix.values > 0).sum(axis=1))
+    team = np.bitwise_or.reduce(bitsets[[1, 4, 9]], axis=0)
+    assert popcount(team) == (matrix.values[[1, 4, 9]].max(axis=0) > 0).sum()
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from gobattlesim.Engine import EngineSession
+from gobattlesim.VectorEngine import PvPSettings, VectorGBS, battle_matrix, shield_average, shield_tensor
+
+
+@pytest.fixture(scope="module")
+def settings(game_master):
+    return PvPSettings(game_master.to_json())
+
+
+@pytest.fixture(scope="module")
+def tensor(great_league_pokemon, settings):
+    return shield_tensor(great_league_pokemon, [], settings)
+
+
+def test_battle_matrix_is_antisymmetric(great_league_pokemon, settings):
+    matrix = battle_matrix(great_league_pokemon, [], settings)
+    assert matrix.shape == (len(great_league_pokemon), len(great_league_pokemon))
+    assert np.array_equal(matrix, -matrix.T)
+    assert not np.diag(matrix).any()
+    assert np.all(np.abs(matrix) <= 1)
+    # Not all draws
+    assert np.abs(matrix).max() > 0
+
+
+def test_battle_matrix_blocks_match_whole(great_league_pokemon, settings):
+    rows, cols = great_league_pokemon[:5], great_league_pokemon[5:]
+    whole = battle_matrix(great_league_pokemon, [], settings)
+    assert np.array_equal(battle_matrix(rows, cols, settings), whole[:5, 5:])
+    # Batches split lanes without changing results
+    assert np.array_equal(battle_matrix(rows, cols, settings, batch_size=7), whole[:5, 5:])
+
+
+def test_shield_tensor_is_antisymmetric(tensor):
+    assert np.array_equal(tensor, -tensor.transpose(1, 0, 3, 2))
+
+
+def test_shields_help_in_mirror_matches(tensor):
+    mirror = tensor[np.arange(len(tensor)), np.arange(len(tensor))]
+    assert np.all(mirror[:, 2, 0] >= 0)
+    assert np.all(mirror[:, 1, 0] >= 0)
+
+
+def test_shield_average(great_league_pokemon, settings, tensor):
+    averaged = battle_matrix(great_league_pokemon, [], settings, average_by_shield=True)
+    assert np.allclose(averaged, shield_average(tensor))
+    assert np.allclose(averaged, tensor.mean(axis=(2, 3)))
+
+
+def test_engine_interface_matches_battle_matrix(game_master, great_league_pokemon, settings):
+    session = EngineSession(VectorGBS)
+    session.configure(game_master)
+    matrix = session.run_matrix(great_league_pokemon, [], 0)
+    assert np.array_equal(np.asarray(matrix), battle_matrix(great_league_pokemon, [], settings))
+    averaged = session.run_matrix(great_league_pokemon, [], 1)
+    assert np.allclose(averaged, battle_matrix(great_league_pokemon, [], settings, average_by_shield=True))
+    assert np.allclose(session.run_shield_tensor(great_league_pokemon),
+                       shield_tensor(great_league_pokemon, [], settings))